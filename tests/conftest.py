@@ -0,0 +1,52 @@
+"""
+Shared fixtures of the tests: a small Jansen-Rit model, quick enough to simulate many times.
+"""
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import Parameter as par
+from whobpyt.models.jansen_rit import JansenRitModel, JansenRitParams
+
+
+def makeJR(node_size = 4, output_size = 3, TRs_per_window = 5, seed = 0, sc_density = 1., **kwargs):
+    # A small JR model with a few fitted parameters (with priors), its connectivity drawn from seed
+    # (with only a fraction sc_density of the connections kept)
+    rng = np.random.RandomState(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    sc = rng.uniform(0, 1, (node_size, node_size))
+    np.fill_diagonal(sc, 0)
+    dist = rng.uniform(10, 50, (node_size, node_size))
+    dist = (dist + dist.T) / 2
+    lm = rng.normal(0, 1, (output_size, node_size))
+    if sc_density < 1:
+        sc = sc * (rng.uniform(0, 1, (node_size, node_size)) < sc_density)
+
+    params = JansenRitParams(A = par(3.25),
+                             a = par(100, 100, 2, True),
+                             B = par(22),
+                             b = par(50, 50, 1, True),
+                             g = par(500, 500, 2, True),
+                             c1 = par(135, 135, 1, True),
+                             c2 = par(135 * 0.8),
+                             c3 = par(135 * 0.25),
+                             c4 = par(135 * 0.25),
+                             std_in = par(np.log(10), np.log(10), .1, True, True),
+                             vmax = par(5), v0 = par(6), r = par(0.56),
+                             y0 = par(-2, -2, 1/4, True),
+                             mu = par(np.log(1.5), np.log(1.5), .1, True, True, lb = 0.1),
+                             k = par(5.), k0 = par(0), cy0 = par(50, 50, 1, True), ki = par(1),
+                             g_f = par(10), g_b = par(10),
+                             lm = par(lm))
+
+    return JansenRitModel(params, node_size = node_size, TRs_per_window = TRs_per_window, step_size = 0.0001,
+                          output_size = output_size, tr = 0.001, sc = sc, lm = lm, dist = dist, **kwargs)
+
+
+@pytest.fixture
+def jr_model():
+    return makeJR
@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run.adjoint import windowAdjoint
+
+
+def _gradients(model):
+    return [torch.zeros_like(param) if param.grad is None else param.grad.detach().clone()
+            for param in model.params_fitted['modelparameter']]
+
+
+def _zeroGradients(model):
+    for param in model.params_fitted['modelparameter']:
+        param.grad = None
+
+
+@pytest.mark.parametrize("num_windows", [2, 3])
+def test_window_adjoint_matches_bptt(jr_model, num_windows):
+    model = jr_model(use_fit_gains = True)
+    model.setNoise(1)
+    cost = CostsJR(model)
+
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    externals = [torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window) for _ in range(num_windows)]
+    targets = [torch.randn(model.output_size, model.TRs_per_window) for _ in range(num_windows)]
+
+    # Backpropagation through time over the whole segment
+    model.noise.reset(1)
+    model.invalidateCoupling()
+    _zeroGradients(model)
+    X_w, hE_w = X.clone(), hE.clone()
+    total = 0
+    bptt_losses = []
+    for external, target in zip(externals, targets):
+        next_window, hE_w = model(external, X_w, hE_w)
+        X_w = next_window['current_state']
+        loss, loss_main = cost.loss(next_window, target)
+        total = total + loss / num_windows
+        bptt_losses.append(loss_main.detach())
+    total.backward()
+    bptt_grads = _gradients(model)
+
+    # Adjoint, re-simulating one window at a time
+    model.noise.reset(1)
+    model.invalidateCoupling()
+    _zeroGradients(model)
+    windows, X_end, hE_end, losses = windowAdjoint(model, cost, X.clone(), hE.clone(), externals, targets)
+    adjoint_grads = _gradients(model)
+
+    assert len(windows) == num_windows
+    assert torch.allclose(X_end, X_w.detach(), rtol = 1e-5, atol = 1e-6)
+    for loss, bptt_loss in zip(losses, bptt_losses):
+        assert torch.allclose(loss, bptt_loss, rtol = 1e-5, atol = 1e-6)
+    for grad, bptt_grad in zip(adjoint_grads, bptt_grads):
+        assert torch.allclose(grad, bptt_grad, rtol = 1e-4, atol = 1e-6)
@@ -0,0 +1,94 @@
+import math
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import DtypePolicy, Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import FittingBatch, Telemetry
+
+BATCH_SIZE = 3
+
+
+def _model(jr_model):
+    model = jr_model()
+    model.setDtypePolicy(DtypePolicy.double())
+    model.setBlocks(BATCH_SIZE)
+    return model
+
+
+def _empRec(model):
+    return Timeseries(np.random.RandomState(3).normal(0, 1, (model.output_size, model.sim_len)), step_size = 0.001)
+
+
+def _single(model, X, hE, noise):
+    # One simulation on its own, without a batch axis
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.sim_len)
+    with torch.no_grad():
+        window, _ = model(external, X, hE, noise)
+    return window
+
+
+def test_batched_forward_matches_each_simulation(jr_model):
+    model = _model(jr_model)
+    X = model.createIC(ver = 0, batch_size = BATCH_SIZE)
+    hE = model.createDelayIC(ver = 0, batch_size = BATCH_SIZE)
+    noise = model.genNoise(model.sim_len, batched = True)[1]
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.sim_len)
+
+    with torch.no_grad():
+        batched, _ = model(external, X, hE, noise)
+
+    for block in range(BATCH_SIZE):
+        single = _single(model, X[block], hE[block], noise[:, block])
+        for name in single:
+            assert torch.allclose(batched[name][block], single[name], rtol = 1e-10, atol = 1e-12), name
+
+
+def test_block_noise_laid_end_to_end_is_the_serial_noise(jr_model):
+    model = _model(jr_model)
+    block_len = 2
+    serial, blocks = model.genNoise(block_len, batched = True)
+    assert blocks.shape == (3, BATCH_SIZE, model.node_size, model.steps_per_TR, block_len)
+    for block in range(BATCH_SIZE):
+        assert torch.equal(serial[:, 0, ..., block * block_len:(block + 1) * block_len], blocks[:, block])
+
+
+def test_evaluate_loss_per_block(jr_model):
+    model = _model(jr_model)
+    cost = CostsJR(model)
+    fit = FittingBatch(model, cost, telemetry = Telemetry([]))
+    empRec = _empRec(model)
+
+    # The simulations start from the last initial conditions created
+    X = model.createIC(ver = 0, batch_size = BATCH_SIZE)
+    hE = model.createDelayIC(ver = 0, batch_size = BATCH_SIZE)
+    metrics = fit.evaluate(0, empRec, noise_seed = 2)
+    assert fit.lastRec['eeg'].data.shape == (model.output_size, model.sim_len, BATCH_SIZE)
+
+    model.noise.reset(2)
+    noise = model.genNoise(model.sim_len, batched = True)[1]
+    for block in range(BATCH_SIZE):
+        single = _single(model, X[block], hE[block], noise[:, block])
+        with torch.no_grad():
+            loss = float(cost.loss(single, empRec.pyTS())[0])
+        assert math.isclose(metrics['loss_per_block'][block], loss, rel_tol = 1e-9)
+
+
+def test_train_updates_the_parameters(jr_model):
+    model = _model(jr_model)
+    fit = FittingBatch(model, CostsJR(model), telemetry = Telemetry([]))
+    before = [param.detach().clone() for param in model.params_fitted['modelparameter']]
+
+    fit.train(0, [_empRec(model)] * 2, num_epochs = 2, batch_size = BATCH_SIZE)
+
+    assert len(fit.trainingStats.loss) == 2
+    assert all(math.isfinite(loss) for loss in fit.trainingStats.loss)
+    assert any(not torch.equal(param, ref) for param, ref in zip(model.params_fitted['modelparameter'], before))
+    assert fit.lastRec['eeg'].data.shape == (model.output_size, model.sim_len, BATCH_SIZE)
+
+    # simulate continues every simulation across forward calls
+    fit.simulate(0, 2 * model.sim_len + 1)
+    assert fit.lastRec['eeg'].data.shape == (model.output_size, 3 * model.sim_len, BATCH_SIZE)
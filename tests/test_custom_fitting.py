@@ -0,0 +1,44 @@
+import math
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import DtypePolicy, Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import FittingFNGFPG, Telemetry
+
+BLOCK_LEN = 2
+
+
+@pytest.mark.parametrize("with_stim, resetIC", [(False, True), (True, True), (False, False)])
+def test_parallel_blocks_reproduce_the_serial_run(jr_model, with_stim, resetIC):
+    model = jr_model(TRs_per_window = 6)
+    model.setDtypePolicy(DtypePolicy.double())
+    fit = FittingFNGFPG(model, CostsJR(model), telemetry = Telemetry([]))
+
+    stim = 0
+    if with_stim:
+        stim = torch.randn(model.node_size, model.steps_per_TR, model.sim_len, dtype = torch.float64)
+    empDatas = [Timeseries(np.random.RandomState(seed).normal(0, 1, (model.output_size, model.sim_len)), step_size = 0.001)
+                for seed in [3, 4]]
+
+    # Without resetIC, the second backpropagation continues the simulation from the end of the first
+    fit.train(stim, empDatas, num_epochs = 2, block_len = BLOCK_LEN, resetIC = resetIC)
+
+    assert len(fit.trainingStats.loss) == 2
+    assert all(math.isfinite(loss) for loss in fit.trainingStats.loss)
+    assert set(fit.lastRec) == set(fit.lastSerial) == set(model.recordNames())
+    for name in fit.lastSerial:
+        serial = fit.lastSerial[name].data
+        assert serial.shape[-1] == model.sim_len
+        assert fit.lastRec[name].data.shape == serial.shape, name
+        assert torch.allclose(fit.lastRec[name].data, serial, rtol = 1e-9, atol = 1e-12), name
+
+
+def test_block_len_must_divide_sim_len(jr_model):
+    model = jr_model(TRs_per_window = 5)
+    fit = FittingFNGFPG(model, CostsJR(model), telemetry = Telemetry([]))
+    with pytest.raises(ValueError):
+        fit.train(0, [None], num_epochs = 1, block_len = BLOCK_LEN)
@@ -0,0 +1,64 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import DelayBuffer
+
+
+def _shift(history, value):
+    # The history shifted by one sample, as the dense tensor of the original implementation
+    return torch.cat([value.unsqueeze(-1), history[..., :-1]], dim = -1)
+
+
+def test_ring_buffer_matches_shifted_history():
+    gen = torch.Generator().manual_seed(0)
+    batch_size, num_nodes, delays_max = 2, 4, 7
+    history = torch.randn(batch_size, num_nodes, delays_max, generator = gen)
+    delays = torch.randint(0, delays_max, (batch_size, num_nodes, num_nodes), generator = gen)
+    weights = torch.randn(num_nodes, num_nodes, generator = gen)
+
+    buffer = DelayBuffer(history.clone())
+    index = buffer.gatherIndex(delays)
+    w_zero = weights.reshape(1, -1)[:, index['zero_pos']]
+
+    # More shifts than the length of the ring, so that the head wraps around
+    for _ in range(3 * delays_max):
+        value = torch.randn(batch_size, num_nodes, generator = gen)
+        buffer.push(value)
+        history = _shift(history, value)
+        assert torch.equal(buffer.toTensor(), history)
+
+        # Entry [j, i] holds the history of node i at the delay of the connection i -> j, zero for zero delays
+        delayed = torch.gather(history, 2, delays) * (delays > 0)
+        assert torch.equal(buffer.gather(index), delayed.transpose(-1, -2))
+
+        # The zero-delay connections read the current value
+        zero = (delays == 0).transpose(-1, -2).to(weights.dtype)
+        expected = torch.einsum('ji,bji,bi->bj', weights, zero, history[..., 0])
+        assert torch.allclose(buffer.gatherCurrent(index, w_zero)[0], expected, atol = 1e-6)
+
+
+def test_delay_buffer_too_short_for_delays():
+    buffer = DelayBuffer(torch.zeros(3, 4))
+    with pytest.raises(ValueError):
+        buffer.gatherIndex(torch.full((3, 3), 4, dtype = torch.int64))
+
+
+def test_forward_with_delay_buffer_matches_tensor(jr_model):
+    model = jr_model()
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    noise = torch.randn(3, model.node_size, model.steps_per_TR, model.TRs_per_window)
+
+    with torch.no_grad():
+        window, hE_tensor = model(external, X, hE.clone(), noise)
+        window_buffer, buffer = model(external, X, DelayBuffer(hE.clone()), noise)
+
+    assert isinstance(buffer, DelayBuffer)
+    assert torch.equal(buffer.toTensor(), hE_tensor)
+    for name in window:
+        assert torch.equal(window_buffer[name], window[name]), name
+
+    # The history moved back by one sample per simulated sample point
+    assert torch.equal(hE_tensor[:, model.TRs_per_window + 1:], hE[:, 1:-model.TRs_per_window])
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+dist = torch.distributed
+mp = torch.multiprocessing
+
+if not dist.is_available():
+    pytest.skip("torch.distributed is not available", allow_module_level = True)
+
+from conftest import makeJR
+from whobpyt.datatypes import Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import DistributedFitting, ModelFitting, Telemetry
+from whobpyt.run.distributed_fitting import _freePort
+
+WORLD_SIZE = 2
+
+
+def _reduceWorker(rank, world_size, port, result_dir):
+    # Gives every rank its own gradients, and saves them after the all-reduce
+    dist.init_process_group('gloo', init_method = f"tcp://127.0.0.1:{port}", rank = rank, world_size = world_size)
+    try:
+        model = makeJR()
+        fit = DistributedFitting(model, CostsJR(model), telemetry = Telemetry([]))
+        for i, param in enumerate(model.params_fitted['modelparameter']):
+            param.grad = torch.full_like(param, 10. * rank + i)
+        fit._reduceGradients()
+        torch.save({group: [None if param.grad is None else param.grad.clone() for param in params]
+                    for group, params in model.params_fitted.items()}, os.path.join(result_dir, f"rank{rank}.pt"))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_reduce_gradients_averages_across_ranks(tmp_path):
+    mp.spawn(_reduceWorker, args = (WORLD_SIZE, _freePort(), str(tmp_path)), nprocs = WORLD_SIZE, join = True)
+    grads = [torch.load(str(tmp_path / f"rank{rank}.pt")) for rank in range(WORLD_SIZE)]
+
+    # The mean of 10 * rank + i over the ranks, on every rank
+    for rank_grads in grads:
+        assert len(rank_grads['modelparameter']) > 0
+        for i, grad in enumerate(rank_grads['modelparameter']):
+            assert torch.allclose(grad, torch.full_like(grad, 5. + i))
+        # Parameters without a gradient are left out of the all-reduce
+        assert all(grad is None for grad in rank_grads['hyperparameter'])
+
+
+def _train(fit):
+    data = np.random.RandomState(3).normal(0, 1, (fit.model.output_size, 4 * fit.model.TRs_per_window))
+    fit.train(0, [Timeseries(data, step_size = 0.001)], num_epochs = 1, TPperWindow = fit.model.TRs_per_window, noise_seed = 3)
+
+
+def test_world_of_one_matches_model_fitting(jr_model, tmp_path):
+    model = jr_model()
+    reference = ModelFitting(model, CostsJR(model), telemetry = Telemetry([]))
+    _train(reference)
+
+    dist.init_process_group('gloo', init_method = f"file://{tmp_path / 'init'}", rank = 0, world_size = 1)
+    try:
+        model = jr_model()
+        fit = DistributedFitting(model, CostsJR(model), telemetry = Telemetry([]))
+        _train(fit)
+    finally:
+        dist.destroy_process_group()
+
+    assert fit.trainingStats.loss == reference.trainingStats.loss
+    for param, ref_param in zip(fit.model.params_fitted['modelparameter'], reference.model.params_fitted['modelparameter']):
+        assert torch.equal(param, ref_param)
+
+
+def test_distributed_fitting_needs_a_process_group(jr_model):
+    model = jr_model()
+    with pytest.raises(RuntimeError):
+        DistributedFitting(model, CostsJR(model))
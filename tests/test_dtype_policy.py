@@ -0,0 +1,68 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import DtypePolicy
+from whobpyt.functions.solvers import comparePrecision
+from whobpyt.optimization.custom_cost_JR import CostsJR
+
+# Largest relative RMSE (over the standard deviation of the float64 reference) of the noise-free EEG of every policy
+SINGLE_TOLERANCE = 1e-4
+MIXED_TOLERANCE = 5e-2
+
+
+def _window(model):
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    next_window, hE = model(external, X, hE)
+    return X, next_window, hE
+
+
+@pytest.mark.parametrize("policy", [DtypePolicy.double(), DtypePolicy.mixed(torch.bfloat16), DtypePolicy.mixed(torch.float16)])
+def test_policy_dtypes(jr_model, policy):
+    model = jr_model()
+    model.setDtypePolicy(policy)
+    model.setNoise(0)
+    cost = CostsJR(model)
+
+    X, next_window, hE = _window(model)
+    assert X.dtype == policy.state
+    assert hE.dtype == policy.state
+    assert model.noise.sample((2,)).dtype == policy.state
+    for name, values in next_window.items():
+        assert values.dtype == policy.state, name
+
+    target = torch.randn(model.output_size, model.TRs_per_window)
+    loss, loss_main = cost.loss(next_window, target)
+    assert loss.dtype == policy.compute
+    assert loss_main.dtype == policy.compute
+    assert torch.isfinite(loss)
+
+    for param in model.params_fitted['modelparameter']:
+        assert param.dtype == policy.compute
+
+
+def test_policy_validation():
+    assert DtypePolicy.double().compute == torch.float64
+    assert DtypePolicy.mixed().state == torch.bfloat16
+    assert DtypePolicy.mixed().compute == torch.float32
+    with pytest.raises(ValueError):
+        DtypePolicy(torch.float64, torch.float32)
+    with pytest.raises(ValueError):
+        DtypePolicy(torch.float32, torch.float16)
+
+
+def test_noise_free_outputs_within_tolerance(jr_model):
+    model = jr_model()
+    policies = [DtypePolicy.double(), DtypePolicy.single(), DtypePolicy.mixed(torch.bfloat16)]
+    results = comparePrecision(model, policies, num_windows = 3)
+
+    double, single, mixed = results
+    assert all(result['finite'] for result in results)
+    assert double['rmse'] == 0
+    assert single['rel_rmse'] < SINGLE_TOLERANCE
+    assert mixed['rel_rmse'] < MIXED_TOLERANCE
+
+    # The policy of the model is restored
+    assert model.dtype_policy == DtypePolicy.single()
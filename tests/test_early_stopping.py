@@ -0,0 +1,77 @@
+import math
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import EarlyStopping, ModelFitting, Telemetry
+
+
+def _empRec(model, seed = 3):
+    data = np.random.RandomState(seed).normal(0, 1, (model.output_size, 4 * model.TRs_per_window))
+    return Timeseries(data, step_size = 0.001)
+
+
+def _train(model, num_epochs, early_stopping = None):
+    fit = ModelFitting(model, CostsJR(model), telemetry = Telemetry([]))
+    fit.train(0, [_empRec(model)], num_epochs = num_epochs, TPperWindow = model.TRs_per_window, noise_seed = 3,
+              early_stopping = early_stopping)
+    return fit
+
+
+def _fittedParams(fit):
+    return [param.detach().clone() for param in fit.model.params_fitted['modelparameter']]
+
+
+def test_plateau_stops_and_restores_the_best_epoch(jr_model):
+    # No later epoch can improve on the first by a relative 1000%, so the training stops after the second
+    early_stopping = EarlyStopping(patience = 1, min_delta = 10.)
+    fit = _train(jr_model(), 5, early_stopping)
+
+    assert len(fit.trainingStats.loss) == 2
+    assert early_stopping.stop_reason == 'plateau'
+    assert early_stopping.best_epoch == 0
+    assert [entry['epoch'] for entry in early_stopping.history] == [0, 1]
+
+    # The parameters restored are those at the end of the first epoch
+    first_epoch = _train(jr_model(), 1)
+    for param, ref_param in zip(_fittedParams(fit), _fittedParams(first_epoch)):
+        assert torch.equal(param, ref_param)
+
+
+def test_divergence_stops(jr_model):
+    model = jr_model()
+    fit = ModelFitting(model, CostsJR(model), telemetry = Telemetry([]))
+    early_stopping = EarlyStopping(patience = 10, divergence_factor = 10.)
+
+    for epoch, loss in enumerate([1., 0.5]):
+        fit.trainingStats.appendLoss(loss)
+        assert not early_stopping.update(fit, epoch)
+    assert early_stopping.best_epoch == 1
+
+    fit.trainingStats.appendLoss(6.)
+    assert early_stopping.update(fit, 2)
+    assert early_stopping.stop_reason == 'diverged'
+
+    early_stopping.reset()
+    fit.trainingStats.appendLoss(math.nan)
+    assert early_stopping.update(fit, 0)
+    assert early_stopping.stop_reason == 'diverged'
+
+
+def test_validation_leaves_the_training_unchanged(jr_model):
+    # Computing the validation metric does not consume the random streams of the training
+    reference = _train(jr_model(), 2)
+
+    model = jr_model()
+    validation = {'u': 0, 'empRec': _empRec(model, seed = 4), 'TPperWindow': model.TRs_per_window, 'transient_num': 5}
+    early_stopping = EarlyStopping(patience = 10, validation = validation, restore_best = False)
+    fit = _train(model, 2, early_stopping)
+
+    assert fit.trainingStats.loss == reference.trainingStats.loss
+    for param, ref_param in zip(_fittedParams(fit), _fittedParams(reference)):
+        assert torch.equal(param, ref_param)
+    assert all(math.isfinite(entry['val_metric']) for entry in early_stopping.history)
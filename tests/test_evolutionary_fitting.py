@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import DtypePolicy, Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import EvolutionaryFitting, Telemetry
+
+
+class _AmplitudeCost:
+    # The squared deviation of the EEG standard deviation from that of the target: a toy objective, which the noise amplitude
+    # (std_in) and the gains of the populations lower smoothly
+    def loss(self, simData, empData):
+        return (simData['eeg'].std() - empData.std()) ** 2
+
+
+def _empRecs(model, data = None):
+    if data is None:
+        data = np.random.RandomState(3).normal(0, 1, (model.output_size, 4 * model.TRs_per_window))
+    return [Timeseries(data, step_size = 0.001)]
+
+
+def _candidates(fit, num, seed = 0):
+    center, scale = fit._searchScale()
+    return fit._toValues(center + scale * np.random.RandomState(seed).standard_normal((num, fit.dim)))
+
+
+def test_batched_candidates_score_as_single_candidates(jr_model):
+    model = jr_model()
+    model.setDtypePolicy(DtypePolicy.double())
+    fit = EvolutionaryFitting(model, CostsJR(model), telemetry = Telemetry([]))
+    empRecs = _empRecs(model)
+    values = _candidates(fit, 4)
+    initial_state = (model.createIC(ver = 0), model.createDelayIC(ver = 0))
+
+    batched = fit.evaluateCandidates(0, empRecs, model.TRs_per_window, values, warmupWindow = 2, noise_seed = 4,
+                                     initial_state = initial_state)
+    assert np.all(np.isfinite(batched))
+
+    # Each candidate on its own, under the same initial conditions and noise
+    single = [fit.evaluateCandidates(0, empRecs, model.TRs_per_window, {name: value[k:k + 1] for name, value in values.items()},
+                                     warmupWindow = 2, noise_seed = 4, initial_state = initial_state)[0]
+              for k in range(4)]
+    np.testing.assert_allclose(batched, single, rtol = 1e-9)
+
+    # and in batches of at most 3
+    fit.max_batch = 3
+    chunked = fit.evaluateCandidates(0, empRecs, model.TRs_per_window, values, warmupWindow = 2, noise_seed = 4,
+                                     initial_state = initial_state)
+    np.testing.assert_allclose(chunked, batched, rtol = 1e-9)
+
+
+def test_fitness_is_reproducible_within_a_training(jr_model):
+    # The candidates of all the generations start from the same initial conditions, so the same candidate scores the same
+    model = jr_model()
+    fit = EvolutionaryFitting(model, CostsJR(model), popsize = 4, telemetry = Telemetry([]))
+    calls = []
+    evaluateCandidates = fit.evaluateCandidates
+
+    def recordingEvaluate(*args):
+        calls.append(args[-1])
+        return evaluateCandidates(*args)
+
+    fit.evaluateCandidates = recordingEvaluate
+    fit.train(0, _empRecs(model), num_generations = 2, TPperWindow = model.TRs_per_window, warmupWindow = 2, noise_seed = 1, seed = 0)
+
+    assert len(calls) == 3
+    for initial_state in calls[1:]:
+        assert initial_state is calls[0]
+
+
+@pytest.mark.parametrize("method", ['cmaes', 'de'])
+def test_search_lowers_the_loss(jr_model, method):
+    model = jr_model()
+    fit = EvolutionaryFitting(model, _AmplitudeCost(), method = method, popsize = 12, telemetry = Telemetry([]))
+    empRecs = _empRecs(model, np.zeros((model.output_size, 4 * model.TRs_per_window)))
+
+    np.random.seed(5)
+    loss_before = fit.evaluate(0, empRecs, model.TRs_per_window, warmupWindow = 2, noise_seed = 1)
+
+    fit.train(0, empRecs, num_generations = 8, TPperWindow = model.TRs_per_window, warmupWindow = 2, noise_seed = 1, seed = 0)
+    assert len(fit.trainingStats.loss) == 8
+
+    np.random.seed(5)
+    loss_after = fit.evaluate(0, empRecs, model.TRs_per_window, warmupWindow = 2, noise_seed = 1)
+    assert loss_after < loss_before
+
+    # The model keeps the final parameters
+    for name, var in fit.searched:
+        assert torch.equal(var.val, fit.best_params[name])
@@ -0,0 +1,52 @@
+import pickle
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import NoiseProvider
+
+
+def _window(model, X, hE, noise = None):
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    with torch.no_grad():
+        window, _ = model(external, X, hE, noise)
+    return window['eeg']
+
+
+def test_seeded_noise_replays(jr_model):
+    model = jr_model()
+    model.setNoise(7)
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+
+    first = _window(model, X, hE)
+    second = _window(model, X, hE)
+    assert not torch.equal(first, second)
+
+    # Restarting the sequence replays the same noise, whatever else used the global generator in between
+    model.noise.reset()
+    torch.randn(100)
+    assert torch.equal(_window(model, X, hE), first)
+    assert torch.equal(_window(model, X, hE), second)
+
+    # The noise drawn by forward is one block per window, as drawn by a provider with the same seed
+    block = NoiseProvider(7).sample((3, 1, model.node_size, model.steps_per_TR, model.TRs_per_window))
+    assert torch.equal(_window(model, X, hE, block), first)
+
+
+def test_noise_state_replays_from_any_position():
+    for seed in [3, None]:
+        noise = NoiseProvider(seed)
+        noise.sample((4, 5))
+        state = noise.getState()
+        block = noise.sample((4, 5))
+        noise.setState(state)
+        assert torch.equal(noise.sample((4, 5)), block)
+
+
+def test_noise_provider_pickles_its_position():
+    noise = NoiseProvider(11)
+    noise.sample((10,))
+    copy = pickle.loads(pickle.dumps(noise))
+    assert torch.equal(copy.sample((10,)), noise.sample((10,)))
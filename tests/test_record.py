@@ -0,0 +1,46 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import ModelFitting
+
+
+def test_decimated_record_matches_full_record(jr_model):
+    model = jr_model()
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    noise = torch.randn(3, model.node_size, model.steps_per_TR, model.TRs_per_window)
+
+    with torch.no_grad():
+        full, hE_full = model(external, X, hE, noise)
+        model.setRecord(['eeg', 'P'], every = 2)
+        decimated, hE_decimated = model(external, X, hE, noise)
+
+    assert set(full) == set(model.state_names + model.output_names + ['current_state'])
+    assert set(decimated) == {'current_state', 'eeg', 'P'}
+    for name in ['eeg', 'P']:
+        assert torch.equal(decimated[name], full[name][..., ::2]), name
+
+    # Recording less does not change the simulation
+    assert torch.equal(decimated['current_state'], full['current_state'])
+    assert torch.equal(hE_decimated, hE_full)
+
+
+def test_record_validation(jr_model):
+    model = jr_model()
+    with pytest.raises(ValueError):
+        model.setRecord(['eeg', 'not_a_state'])
+    with pytest.raises(ValueError):
+        model.setRecord(['eeg'], every = 0)
+
+
+def test_simulate_keeps_only_recorded_outputs(jr_model):
+    model = jr_model()
+    model.setRecord(['eeg'], every = 2)
+    fit = ModelFitting(model, CostsJR(model))
+    fit.simulate(0, 4 * model.TRs_per_window, base_window_num = 1)
+
+    assert list(fit.lastRec) == ['eeg']
+    assert fit.lastRec['eeg'].data.shape == (model.output_size, 4 * -(-model.TRs_per_window // 2))
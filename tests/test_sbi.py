@@ -0,0 +1,98 @@
+import math
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.optimization import SummaryFeatures
+from whobpyt.run import MixtureDensityEstimator, SimulationBasedInference, Telemetry
+
+
+def test_summary_features_shapes():
+    num_regions, length, batch_size = 3, 40, 5
+    ts = torch.randn(batch_size, num_regions, length, generator = torch.Generator().manual_seed(0))
+
+    # 4 ERP bins, and 2 PSD frequencies (2 to 40 Hz at 1000 Hz over 40 time points) per region, and 3 FC pairs
+    features = SummaryFeatures('eeg', num_regions, 1000., erp_bins = 4)
+    x = features.compute(ts)
+    assert x.shape == (batch_size, num_regions * 4 + num_regions * 2 + 3)
+    assert torch.isfinite(x).all()
+
+    # A single time series, or a dict of model outputs, is a batch of one
+    assert features.compute(ts[0]).shape == (1, x.shape[1])
+    assert torch.equal(features.compute({'eeg': ts}), x)
+
+    erp = SummaryFeatures('eeg', num_regions, 1000., features = ('erp',), erp_bins = 4).compute(ts)
+    assert torch.allclose(erp, ts.reshape(batch_size, num_regions, 4, 10).mean(-1).reshape(batch_size, -1), atol = 1e-6)
+
+    fc = SummaryFeatures('eeg', num_regions, 1000., features = ('fc',)).compute(ts)
+    rows, cols = np.tril_indices(num_regions, -1)
+    for k in range(batch_size):
+        expected = np.corrcoef(ts[k].numpy())[rows, cols]
+        assert np.allclose(fc[k].numpy(), expected, atol = 1e-5)
+
+    with pytest.raises(ValueError):
+        SummaryFeatures('eeg', num_regions, 1000., features = ('spikes',))
+
+
+def test_mixture_density_estimator():
+    torch.manual_seed(0)
+    estimator = MixtureDensityEstimator(num_features = 3, num_params = 2, num_components = 2, hidden_size = 8)
+    assert estimator.tril_index.shape == (2, 3)
+
+    theta = torch.randn(6, 2)
+    x = torch.randn(6, 3)
+    log_prob = estimator.logProb(theta, x)
+    assert log_prob.shape == (6,)
+    assert torch.isfinite(log_prob).all()
+
+    samples = estimator.sample(x[0], 7)
+    assert samples.shape == (7, 2)
+
+
+def test_mixture_density_is_normalized_after_standardization():
+    # The density of the parameters (not of the standardized ones) integrates to one
+    torch.manual_seed(0)
+    estimator = MixtureDensityEstimator(num_features = 2, num_params = 1, num_components = 3, hidden_size = 8)
+    estimator.setStandardization(torch.randn(50, 2), 5 + 3 * torch.randn(50, 1))
+
+    grid = torch.linspace(-100, 110, 20001).reshape(-1, 1)
+    x = torch.randn(1, 2).expand(grid.shape[0], 2)
+    with torch.no_grad():
+        density = torch.exp(estimator.logProb(grid, x))
+    assert math.isclose(float(torch.trapezoid(density, grid[:, 0])), 1., rel_tol = 1e-3)
+
+
+def _sbi(model):
+    features = SummaryFeatures('eeg', model.output_size, 1000., features = ('erp', 'fc'), erp_bins = 5)
+    return SimulationBasedInference(model, features, num_components = 2, hidden_size = 16, telemetry = Telemetry([]))
+
+
+def test_simulate_train_sample_round_trip(jr_model):
+    sbi = _sbi(jr_model())
+    theta, x = sbi.simulate(40, 0, num_windows = 2, warmupWindow = 2, batch_size = 16, seed = 0)
+    num_features = 3 * 5 + 3 # 5 ERP bins of each of the 3 channels, and 3 FC pairs
+    assert theta.shape[1] == sbi.dim and x.shape == (theta.shape[0], num_features)
+    assert theta.shape[0] > 20
+    assert sbi.theta_bank.shape == theta.shape
+
+    # A seeded simulate is reproducible, whatever the state of numpy's global generator
+    other = _sbi(jr_model())
+    np.random.seed(123)
+    theta_again, x_again = other.simulate(40, 0, num_windows = 2, warmupWindow = 2, batch_size = 16, seed = 0)
+    assert torch.equal(theta_again, theta) and torch.equal(x_again, x)
+
+    sbi.train(num_epochs = 3, batch_size = 16, seed = 0)
+    assert len(sbi.trainingStats.loss) == 3
+    assert all(math.isfinite(loss) for loss in sbi.trainingStats.loss)
+
+    samples = sbi.sample(x[0], num_samples = 10)
+    assert set(samples) == {var_name for var_name, var in sbi.inferred}
+    for var_name, var in sbi.inferred:
+        assert samples[var_name].shape == (10,) + tuple(var.val.shape)
+        assert torch.isfinite(samples[var_name]).all()
+    assert math.isfinite(sbi.logProb(x[0]))
+
+    with pytest.raises(ValueError):
+        sbi.sample(x[0, :-1])
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import TimeseriesStore
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import ModelFitting, Telemetry
+
+
+def _fitting(model):
+    return ModelFitting(model, CostsJR(model), telemetry = Telemetry([]))
+
+
+def _simulate(fit, u, numTP):
+    np.random.seed(1)
+    fit.simulate(u, numTP, base_window_num = 2, noise_seed = 5)
+    return {name: rec.data for name, rec in fit.lastRec.items()}
+
+
+def _stream(fit, u, numTP = None, store = None):
+    np.random.seed(1)
+    windows = list(fit.simulateStream(u, numTP, base_window_num = 2, noise_seed = 5, store = store))
+    return {name: torch.cat([window[name] for window in windows], dim = 1) for name in windows[0]}
+
+
+def test_stream_matches_simulate(jr_model):
+    model = jr_model()
+    fit = _fitting(model)
+    numTP = 6 * model.TRs_per_window
+
+    reference = _simulate(fit, 0, numTP)
+    streamed = _stream(fit, 0, numTP)
+    assert set(streamed) == set(reference)
+    for name in reference:
+        assert torch.equal(streamed[name], reference[name]), name
+
+
+def test_stream_of_stimulus_windows_matches_simulate(jr_model):
+    model = jr_model()
+    fit = _fitting(model)
+    T = model.TRs_per_window
+    u = torch.randn(model.node_size, model.steps_per_TR, 3 * T)
+    reference = _simulate(fit, u, 3 * T)
+
+    # The stimulus given as a function of the window, or as an iterator of windows, ends the simulation with it
+    windows = [u[:, :, i * T:(i + 1) * T] for i in range(3)]
+    by_function = _stream(fit, lambda i: windows[i] if i < 3 else None)
+    by_iterator = _stream(fit, iter(windows))
+    for name in reference:
+        assert torch.equal(by_function[name], reference[name]), name
+        assert torch.equal(by_iterator[name], reference[name]), name
+
+
+def test_stream_store_matches_simulate(jr_model, tmp_path):
+    model = jr_model()
+    model.setRecord(['eeg', 'P'])
+    fit = _fitting(model)
+    numTP = 6 * model.TRs_per_window
+    reference = _simulate(fit, 0, numTP)
+
+    # Chunks of 4 windows, the last one written when the stream ends
+    store = TimeseriesStore(str(tmp_path / 'store'), chunk_windows = 4)
+    _stream(fit, 0, numTP, store)
+    assert sorted(store.names()) == ['P', 'eeg']
+    assert store.chunks['eeg'] == [4 * model.TRs_per_window, 2 * model.TRs_per_window]
+    for name in reference:
+        assert np.array_equal(store.read(name), reference[name].numpy()), name
+    assert store.timeseries('eeg').step_size == float(model.step_size)
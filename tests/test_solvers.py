@@ -0,0 +1,48 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import DtypePolicy
+from whobpyt.functions.solvers import EulerSolver, HeunSolver, RK4Solver, benchmarkSolvers
+
+STEP_SIZES = [2e-4, 1e-4, 5e-5]
+
+
+def test_higher_order_solvers_converge(jr_model):
+    model = jr_model()
+    model.setDtypePolicy(DtypePolicy.double())
+    results = benchmarkSolvers(model, [EulerSolver(), HeunSolver(), RK4Solver()], STEP_SIZES, num_windows = 2, ref_step_size = 1e-5)
+    rmse = {(result['solver'], result['step_size']): result for result in results}
+
+    # Without saturating the states after every step, the error shrinks with the step
+    for name in ['Heun', 'RK4']:
+        errors = [rmse[(name, step_size)]['rmse'] for step_size in STEP_SIZES]
+        assert errors[0] > errors[1] > errors[2], name
+
+    # and RK4 is closer to the converged solution than forward Euler at the same step
+    assert rmse[('RK4', 1e-4)]['rmse'] < rmse[('Euler', 1e-4)]['rmse']
+
+    # Forward Euler at the step of the model is the Euler output itself
+    assert rmse[('Euler', 1e-4)]['rmse_euler'] == 0
+
+    # The solver and step of the model are restored
+    assert isinstance(model.solver, EulerSolver)
+    assert model.steps_per_TR == 10
+
+
+def test_euler_solver_is_the_builtin_step(jr_model):
+    model = jr_model()
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    noise = torch.randn(3, model.node_size, model.steps_per_TR, model.TRs_per_window)
+
+    # For baseline parity, EulerSolver keeps the built-in step, which saturates the states after every step
+    with torch.no_grad():
+        builtin, _ = model(external, X, hE, noise)
+        model.setSolver(RK4Solver())
+        model.setSolver(EulerSolver())
+        euler, _ = model(external, X, hE, noise)
+
+    for name in builtin:
+        assert torch.equal(euler[name], builtin[name]), name
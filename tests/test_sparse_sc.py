@@ -0,0 +1,45 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def _run(model, X, hE, noise):
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    window, hE_end = model(external, X.clone(), hE.clone(), noise)
+    loss = (window['eeg'] ** 2).mean()
+    loss.backward()
+    return window, hE_end
+
+
+@pytest.mark.parametrize("use_laplacian", [True, False])
+def test_sparse_coupling_matches_dense(jr_model, use_laplacian):
+    dense = jr_model(node_size = 6, sc_density = 0.5, use_laplacian = use_laplacian)
+    sparse = jr_model(node_size = 6, sc_density = 0.5, use_laplacian = use_laplacian, use_sparse_sc = True)
+
+    # The edge list only holds the connections of the SC (in either direction)
+    assert sparse.sc_edges.shape[0] < dense.node_size * (dense.node_size - 1)
+
+    X = dense.createIC(ver = 0)
+    hE = dense.createDelayIC(ver = 0)
+    noise = torch.randn(3, dense.node_size, dense.steps_per_TR, dense.TRs_per_window)
+
+    window_dense, hE_dense = _run(dense, X, hE, noise)
+    window_sparse, hE_sparse = _run(sparse, X, hE, noise)
+
+    for name in window_dense:
+        assert torch.allclose(window_sparse[name], window_dense[name], rtol = 1e-4, atol = 1e-4), name
+    assert torch.allclose(hE_sparse, hE_dense, rtol = 1e-4, atol = 1e-4)
+
+    # The same gradients, the dense gains being read at the SC edges
+    params_dense = dense.params_fitted['modelparameter']
+    params_sparse = sparse.params_fitted['modelparameter']
+    for param_dense, param_sparse in zip(params_dense[:-3], params_sparse[:-3]):
+        grad = param_dense.grad
+        if grad is None:
+            # (e.g. the conduction speed, which only sets the integer delays)
+            assert param_sparse.grad is None
+            continue
+        assert torch.allclose(param_sparse.grad, grad, rtol = 1e-3, atol = 1e-4 * float(grad.abs().max()) + 1e-8)
+    for name in ['w_p2e', 'w_p2i', 'w_p2p']:
+        grad = getattr(dense, name).grad[sparse.sc_dst, sparse.sc_src]
+        assert torch.allclose(getattr(sparse, name).grad, grad, rtol = 1e-3, atol = 1e-4 * float(grad.abs().max()) + 1e-8), name
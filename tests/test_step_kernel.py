@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+
+def _simulate(model, mode, X, hE, noise):
+    model.setStepKernel(mode)
+    model.invalidateCoupling()
+    external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+    with torch.no_grad():
+        next_window, hE_end = model(external, X.clone(), hE.clone(), noise)
+    return next_window, hE_end
+
+
+@pytest.mark.parametrize("mode", ["script", "compile"])
+def test_step_kernel_matches_eager(jr_model, mode):
+    if mode == "compile" and not hasattr(torch, "compile"):
+        pytest.skip("torch.compile needs PyTorch 2")
+
+    model = jr_model()
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    noise = torch.randn(3, model.node_size, model.steps_per_TR, model.TRs_per_window)
+
+    eager, hE_eager = _simulate(model, 'eager', X, hE, noise)
+    other, hE_other = _simulate(model, mode, X, hE, noise)
+    model.setStepKernel('eager')
+
+    for name in eager:
+        assert torch.allclose(other[name], eager[name], rtol = 1e-5, atol = 1e-5), name
+    assert torch.allclose(hE_other, hE_eager, rtol = 1e-5, atol = 1e-5)
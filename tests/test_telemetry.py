@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import MemorySink, ModelFitting, PrintSink, Telemetry
+
+
+def _train(model, telemetry = None):
+    data = np.random.RandomState(3).normal(0, 1, (model.output_size, 4 * model.TRs_per_window))
+    fit = ModelFitting(model, CostsJR(model), telemetry = telemetry)
+    fit.train(0, [Timeseries(data, step_size = 0.001)], num_epochs = 1, TPperWindow = model.TRs_per_window, noise_seed = 3)
+    return fit
+
+
+def test_print_sink_line():
+    line = PrintSink().format({'event': 'epoch', 'time': 0., 'epoch': 0, 'loss': 1.5})
+    assert line == 'epoch: 0, loss: 1.5'
+
+
+def test_default_output_keeps_the_fc_correlation(jr_model, capsys):
+    _train(jr_model())
+    lines = capsys.readouterr().out.splitlines()
+
+    assert len(lines) == 2
+    assert lines[0].startswith('epoch: 0, recording: 0, loss: ')
+    assert 'pseudo_FC_cor: ' in lines[0] and 'cos_sim: ' in lines[0]
+    assert lines[1].startswith('epoch: 0, loss: ')
+
+
+def test_diagnostics_only_when_asked(jr_model):
+    plain, asking = MemorySink(), MemorySink(diagnostics = ['cos_sim'])
+    _train(jr_model(), Telemetry([plain]))
+    _train(jr_model(), Telemetry([asking]))
+
+    assert 'cos_sim' not in plain.select('recording')[0]
+    assert 'cos_sim' in asking.select('recording')[0]
+    assert 'pseudo_FC_cor' not in asking.select('recording')[0]
+
+    # One record per training window, with the time of each phase
+    windows = plain.select('window')
+    assert len(windows) == 4
+    for name in Telemetry.phases:
+        assert windows[0][name + '_seconds'] >= 0
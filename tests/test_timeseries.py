@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import Timeseries
+
+
+def _windowedLoop(data, TPperWindow):
+    # The windows as copied one by one by the original windowedTensor
+    num_windows = int(data.shape[1] / TPperWindow)
+    data_out = np.zeros((num_windows, data.shape[0], TPperWindow))
+    for i_win in range(num_windows):
+        data_out[i_win, :, :] = data[:, i_win * TPperWindow:(i_win + 1) * TPperWindow]
+    return data_out
+
+
+def test_windowed_tensor_is_a_view_of_the_windows():
+    data = np.random.RandomState(0).normal(0, 1, (3, 23)).astype(np.float32)
+    ts = Timeseries(data, step_size = 0.001)
+
+    windows = ts.windowedTensor(5)
+    assert torch.is_tensor(windows)
+    assert windows.dtype == torch.float32
+    assert windows.data_ptr() == ts.data.data_ptr()
+    assert np.array_equal(windows.numpy(), _windowedLoop(data, 5))
+
+
+def test_np_windowed_keeps_the_numpy_copy():
+    data = np.random.RandomState(0).normal(0, 1, (3, 23)).astype(np.float32)
+    ts = Timeseries(data, step_size = 0.001)
+
+    windows = ts.npWindowed(5)
+    assert isinstance(windows, np.ndarray)
+    assert windows.dtype == np.float64
+    assert np.array_equal(windows, _windowedLoop(data, 5))
+
+    windows[0, 0, 0] += 1
+    assert ts.data[0, 0] == float(data[0, 0])
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import AbstractSink, Timeseries
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import ModelFitting, Telemetry
+
+NUM_EPOCHS = 2
+
+
+class _Interrupt(Exception):
+    pass
+
+
+class _InterruptSink(AbstractSink):
+    # Interrupts the training at a given window, as a crash would
+    def __init__(self, epoch, window):
+        super().__init__()
+        self.at = (epoch, window)
+
+    def write(self, record):
+        if record['event'] == 'window' and (record['epoch'], record['window']) == self.at:
+            raise _Interrupt()
+
+
+def _empRecs(model):
+    data = np.random.RandomState(3).normal(0, 1, (model.output_size, 4 * model.TRs_per_window))
+    return [Timeseries(data, step_size = 0.001)]
+
+
+def _fitting(model, sinks = []):
+    return ModelFitting(model, CostsJR(model), telemetry = Telemetry(sinks))
+
+
+def _train(fit, **kwargs):
+    fit.train(0, _empRecs(fit.model), num_epochs = NUM_EPOCHS, TPperWindow = fit.model.TRs_per_window, noise_seed = 3, **kwargs)
+
+
+def _assertSameTraining(fit, reference):
+    assert fit.trainingStats.loss == reference.trainingStats.loss
+    for group in ['modelparameter', 'hyperparameter']:
+        for param, ref_param in zip(fit.model.params_fitted[group], reference.model.params_fitted[group]):
+            assert torch.equal(param, ref_param)
+    assert set(fit.lastRec) == set(reference.lastRec)
+    for name in reference.lastRec:
+        assert np.array_equal(fit.lastRec[name].npTS(), reference.lastRec[name].npTS()), name
+
+
+@pytest.mark.parametrize("unit, interrupt", [('epoch', (1, 0)), ('window', (1, 2))])
+def test_resumed_training_matches_uninterrupted(jr_model, tmp_path, unit, interrupt):
+    reference = _fitting(jr_model())
+    _train(reference)
+
+    # The training is interrupted part way through the second epoch, having saved its state every epoch or window
+    filename = str(tmp_path / 'train_state.pt')
+    interrupted = _fitting(jr_model(), [_InterruptSink(*interrupt)])
+    with pytest.raises(_Interrupt):
+        _train(interrupted, save_state = filename, save_state_unit = unit)
+
+    # and resumed by a new process, with a new model
+    resumed = _fitting(jr_model())
+    _train(resumed, resume_from = filename)
+
+    _assertSameTraining(resumed, reference)
+    assert len(resumed.trainingStats.loss) == NUM_EPOCHS
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from whobpyt.datatypes import WarmStateCache
+from whobpyt.functions.solvers import EulerSolver, RK4Solver
+from whobpyt.optimization.custom_cost_JR import CostsJR
+from whobpyt.run import ModelFitting
+
+
+def _simulate(fit, ic_seed):
+    np.random.seed(ic_seed)
+    fit.simulate(0, 3 * fit.model.TRs_per_window, base_window_num = 4, noise_seed = 5)
+    return fit.lastRec['eeg'].data.clone()
+
+
+def test_cache_hit_reproduces_the_uncached_simulation(jr_model):
+    model = jr_model()
+    cache = WarmStateCache()
+    reference = _simulate(ModelFitting(model, CostsJR(model)), ic_seed = 1)
+
+    fit = ModelFitting(model, CostsJR(model), warm_cache = cache)
+    assert torch.equal(_simulate(fit, ic_seed = 1), reference)
+    assert len(cache.entries) == 1
+
+    # The hit restores the state after the base windows (and the noise from there), whatever the initial conditions drawn
+    assert torch.equal(_simulate(fit, ic_seed = 2), reference)
+    assert len(cache.entries) == 1
+
+
+def test_cache_misses_on_any_change(jr_model):
+    model = jr_model()
+    model.setNoise(5)
+    cache = WarmStateCache()
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    cache.store(model, 4, X, hE)
+
+    X_hit, hE_hit = cache.lookup(model, 4)
+    assert torch.equal(X_hit, X) and torch.equal(hE_hit, hE)
+    assert cache.lookup(model, 5) is None
+
+    # Parameters within the tolerance still hit, others miss
+    g = model.params.g.val
+    with torch.no_grad():
+        g.add_(1e-5)
+    assert cache.lookup(model, 4) is not None
+    with torch.no_grad():
+        g.add_(1.)
+    assert cache.lookup(model, 4) is None
+    with torch.no_grad():
+        g.sub_(1. + 1e-5)
+    assert cache.lookup(model, 4) is not None
+
+    model.setSolver(RK4Solver())
+    assert cache.lookup(model, 4) is None
+    model.setSolver(EulerSolver())
+    assert cache.lookup(model, 4) is not None
+
+    model.setNoise(6)
+    assert cache.lookup(model, 4) is None
+
+
+def test_cache_is_shared_through_its_directory(jr_model, tmp_path):
+    model = jr_model()
+    X = model.createIC(ver = 0)
+    hE = model.createDelayIC(ver = 0)
+    WarmStateCache(path = str(tmp_path)).store(model, 4, X, hE)
+
+    X_hit, hE_hit = WarmStateCache(path = str(tmp_path)).lookup(model, 4)
+    assert torch.equal(X_hit, X) and torch.equal(hE_hit, hE)
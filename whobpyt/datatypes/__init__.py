@@ -2,7 +2,14 @@ from .abstract_loss import AbstractLoss
 from .abstract_fitting import AbstractFitting
 from .abstract_measurement_model import AbstractMeasurementModel
 from .abstract_neural_model import AbstractNeuralModel
+from .abstract_solver import AbstractSolver
+from .abstract_sink import AbstractSink
 from .abstract_params import AbstractParams
 from .parameter import Parameter
+from .dtype_policy import DtypePolicy
 from .timeseries import Timeseries
-from .outputs import TrainingStats
+from .outputs import TrainingStats, ConditionResults
+from .delay_buffer import DelayBuffer
+from .noise_provider import NoiseProvider
+from .warm_state_cache import WarmStateCache
+from .timeseries_store import TimeseriesStore
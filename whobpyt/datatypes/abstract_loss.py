@@ -23,6 +23,17 @@ class AbstractLoss:
         
         pass
     
+    def castData(self, data):
+        # Casts simulated or empirical data to the dtype the objective function computes in: the compute dtype of the model's
+        # DtypePolicy if there is a model, otherwise float32 for half precision data, so that sums are always accumulated in float32 or more.
+        
+        policy = getattr(getattr(self, 'model', None), 'dtype_policy', None)
+        if policy is not None:
+            return data.to(policy.compute)
+        if data.dtype in [torch.float16, torch.bfloat16]:
+            return data.to(torch.float32)
+        return data
+    
     def prior_loss(self):
         loss_prior = []
         lb =0.001
@@ -4,6 +4,7 @@ Authors: Andrew Clappison, John Griffiths, Zheng Wang, Davide Momi, Sorenza Bast
 
 import torch
 from .parameter import Parameter as par
+from .dtype_policy import DtypePolicy
 from torch.nn.parameter import Parameter as ptParameter
 from torch.nn import Module as ptModule
 import subprocess
@@ -29,6 +30,11 @@ class AbstractNeuralModel(ptModule):
         self.state_names = ["None"] # The names of the state variables of the model
         self.output_names = ["None"] # The variable to be used as output from the NMM, for purposes such as the input to an objective function
         self.track_params = [] # Which NMM Parameters to track over training
+        self.solver = None # The numerical integration scheme (an AbstractSolver), None if the model only has its own built-in scheme
+        self.checkpoint = False # Whether forward() checkpoints its integration steps for backward (see setCheckpointing())
+        self.record = None # Which state variables and outputs forward() records, None for all of them (see setRecord())
+        self.record_every = 1 # forward() records every record_every sample points
+        self.dtype_policy = DtypePolicy() # The numerical precision of the states and computations (see setDtypePolicy())
         self.commit_hash = get_git_commit_hash()
         
         
@@ -80,6 +86,46 @@ class AbstractNeuralModel(ptModule):
 
         self.params_fitted = {'modelparameter': param_reg,'hyperparameter': param_hyper}
         
+    def setSolver(self, solver):
+        # Selects the numerical integration scheme (an AbstractSolver) used by forward().
+        # Models which support solvers call solver.step() on every integration step, with a function returning the time derivatives of their state.
+        
+        self.solver = solver
+        
+    def setDtypePolicy(self, policy):
+        # Selects the numerical precision (a DtypePolicy) of the model: the dtype of its states, delay history, outputs and noise,
+        # and the dtype of its parameters and computations. Models which support it cast their parameters and constants here.
+        
+        self.dtype_policy = policy
+        
+    def setCheckpointing(self, checkpoint):
+        # Sets whether forward() keeps only checkpoints of the simulation for backward, recomputing the integration steps in between.
+        # This trades computation for memory when fitting long windows. Models which do not support it ignore it.
+        
+        self.checkpoint = checkpoint
+        
+    def setRecord(self, record = None, every = 1):
+        # Selects which state variables and outputs forward() records (None for all of them), and every how many sample points.
+        # Models which support it only allocate and fill these, and the fitting classes only collect these.
+        # Objective functions and fitting metrics need the first output (output_names[0]) at every sample point.
+        
+        if record is not None:
+            unknown = [name for name in record if name not in self.state_names + self.output_names]
+            if unknown:
+                raise ValueError(f"Cannot record {unknown}, which are not state variables or outputs of the model.")
+        if every < 1:
+            raise ValueError(f"every should be a positive number of sample points, but got {every} instead.")
+        self.record = record
+        self.record_every = every
+        
+    def recordNames(self):
+        # The names of the state variables and outputs recorded by forward().
+        
+        record = getattr(self, 'record', None)
+        if record is None:
+            return list(set(self.state_names + self.output_names))
+        return list(record)
+        
     def createIC(self, ver):
         # Create the initial conditions for the model state variables. 
         pass
@@ -0,0 +1,24 @@
+"""
+Authors: Andrew Clappison, John Griffiths, Zheng Wang, Davide Momi, Sorenza Bastiaens, Parsa Oveisi, Kevin Kadak, Taha Morshedzadeh, Shreyas Harita
+"""
+
+class AbstractSink:
+    # This is the abstract class for the sinks of the training telemetry (see run.Telemetry), which receive the
+    # records of a fitting run (one per training window, recording, epoch, ...) and write them out.
+
+    def __init__(self, diagnostics = []):
+        self.diagnostics = diagnostics # The names of the costly diagnostics (e.g. 'FC_cor', 'cos_sim') the sink wants.
+                                       # Diagnostics are only computed when at least one sink asks for them. Use ['all'] for all of them.
+
+    def write(self, record):
+        # Writes out one record.
+
+        # record: a dict of plain (str, int, float) values, with an 'event' key giving the kind of record
+        #         ('window', 'recording', 'epoch', 'evaluate', ...).
+
+        pass
+
+    def close(self):
+        # Flushes and releases anything the sink holds (e.g. an open file).
+
+        pass
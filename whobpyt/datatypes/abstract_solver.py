@@ -0,0 +1,24 @@
+"""
+Authors: Andrew Clappison, John Griffiths, Zheng Wang, Davide Momi, Sorenza Bastiaens, Parsa Oveisi, Kevin Kadak, Taha Morshedzadeh, Shreyas Harita
+"""
+
+class AbstractSolver:
+    # This is the abstract class for the numerical integration schemes (solvers) used by the models.
+    # A model selects a solver with AbstractNeuralModel.setSolver().
+
+    def __init__(self):
+        self.name = "None" # The name of the integration scheme
+        self.order = None # The order of accuracy of the scheme (for deterministic dynamics)
+
+    def step(self, dfun, state, inputs, dt, sys2nd = None):
+        # Advances the model state by one integration step and returns the new state.
+
+        # dfun: dfun(state, inputs) returns the time derivatives of the state variables, as a tuple of tensors matching state.
+        # state: a tuple of tensors with the state variables of the model.
+        # inputs: everything else dfun needs (coupling, external input, noise), held constant over the step.
+        # dt: the integration step.
+        # sys2nd: optional description of the linear second order structure of the model, for solvers which exploit it.
+        #         sys2nd(state, inputs) returns one (rate, target) pair per second order system, where state holds the
+        #         positions x of all systems followed by their velocities v, and x'' = rate**2 * (target - x) - 2 * rate * x'.
+
+        pass
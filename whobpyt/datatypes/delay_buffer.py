@@ -0,0 +1,235 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for the delayed history of state variables
+"""
+
+import copy
+
+import torch
+
+
+class DelayBuffer:
+    '''
+    This class holds the delayed history of a state variable, such as the pyramidal current used for the delayed coupling of the JR model.
+
+    The history is addressed in logical order, slot 0 holding the current value and slot k the value k samples ago,
+    as in the (node_size x delays_max) tensors returned by createDelayIC().
+
+    Slot 0 changes on every integration step, so is held on its own and simply replaced.
+    Slots 1 to delays_max-1 only change when the buffer is shifted, and are stored in a ring with a moving head pointer,
+    so that a shift writes one column instead of copying the whole history. The ring is stored twice over, so that a
+    delayed read is a single gather at precomputed flat offsets (see gatherIndex()) shifted by the head, without any modulo.
+    Reads use advanced indexing rather than torch.gather, so the in-place writes of later shifts are safe for autograd.
+
+    Attributes
+    ------------
+    current : Tensor
+        Slot 0 of the history, of shape batch_size x num_nodes
+    ring : Tensor
+        Slots 1 to delays_max-1 of the history (stored twice), of shape batch_size x num_nodes x 2*(delays_max-1)
+    head : Int
+        Position of slot 1 in the ring
+    delays_max : Int
+        The number of slots in the history
+    batched : Bool
+        Whether the history was given with a leading batch axis
+    '''
+
+    def __init__(self, history):
+        '''
+
+        Parameters
+        -----------
+        history : Tensor of num_nodes x delays_max (or batch_size x num_nodes x delays_max)
+            The initial history in logical order (slot 0 first)
+
+        '''
+
+        self.batched = history.dim() == 3
+        if not self.batched:
+            history = history.unsqueeze(0)
+
+        self.delays_max = history.shape[-1]
+        if self.delays_max < 2:
+            raise ValueError(f"A delay history needs at least 2 slots, but got {self.delays_max}.")
+
+        self.current = history[..., 0]
+        older = history[..., 1:]
+        self.ring = torch.cat([older, older], dim = -1)
+        self.head = 0
+
+    def push(self, value):
+        '''
+        Shifts the history by one sample, so that `value` becomes slot 0 and every older slot moves back by one.
+
+        Parameters
+        -----------
+        value : Tensor of batch_size x num_nodes
+            The new current value
+
+        '''
+
+        length = self.delays_max - 1
+        self.head = (self.head - 1) % length
+        self.ring[..., self.head] = self.current
+        self.ring[..., self.head + length] = self.current
+        self.current = value
+
+    def gatherIndex(self, delays, src = None, dst = None):
+        '''
+        Precomputes the offsets used by gather() and gatherCurrent() for a given set of delays.
+
+        This only needs to be redone when the delays change, not when the buffer is shifted.
+
+        Parameters
+        -----------
+        delays : LongTensor of num_nodes x num_nodes (or batch_size x num_nodes x num_nodes)
+            The delays in samples, delays[..., i, j] being the delay of the connection from node i to node j.
+            If `src` and `dst` are given, one delay per connection instead (num_connections, or batch_size x num_connections).
+        src : LongTensor
+            Source node of each connection to gather (e.g. the non-zero SC edges). By default all node pairs are gathered.
+        dst : LongTensor
+            Target node of each connection to gather, used together with `src`
+
+        Returns
+        ---------
+        Dict
+            The offsets. gather() returns its values in the layout of 'flat': num_nodes (target) x num_nodes (source)
+            for all node pairs, or one value per connection for `src` and `dst`.
+        '''
+
+        batch_size, num_nodes, ring_len = self.ring.shape
+        device = self.ring.device
+
+        max_delay = int(delays.max())
+        if max_delay >= self.delays_max:
+            raise ValueError(f"Delays of up to {max_delay} samples need more than the {self.delays_max} samples of delay history.")
+
+        if src is None:
+            # Entry [j, i] holds the history of node i at the delay of the connection i -> j
+            d = torch.transpose(delays, -1, -2)
+            nodes = torch.arange(num_nodes, device = device)
+            src_idx = nodes.expand(num_nodes, num_nodes)
+        else:
+            d = delays
+            src_idx = src
+        d = d.expand((batch_size,) + tuple(src_idx.shape))
+
+        hist = d > 0
+        index = {}
+        index['batch'] = torch.arange(batch_size, device = device).reshape((batch_size,) + (1,) * src_idx.dim())
+        index['flat'] = src_idx * ring_len + (d - 1).clamp(min = 0)
+        index['mask'] = hist.to(self.ring.dtype)
+
+        # Zero-delay connections read slot 0, which changes every step
+        zero = torch.nonzero(~hist, as_tuple = True)
+        index['zero_b'] = zero[0]
+        if src is None:
+            index['zero_dst'] = zero[1]
+            index['zero_src'] = zero[2]
+            index['zero_pos'] = zero[1] * num_nodes + zero[2]
+        else:
+            index['zero_pos'] = zero[1]
+            index['zero_src'] = src[zero[1]]
+            index['zero_dst'] = dst[zero[1]]
+
+        return index
+
+    def gather(self, index):
+        '''
+        Reads the delayed history of every connection with a non-zero delay.
+
+        Parameters
+        -----------
+        index : Dict
+            The output of gatherIndex()
+
+        Returns
+        ---------
+        Tensor
+            The delayed values with a leading batch axis, in the layout of index['flat']. Zero-delay connections are zero (see gatherCurrent()).
+        '''
+
+        ring = self.ring.reshape(self.ring.shape[0], -1)
+        return ring[index['batch'], index['flat'] + self.head] * index['mask']
+
+    def gatherCurrent(self, index, weights, current = None):
+        '''
+        Sums the weighted current value (slot 0) over the zero-delay connections of each target node.
+
+        Parameters
+        -----------
+        index : Dict
+            The output of gatherIndex()
+        weights : Tensor of num_weights x num_zero_delay_connections
+            One or more sets of connection weights, e.g. weights[:, index['zero_pos']] of flattened weight matrices
+        current : Tensor of batch_size x num_nodes
+            The value to use for slot 0 instead of the one held by the buffer (e.g. when recomputing a checkpointed step)
+
+        Returns
+        ---------
+        Tensor of num_weights x batch_size x num_nodes
+            The summed zero-delay input into each node
+        '''
+
+        if current is None:
+            current = self.current
+        batch_size, num_nodes = current.shape
+        vals = weights * current[index['zero_b'], index['zero_src']]
+        out = vals.new_zeros(weights.shape[0], batch_size * num_nodes)
+        out = out.index_add(1, index['zero_b'] * num_nodes + index['zero_dst'], vals)
+        return out.reshape(weights.shape[0], batch_size, num_nodes)
+
+    def toTensor(self):
+        '''
+        Returns
+        ---------
+        Tensor of num_nodes x delays_max (or batch_size x num_nodes x delays_max)
+            The history in logical order (slot 0 first), in the layout it was given in
+
+        '''
+
+        length = self.delays_max - 1
+        history = torch.cat([self.current.unsqueeze(-1), self.ring[..., self.head:self.head + length]], dim = -1)
+        if not self.batched:
+            history = history.squeeze(0)
+        return history
+
+    def detach(self):
+        '''
+        Returns
+        ---------
+        DelayBuffer
+            A buffer with the same history, detached from the autograd graph
+
+        '''
+
+        out = copy.copy(self)
+        out.current = self.current.detach()
+        out.ring = self.ring.detach()
+        return out
+
+    def clone(self):
+        '''
+        Returns
+        ---------
+        DelayBuffer
+            A copy of the buffer which does not share memory with it
+
+        '''
+
+        out = copy.copy(self)
+        out.current = self.current.clone()
+        out.ring = self.ring.clone()
+        return out
+
+    def to(self, device):
+        '''
+        Moves the history between CPU and GPU
+
+        '''
+
+        self.current = self.current.to(device)
+        self.ring = self.ring.to(device)
+        return self
@@ -0,0 +1,108 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for the numerical precision (dtype) policy of the models
+"""
+
+import torch
+
+
+class DtypePolicy:
+    '''
+    This class sets the numerical precision of a model, in two parts:
+        - the state dtype, in which the states, the delay history, the recorded outputs and the noise are stored
+        - the compute dtype, in which the parameters are held and the integration steps, couplings and objective functions are computed
+
+    The default policy is float32 throughout. float64 throughout helps in stiff parameter regimes, where float32 rounding
+    can hide instabilities behind the saturation of the states. A half precision state (bfloat16 or float16) with float32 compute
+    halves the memory traffic of large parameter sweeps, while keeping every step and sum accumulated in float32.
+
+    Attributes
+    ------------
+    state : torch.dtype
+        The dtype of stored states, delay history, outputs and noise
+    compute : torch.dtype
+        The dtype of parameters and computations
+    '''
+
+    def __init__(self, state = torch.float32, compute = None):
+        '''
+
+        Parameters
+        -----------
+        state : torch.dtype
+            The dtype of stored states, delay history, outputs and noise
+        compute : torch.dtype
+            The dtype of parameters and computations. Defaults to the state dtype, or float32 for a half precision state.
+
+        '''
+
+        if not state.is_floating_point:
+            raise ValueError(f"The state dtype should be a floating point dtype, but got {state} instead.")
+        if compute is None:
+            compute = state if state in [torch.float32, torch.float64] else torch.float32
+        if compute not in [torch.float32, torch.float64]:
+            raise ValueError(f"The compute dtype should be float32 or float64, but got {compute} instead.")
+        if torch.finfo(compute).bits < torch.finfo(state).bits:
+            raise ValueError(f"The compute dtype ({compute}) should not be less precise than the state dtype ({state}).")
+
+        self.state = state
+        self.compute = compute
+
+    @classmethod
+    def single(cls):
+        '''
+        Returns
+        ---------
+        DtypePolicy
+            float32 throughout (the default)
+        '''
+
+        return cls(torch.float32)
+
+    @classmethod
+    def double(cls):
+        '''
+        Returns
+        ---------
+        DtypePolicy
+            float64 throughout
+        '''
+
+        return cls(torch.float64)
+
+    @classmethod
+    def mixed(cls, state = torch.bfloat16):
+        '''
+        Parameters
+        -----------
+        state : torch.dtype
+            The half precision dtype of the state, torch.bfloat16 or torch.float16
+
+        Returns
+        ---------
+        DtypePolicy
+            A half precision state with float32 compute
+        '''
+
+        return cls(state, torch.float32)
+
+    def toState(self, x):
+        '''
+        Casts a tensor to the state dtype.
+        '''
+
+        return x.to(self.state)
+
+    def toCompute(self, x):
+        '''
+        Casts a tensor to the compute dtype.
+        '''
+
+        return x.to(self.compute)
+
+    def __repr__(self):
+        return f"DtypePolicy(state={self.state}, compute={self.compute})"
+
+    def __eq__(self, other):
+        return isinstance(other, DtypePolicy) and self.state == other.state and self.compute == other.compute
@@ -0,0 +1,138 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for the noise driving the models
+"""
+
+import torch
+
+
+class NoiseProvider:
+    '''
+    This class generates the standard normal noise used by the integrators of the models.
+
+    Noise is drawn in blocks (typically one block per simulated window) from an explicit torch.Generator,
+    so that runs are reproducible and independent of other uses of the global random number generator.
+    Calling reset() restarts the noise sequence, so that exactly the same noise is replayed (e.g. to evaluate
+    a fitted model on the noise it was fitted with) without having to keep the noise in memory.
+
+    Attributes
+    ------------
+    seed : Int
+        The seed of the generator. If None, the global PyTorch random number generator is used instead.
+    generator : torch.Generator
+        The random number generator (None if no seed is set)
+    device : torch.device
+        Whether to generate the noise on CPU or GPU
+    dtype : torch.dtype
+        The data type of the generated noise
+    '''
+
+    def __init__(self, seed = None, device = torch.device('cpu'), dtype = torch.float32):
+        '''
+
+        Parameters
+        -----------
+        seed : Int
+            The seed of the generator. If None, the global PyTorch random number generator is used instead.
+        device : torch.device
+            Whether to generate the noise on CPU or GPU
+        dtype : torch.dtype
+            The data type of the generated noise
+
+        '''
+
+        self.seed = seed
+        self.device = device
+        self.dtype = dtype
+        self.generator = None
+        self.reset()
+
+    def reset(self, seed = None):
+        '''
+        Restarts the noise sequence, so that the same noise is generated again.
+
+        Parameters
+        -----------
+        seed : Int
+            If given, the sequence restarts from this seed instead (and it becomes the seed of the provider)
+
+        '''
+
+        if seed is not None:
+            self.seed = seed
+
+        if self.seed is None:
+            self.generator = None
+        else:
+            self.generator = torch.Generator(device = self.device)
+            self.generator.manual_seed(self.seed)
+
+    def sample(self, shape):
+        '''
+        Draws a block of noise.
+
+        Parameters
+        -----------
+        shape : Tuple
+            The shape of the block
+
+        Returns
+        ---------
+        Tensor
+            Standard normal noise of the given shape
+
+        '''
+
+        return torch.randn(shape, generator = self.generator, device = self.device, dtype = self.dtype)
+
+    def getState(self):
+        '''
+        Returns the position in the noise sequence, so that the noise from this point on can be replayed with setState().
+        Without a seed, this is the state of the global PyTorch random number generator.
+
+        '''
+
+        if self.generator is not None:
+            return self.generator.get_state()
+        if torch.device(self.device).type == 'cuda':
+            return torch.cuda.get_rng_state(self.device)
+        return torch.get_rng_state()
+
+    def setState(self, state):
+        '''
+        Moves back (or forward) to a position in the noise sequence returned by getState().
+
+        '''
+
+        if self.generator is not None:
+            self.generator.set_state(state)
+        elif torch.device(self.device).type == 'cuda':
+            torch.cuda.set_rng_state(state, self.device)
+        else:
+            torch.set_rng_state(state)
+
+    def to(self, device):
+        '''
+        Moves the generator between CPU and GPU, restarting the noise sequence.
+
+        '''
+
+        self.device = device
+        self.reset()
+        return self
+
+    def __getstate__(self):
+        # torch.Generator cannot be pickled, so its state is saved instead
+        state = self.__dict__.copy()
+        if self.generator is not None:
+            state['generator'] = self.generator.get_state()
+        return state
+
+    def __setstate__(self, state):
+        generator_state = state.pop('generator')
+        self.__dict__.update(state)
+        self.generator = None
+        if generator_state is not None:
+            self.generator = torch.Generator(device = self.device)
+            self.generator.set_state(generator_state)
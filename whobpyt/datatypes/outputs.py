@@ -9,6 +9,7 @@ import pickle
 import numpy as np  # for numerical operations
 
 import whobpyt.datatypes.parameter
+from .timeseries import Timeseries
 
 
 class TrainingStats:
@@ -170,4 +171,119 @@ class TrainingStats:
                 self.fit_params[name] = [newValues[name]]
         else:
             for name in newValues.keys():
-                self.fit_params[name].append(newValues[name])
\ No newline at end of file
+                self.fit_params[name].append(newValues[name])
+
+
+class ConditionResults:
+    '''
+    This class holds the results of a batched simulation over several conditions (stimuli, connection masks, parameter values),
+    as run by ModelFitting.simulateConditions and ModelFitting.evaluateConditions, indexed by condition.
+
+    Attributes
+    ------------
+    conditions : List
+        The label of every condition, in the order of the batch
+    data : Dict
+        For every recorded state or output, a numpy array of num_conditions x num_regions x ts_length
+    step_size : Float
+        The step size of the time points in the data
+    metrics : List of Dict
+        The fit metrics of every condition against the empirical data (None for simulations)
+    '''
+
+    def __init__(self, conditions, data, step_size, metrics = None):
+        '''
+
+        Parameters
+        -----------
+        conditions : List
+            The label of every condition, in the order of the batch
+        data : Dict
+            For every recorded state or output, a numpy array of num_conditions x num_regions x ts_length
+        step_size : Float
+            The step size of the time points in the data
+        metrics : List of Dict
+            The fit metrics of every condition against the empirical data (None for simulations)
+
+        '''
+
+        self.conditions = list(conditions)
+        self.data = data
+        self.step_size = step_size
+        self.metrics = metrics
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def index(self, condition):
+        '''
+        Parameters
+        ------------
+        condition : Any
+            The label of a condition
+
+        Returns
+        ---------
+        Int
+            The position of the condition in the batch
+        '''
+
+        return self.conditions.index(condition)
+
+    def __getitem__(self, condition):
+        '''
+        Parameters
+        ------------
+        condition : Any
+            The label of a condition
+
+        Returns
+        ---------
+        Dict
+            A Timeseries of every recorded state or output of the condition, as ModelFitting.lastRec
+        '''
+
+        idx = self.index(condition)
+        return {name: Timeseries(values[idx], step_size = self.step_size) for name, values in self.data.items()}
+
+    def stack(self, name):
+        '''
+        Parameters
+        ------------
+        name : String
+            A recorded state or output, e.g. 'eeg'
+
+        Returns
+        ---------
+        Numpy Array
+            Its time series in every condition, num_conditions x num_regions x ts_length
+        '''
+
+        return self.data[name]
+
+    def metric(self, name):
+        '''
+        Parameters
+        ------------
+        name : String
+            A fit metric, e.g. 'FC_cor' or 'cos_sim'
+
+        Returns
+        ---------
+        Numpy Array
+            Its value in every condition
+        '''
+
+        return np.array([m[name] for m in self.metrics])
+
+    def save(self, filename):
+        '''
+        Parameters
+        ------------
+        filename : String
+            The filename to use to save the ConditionResults as a pickle object.
+
+        '''
+
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f)
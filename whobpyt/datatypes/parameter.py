@@ -34,7 +34,7 @@ class Parameter:
         Whether the log of the parameter value will be stored instead of the parameter itself (will prevent parameter from being negative).
     '''
 
-    def __init__(self, val, prior_mean = None, prior_std = None, fit_par = False, asLog = False, asRand = True, lb = 0, device = torch.device('cpu')):
+    def __init__(self, val, prior_mean = None, prior_std = None, fit_par = False, asLog = False, asRand = True, lb = 0, device = torch.device('cpu'), dtype = torch.float32):
         '''
 
         Parameters
@@ -49,47 +49,64 @@ class Parameter:
             Whether the parameter value should be set to as a PyTorch Parameter
         device: torch.device
             Whether to run on CPU or GPU
+        dtype: torch.dtype
+            The dtype of the value and priors (the compute dtype of the model's DtypePolicy)
         '''
         self.fit_par = fit_par
         self.device = device
+        self.dtype = dtype
         self.asLog = asLog
         self.asRand = asRand
-        self.lb = torch.tensor(lb, dtype=torch.float32).to(self.device)
+        self.lb = torch.tensor(lb, dtype=self.dtype).to(self.device)
         self.fit_hyper = False
 
         if self.fit_par:
             if np.all(prior_mean != None) & np.all(prior_std != None):
 
-                prior_mean_ts = torch.tensor(prior_mean, dtype=torch.float32).to(self.device)
+                prior_mean_ts = torch.tensor(prior_mean, dtype=self.dtype).to(self.device)
                 self.prior_mean = prior_mean_ts
-                prior_std_ts = torch.tensor(prior_std, dtype=torch.float32).to(self.device)
+                prior_std_ts = torch.tensor(prior_std, dtype=self.dtype).to(self.device)
                 self.prior_precision = 1/prior_std_ts**2
                 if self.asRand == True:
                     if type(val) is np.ndarray:
-                        val = prior_mean + prior_std * torch.randn_like(torch.tensor(val, dtype=torch.float32)).detach().numpy()
+                        val = prior_mean + prior_std * torch.randn_like(torch.tensor(val, dtype=self.dtype)).detach().numpy()
                     else:
                         val = prior_mean + prior_std * np.random.randn(1,)
                 
                     
-                val_ts = torch.tensor(val, dtype=torch.float32).to(self.device)
+                val_ts = torch.tensor(val, dtype=self.dtype).to(self.device)
                 self.val = val_ts
                 self.fit_hyper = True
 
             else:
-                val_ts = torch.tensor(val, dtype=torch.float32).to(self.device)
+                val_ts = torch.tensor(val, dtype=self.dtype).to(self.device)
                 self.val = val_ts
         else:
-            self.val = torch.tensor(val, dtype=torch.float32).to(self.device)
+            self.val = torch.tensor(val, dtype=self.dtype).to(self.device)
 
 
 
 
-    def to(self, device):
+    def to(self, device, dtype = None):
         '''
+        Moves the value (and priors) to a device, and optionally casts them to a dtype.
+        PyTorch Parameters are changed in place, so that the references held by optimizers stay valid.
         '''
         self.device = device
-        
-        self.val = self.val.to(self.device)
+        if dtype is not None:
+            self.dtype = dtype
+
+        if dtype is None:
+            self.val = self.val.to(self.device)
+            return
+
+        self.lb = self.lb.to(self.device, self.dtype)
+        for name in ['val', 'prior_mean', 'prior_precision']:
+            tensor = getattr(self, name, None)
+            if isinstance(tensor, torch.nn.Parameter):
+                tensor.data = tensor.data.to(self.device, self.dtype)
+            elif torch.is_tensor(tensor):
+                setattr(self, name, tensor.to(self.device, self.dtype))
 
 
     def npValue(self):
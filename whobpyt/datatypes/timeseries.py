@@ -28,7 +28,7 @@ class Timeseries():
     
     '''
         
-    def __init__(self, data, step_size, modality = ""):
+    def __init__(self, data, step_size, modality = "", dtype = None):
         '''
         
         Parameters
@@ -40,12 +40,16 @@ class Timeseries():
             The step size of the time points in the data class
         modality : String
             The name of the modality of the time series
+        dtype : torch.dtype
+            The dtype to store the data in, e.g. the state dtype of a model's DtypePolicy (None to keep the dtype of the data)
         
         '''
         
         
         if not(torch.is_tensor(data)):
             data = torch.tensor(data) # Store as Tensor
+        if dtype is not None:
+            data = data.to(dtype)
         
         self.data = data
         self.step_size = step_size
@@ -63,6 +67,13 @@ class Timeseries():
         
         return self.data
     
+    def _npData(self):
+        # numpy has no bfloat16, so bfloat16 data (e.g. simulated with a mixed DtypePolicy) is converted through float32
+        data = self.data.detach().cpu()
+        if data.dtype == torch.bfloat16:
+            data = data.to(torch.float32)
+        return data.numpy()
+    
     def npTS(self):
         '''
         Returns
@@ -71,7 +82,7 @@ class Timeseries():
         
         '''
         
-        return self.data.cpu().numpy()
+        return self._npData()
         
     def npNodeByTime(self):
         '''
@@ -81,7 +92,7 @@ class Timeseries():
         
         '''
         
-        return self.data.cpu().numpy()
+        return self._npData()
         
     def npTimeByNodes(self):
         '''
@@ -91,7 +102,7 @@ class Timeseries():
         
         '''
         
-        return self.data.cpu().numpy().T
+        return self._npData().T
         
     def length(self):
         '''
@@ -123,15 +134,27 @@ class Timeseries():
         Returns
         ---------
         Tensor: num_windows x num_regions x window_length
-            The time series data in a windowed format
+            The time series data in a windowed format, in the dtype and on the device of the data. This is a view of the data 
+            (no copy is made), so should not be modified in place. (Earlier versions returned a float64 numpy copy, which npWindowed() still returns.)
         '''
         
         node_size = self.data.shape[0]
         length_ts = self.data.shape[1]
         num_windows = int(length_ts / TPperWindow)
-        data_out = np.zeros((num_windows, node_size, TPperWindow))
     
-        for i_win in range(num_windows):
-            data_out[i_win, :, :] = self.data[:, i_win * TPperWindow:(i_win + 1) * TPperWindow]
+        return self.data[:, :num_windows * TPperWindow].reshape(node_size, num_windows, TPperWindow).transpose(0, 1)
     
-        return data_out
+    def npWindowed(self, TPperWindow):
+        '''
+        Parameters
+        -----------
+        TPperWindow : Int
+            The number of time points in each window
+        
+        Returns
+        ---------
+        Numpy Array of float64: num_windows x num_regions x window_length
+            A copy of the time series data in a windowed format (see windowedTensor())
+        '''
+        
+        return self.windowedTensor(TPperWindow).detach().cpu().to(torch.float64).numpy().copy()
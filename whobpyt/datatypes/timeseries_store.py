@@ -0,0 +1,212 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for storing long simulated time series on disk in chunks
+"""
+
+import os
+import json
+
+import numpy as np
+import torch
+
+from .timeseries import Timeseries
+
+
+class TimeseriesStore:
+    '''
+    This class writes the windows of a simulation (see ModelFitting.simulateStream) to a directory, in chunks,
+    so that a simulation of any length runs in constant memory.
+
+    The windows of every recorded state or output are buffered until chunk_windows of them are there, and then written
+    as one numpy file (num_regions x chunk length). An index of the chunks is kept in 'store.json', which is rewritten
+    after every chunk, so that a store is readable while it is being written and after an interrupted simulation.
+
+    Attributes
+    ------------
+    path : String
+        Directory of the store
+    chunk_windows : Int
+        The number of windows per chunk
+    step_size : Float
+        The step size of the time points in the data
+    chunks : Dict
+        For every recorded state or output, the length of each of its written chunks
+    '''
+
+    def __init__(self, path, chunk_windows = 100, step_size = None, overwrite = False):
+        '''
+
+        Parameters
+        -----------
+        path : String
+            Directory of the store. It is created if needed.
+        chunk_windows : Int
+            The number of windows per chunk
+        step_size : Float
+            The step size of the time points in the data (set by ModelFitting.simulateStream if not given)
+        overwrite : Bool
+            Whether to discard the content of an existing store in the directory (otherwise it is opened, and appended to)
+
+        '''
+
+        self.path = path
+        self.chunk_windows = chunk_windows
+        self.step_size = step_size
+        self.chunks = {}
+        self._buffer = {}
+
+        os.makedirs(self.path, exist_ok = True)
+        if os.path.exists(self._indexFile()):
+            if overwrite:
+                self.clear()
+            else:
+                with open(self._indexFile()) as f:
+                    index = json.load(f)
+                self.chunks = index['chunks']
+                if self.step_size is None:
+                    self.step_size = index['step_size']
+
+    def _indexFile(self):
+        return os.path.join(self.path, 'store.json')
+
+    def _chunkFile(self, name, chunk_idx):
+        return os.path.join(self.path, f"{name}_{chunk_idx:06d}.npy")
+
+    def _writeIndex(self):
+        # Written to a temporary file first, so that an interrupted write never leaves a corrupt index
+        with open(self._indexFile() + '.tmp', 'w') as f:
+            json.dump({'chunks': self.chunks, 'step_size': self.step_size}, f)
+        os.replace(self._indexFile() + '.tmp', self._indexFile())
+
+    def append(self, window):
+        '''
+        Adds a window, writing a chunk when enough windows are buffered.
+
+        Parameters
+        -----------
+        window : Dict
+            For every recorded state or output, a Tensor or numpy array of num_regions x window length
+
+        '''
+
+        for name, values in window.items():
+            if torch.is_tensor(values):
+                values = values.detach().cpu()
+                if values.dtype == torch.bfloat16:
+                    # numpy has no bfloat16 (see DtypePolicy)
+                    values = values.to(torch.float32)
+                values = values.numpy()
+            self._buffer.setdefault(name, []).append(np.asarray(values))
+        if max(len(b) for b in self._buffer.values()) >= self.chunk_windows:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered windows as a (possibly shorter) chunk.
+
+        '''
+
+        written = False
+        for name, windows in self._buffer.items():
+            if not windows:
+                continue
+            chunk = np.concatenate(windows, axis = 1)
+            chunk_list = self.chunks.setdefault(name, [])
+            np.save(self._chunkFile(name, len(chunk_list)), chunk)
+            chunk_list.append(chunk.shape[1])
+            written = True
+        self._buffer = {}
+        if written:
+            self._writeIndex()
+
+    def names(self):
+        '''
+        Returns
+        ---------
+        List of String
+            The recorded states and outputs in the store
+        '''
+
+        return list(self.chunks)
+
+    def length(self, name):
+        '''
+        Parameters
+        -----------
+        name : String
+            A recorded state or output
+
+        Returns
+        ---------
+        Int
+            The number of written time points
+        '''
+
+        return int(sum(self.chunks.get(name, [])))
+
+    def read(self, name, start = 0, stop = None):
+        '''
+        Reads a segment of a written time series, loading only the chunks it overlaps.
+
+        Parameters
+        -----------
+        name : String
+            A recorded state or output
+        start : Int
+            The first time point
+        stop : Int
+            The time point after the last one (the end of the written series if None)
+
+        Returns
+        ---------
+        Numpy Array of num_regions x (stop - start)
+        '''
+
+        if stop is None:
+            stop = self.length(name)
+        parts = []
+        offset = 0
+        for chunk_idx, chunk_len in enumerate(self.chunks[name]):
+            if offset + chunk_len > start and offset < stop:
+                chunk = np.load(self._chunkFile(name, chunk_idx), mmap_mode = 'r')
+                parts.append(np.asarray(chunk[:, max(start - offset, 0):min(stop - offset, chunk_len)]))
+            offset += chunk_len
+        return np.concatenate(parts, axis = 1)
+
+    def timeseries(self, name, start = 0, stop = None):
+        '''
+        Parameters
+        -----------
+        name : String
+            A recorded state or output
+        start : Int
+            The first time point
+        stop : Int
+            The time point after the last one (the end of the written series if None)
+
+        Returns
+        ---------
+        Timeseries
+            The segment of the time series (loaded in memory)
+        '''
+
+        return Timeseries(self.read(name, start, stop), step_size = self.step_size)
+
+    def clear(self):
+        '''
+        Deletes the content of the store.
+
+        '''
+
+        chunks = dict(self.chunks)
+        if os.path.exists(self._indexFile()):
+            with open(self._indexFile()) as f:
+                chunks.update(json.load(f)['chunks'])
+            os.remove(self._indexFile())
+        for name, chunk_list in chunks.items():
+            for chunk_idx in range(len(chunk_list)):
+                if os.path.exists(self._chunkFile(name, chunk_idx)):
+                    os.remove(self._chunkFile(name, chunk_idx))
+        self.chunks = {}
+        self._buffer = {}
@@ -0,0 +1,205 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for caching the warmed-up states of the models
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .parameter import Parameter as par
+
+
+class WarmStateCache:
+    '''
+    This class caches the state of a model after its warm-up (the windows simulated to get past the initial transient),
+    so that repeated fits or simulations of the same model do not recompute it.
+
+    An entry holds the current state X and the delay history hE after warm-up, as well as the position of the noise sequence.
+    It is found again for a model with the same SC, distances and connection mask, the same noise seed, the same warm-up length,
+    time stepping, solver, dtype policy and coupling options (Laplacian, sparse backend), and parameter values equal to the cached ones within a tolerance.
+    The most recently used entries are kept in memory (least recently used ones are evicted), and optionally also
+    written to a directory, which then serves as a backing store shared between sessions.
+
+    Attributes
+    ------------
+    max_entries : Int
+        The number of entries kept in memory
+    tol : Float
+        The relative tolerance on parameter values for a cached state to be used
+    path : String
+        Directory of the on-disk store (None for memory only)
+    entries : OrderedDict
+        The in-memory entries, least recently used first
+    '''
+
+    def __init__(self, max_entries = 16, tol = 1e-6, path = None):
+        '''
+
+        Parameters
+        -----------
+        max_entries : Int
+            The number of entries kept in memory
+        tol : Float
+            The relative tolerance on parameter values for a cached state to be used
+        path : String
+            Directory of the on-disk store (None for memory only). It is created if needed.
+
+        '''
+
+        self.max_entries = max_entries
+        self.tol = tol
+        self.path = path
+        self.entries = OrderedDict()
+        self._count = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok = True)
+
+    def _paramVector(self, model):
+        # All parameter values of the model (its Parameters and fitted gains), as one float64 vector
+        vals = []
+        var_names = [a for a in dir(model.params) if (type(getattr(model.params, a)) == par)]
+        for var_name in var_names:
+            vals.append(torch.as_tensor(getattr(model.params, var_name).value()).detach().cpu().double().reshape(-1))
+        for key, value in model.state_dict().items():
+            vals.append(value.detach().cpu().double().reshape(-1))
+        return torch.cat(vals)
+
+    def _exactKey(self, model, warmup_windows):
+        # Digest of everything which must match exactly: SC, distances, connection mask, noise seed, warm-up length,
+        # time stepping, solver, dtype policy and coupling options
+        digest = hashlib.sha1()
+        if getattr(model, 'use_sparse_sc', False):
+            # The sparse backend keeps the SC as an edge list (its sc may be a scipy.sparse matrix)
+            mats = [getattr(model, name, None) for name in ['sc_src', 'sc_dst', 'sc_edges', 'dist_edges']]
+        else:
+            mats = [getattr(model, 'sc', None), getattr(model, 'dist', None)]
+        mats.append(getattr(model, 'sc_mask', None))
+        for mat in mats:
+            if mat is None:
+                digest.update(b'None')
+                continue
+            if hasattr(mat, 'toarray'):
+                mat = mat.toarray()
+            mat = mat.detach().cpu().numpy() if torch.is_tensor(mat) else np.asarray(mat)
+            digest.update(repr(mat.shape).encode())
+            digest.update(np.ascontiguousarray(mat, dtype = np.float64).tobytes())
+        solver = getattr(model, 'solver', None)
+        solver_key = None if solver is None else (type(solver).__name__, getattr(solver, 'name', None))
+        digest.update(repr((self._seed(model), int(warmup_windows), model.TRs_per_window, model.steps_per_TR, float(model.step_size),
+                            solver_key, repr(getattr(model, 'dtype_policy', None)),
+                            getattr(model, 'use_laplacian', None), getattr(model, 'use_sparse_sc', None))).encode())
+        return digest.hexdigest()
+
+    def _seed(self, model):
+        noise = getattr(model, 'noise', None)
+        return None if noise is None else noise.seed
+
+    def _matches(self, entry, params):
+        return entry['params'].shape == params.shape and \
+            bool(torch.all(torch.abs(entry['params'] - params) <= self.tol * (1 + torch.abs(params))))
+
+    def _diskFile(self, key):
+        return os.path.join(self.path, key + '.pt')
+
+    def lookup(self, model, warmup_windows):
+        '''
+        Finds the warmed-up state of a model.
+
+        Parameters
+        -----------
+        model : AbstractNeuralModel
+            The model, whose parameters, SC, distances and noise seed identify the state
+        warmup_windows : Int
+            The number of warm-up windows
+
+        Returns
+        ---------
+        Tuple of Tensors or None
+            (X, hE) after warm-up (copies, which may be modified), or None if it is not cached.
+            On a hit, the noise of a seeded model continues from where it was after warm-up.
+        '''
+
+        key = self._exactKey(model, warmup_windows)
+        params = self._paramVector(model)
+
+        found = None
+        for entry_id, entry in self.entries.items():
+            if entry['key'] == key and self._matches(entry, params):
+                found = entry_id
+                break
+
+        if found is not None:
+            self.entries.move_to_end(found)
+            entry = self.entries[found]
+        elif self.path is not None and os.path.exists(self._diskFile(key)):
+            entry = None
+            for disk_entry in torch.load(self._diskFile(key), map_location = 'cpu', weights_only = True):
+                if self._matches(disk_entry, params):
+                    entry = disk_entry
+                    self._insert(entry)
+                    break
+            if entry is None:
+                return None
+        else:
+            return None
+
+        if entry['noise_state'] is not None:
+            model.noise.setState(entry['noise_state'])
+        return entry['X'].clone(), entry['hE'].clone()
+
+    def store(self, model, warmup_windows, X, hE):
+        '''
+        Caches the warmed-up state of a model. Should be called right after warm-up, before the model is updated or its noise is used again.
+
+        Parameters
+        -----------
+        model : AbstractNeuralModel
+            The model, whose parameters, SC, distances and noise seed identify the state
+        warmup_windows : Int
+            The number of warm-up windows
+        X : Tensor
+            The current state after warm-up
+        hE : Tensor
+            The delay history after warm-up
+
+        '''
+
+        entry = {'key': self._exactKey(model, warmup_windows),
+                 'params': self._paramVector(model),
+                 'X': X.detach().cpu().clone(),
+                 'hE': hE.detach().cpu().clone(),
+                 'noise_state': model.noise.getState() if self._seed(model) is not None else None}
+
+        # A new state for the same model replaces the old one
+        for entry_id in [i for i, e in self.entries.items() if e['key'] == entry['key'] and self._matches(e, entry['params'])]:
+            del self.entries[entry_id]
+        self._insert(entry)
+
+        if self.path is not None:
+            disk_file = self._diskFile(entry['key'])
+            disk_entries = torch.load(disk_file, map_location = 'cpu', weights_only = True) if os.path.exists(disk_file) else []
+            disk_entries = [e for e in disk_entries if not self._matches(e, entry['params'])] + [entry]
+            disk_entries = disk_entries[-self.max_entries:]
+            # Written to a temporary file first, so that an interrupted write never leaves a corrupt store
+            torch.save(disk_entries, disk_file + '.tmp')
+            os.replace(disk_file + '.tmp', disk_file)
+
+    def _insert(self, entry):
+        self.entries[self._count] = entry
+        self._count += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        '''
+        Empties the in-memory entries (the on-disk store is kept).
+
+        '''
+
+        self.entries.clear()
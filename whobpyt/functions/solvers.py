@@ -0,0 +1,240 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for the numerical integration schemes (solvers) of the models
+"""
+
+import time
+
+import torch
+from ..datatypes import AbstractSolver, DtypePolicy
+
+
+class EulerSolver(AbstractSolver):
+    """
+    Forward Euler scheme. This is the default solver of the models.
+
+    Noise and external input are held constant over the step, as in the Euler-Maruyama scheme.
+    """
+    def __init__(self):
+        self.name = "Euler"
+        self.order = 1
+
+    def step(self, dfun, state, inputs, dt, sys2nd = None):
+        dstate = dfun(state, inputs)
+        return tuple(x + dt * dx for x, dx in zip(state, dstate))
+
+
+class HeunSolver(AbstractSolver):
+    """
+    Heun (improved Euler, or explicit trapezoidal) scheme.
+
+    Both stages use the same noise and input, as in the stochastic Heun scheme. Costs two evaluations of the model equations per step.
+    """
+    def __init__(self):
+        self.name = "Heun"
+        self.order = 2
+
+    def step(self, dfun, state, inputs, dt, sys2nd = None):
+        k1 = dfun(state, inputs)
+        pred = tuple(x + dt * dx for x, dx in zip(state, k1))
+        k2 = dfun(pred, inputs)
+        return tuple(x + 0.5 * dt * (dx1 + dx2) for x, dx1, dx2 in zip(state, k1, k2))
+
+
+class RK4Solver(AbstractSolver):
+    """
+    Classical fourth order Runge-Kutta scheme.
+
+    All four stages use the same noise and input. Costs four evaluations of the model equations per step.
+    """
+    def __init__(self):
+        self.name = "RK4"
+        self.order = 4
+
+    def step(self, dfun, state, inputs, dt, sys2nd = None):
+        k1 = dfun(state, inputs)
+        k2 = dfun(tuple(x + 0.5 * dt * dx for x, dx in zip(state, k1)), inputs)
+        k3 = dfun(tuple(x + 0.5 * dt * dx for x, dx in zip(state, k2)), inputs)
+        k4 = dfun(tuple(x + dt * dx for x, dx in zip(state, k3)), inputs)
+        return tuple(x + dt / 6 * (dx1 + 2 * dx2 + 2 * dx3 + dx4) for x, dx1, dx2, dx3, dx4 in zip(state, k1, k2, k3, k4))
+
+
+class ExponentialSolver(AbstractSolver):
+    """
+    Exponential Euler scheme for models made of linear second order systems driven by a nonlinear input,
+    such as the PSP kernels of the Jansen-Rit model.
+
+    The linear (critically damped) part x'' = rate**2 * (target - x) - 2 * rate * x' is solved exactly over the step,
+    with the nonlinear target held constant. This stays stable for steps well beyond the limit of forward Euler.
+    Requires the model to describe its second order structure (the sys2nd argument of step()).
+    """
+    def __init__(self):
+        self.name = "Exponential"
+        self.order = 1
+
+    def step(self, dfun, state, inputs, dt, sys2nd = None):
+        if sys2nd is None:
+            raise ValueError("ExponentialSolver needs a model with a second order structure (sys2nd).")
+
+        num_sys = len(state) // 2
+        new_x = []
+        new_v = []
+        for (rate, target), x, v in zip(sys2nd(state, inputs), state[:num_sys], state[num_sys:]):
+            y = x - target
+            c = v + rate * y
+            decay = torch.exp(-rate * dt)
+            new_x.append(target + (y + c * dt) * decay)
+            new_v.append((v - rate * c * dt) * decay)
+        return tuple(new_x + new_v)
+
+
+class _SilentNoise:
+    # Stand-in for a NoiseProvider returning zeros, so that benchmark runs are deterministic
+
+    dtype = torch.float32
+
+    def sample(self, shape):
+        return torch.zeros(shape, dtype = self.dtype)
+
+
+def benchmarkSolvers(model, solvers, step_sizes, num_windows = 1, ref_step_size = None, ref_solver = None):
+    """
+    Compares the accuracy and cost of solvers against a converged reference, and against the current Euler output of the model.
+
+    The model is run without noise and without external input, from the same initial conditions, for every solver
+    and step size. The reference is a fourth order solver at a fine step, whose solution has converged. The Euler output
+    is that of the model's forward Euler at its own step size, i.e. the output the other solvers would replace.
+    The model's solver, step size and noise are restored afterwards.
+
+    Parameters
+    ----------
+    model : AbstractNeuralModel
+        The model to benchmark, e.g. a JansenRitModel.
+    solvers : list of AbstractSolver
+        The solvers to compare.
+    step_sizes : list of float
+        The integration steps to try for every solver. model.tr should be a multiple of each.
+    num_windows : int
+        The number of windows (forward calls) to simulate.
+    ref_step_size : float
+        The integration step of the reference. Defaults to a tenth of the smallest step size.
+    ref_solver : AbstractSolver
+        The solver of the reference, RK4Solver by default. It should be one whose solution converges as the step is refined,
+        which the forward Euler step of JansenRitModel does not, as it saturates the states after every step.
+
+    Returns
+    -------
+    list of dict
+        One entry per solver and step size, with keys 'solver', 'step_size', 'seconds' (wall time), 'rmse' (root mean square 
+        error of the first model output against the reference) and 'rmse_euler' (the same against the Euler output).
+    """
+
+    saved = (model.solver, model.step_size, model.steps_per_TR, model.noise)
+    if ref_step_size is None:
+        ref_step_size = min(step_sizes) / 10
+    if ref_solver is None:
+        ref_solver = RK4Solver()
+
+    X0 = model.createIC(ver = 0)
+    hE0 = model.createDelayIC(ver = 0)
+    output_name = model.output_names[0]
+
+    def run(solver, step_size):
+        model.setSolver(solver)
+        model.step_size = torch.tensor(step_size, dtype = model.dtype_policy.compute)
+        model.steps_per_TR = int(round(model.tr / step_size))
+        external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+        X = X0.clone()
+        hE = hE0.clone()
+        outputs = []
+        start = time.perf_counter()
+        with torch.no_grad():
+            for win_idx in range(num_windows):
+                next_window, hE = model(external, X, hE)
+                X = next_window['current_state']
+                outputs.append(next_window[output_name])
+        return torch.cat(outputs, dim = -1), time.perf_counter() - start
+
+    rmse = lambda output, target: torch.sqrt(torch.mean((output - target) ** 2)).item()
+
+    try:
+        model.noise = _SilentNoise()
+        reference, _ = run(ref_solver, ref_step_size)
+        euler, _ = run(EulerSolver(), float(saved[1]))
+
+        results = []
+        for solver in solvers:
+            for step_size in step_sizes:
+                output, seconds = run(solver, step_size)
+                results.append({'solver': solver.name, 'step_size': step_size, 'seconds': seconds, 
+                                'rmse': rmse(output, reference), 'rmse_euler': rmse(output, euler)})
+    finally:
+        model.solver, model.step_size, model.steps_per_TR, model.noise = saved
+
+    return results
+
+
+def comparePrecision(model, policies, num_windows = 1):
+    """
+    Validates the numerics of dtype policies against a float64 reference.
+
+    The model is run without noise and without external input, from the same initial conditions, with its own solver
+    and step size, under every policy (see the model's setDtypePolicy). The model's dtype policy and noise are restored afterwards.
+
+    Parameters
+    ----------
+    model : AbstractNeuralModel
+        The model to validate, e.g. a JansenRitModel.
+    policies : list of DtypePolicy
+        The policies to compare, e.g. [DtypePolicy.single(), DtypePolicy.mixed()].
+    num_windows : int
+        The number of windows (forward calls) to simulate.
+
+    Returns
+    -------
+    list of dict
+        One entry per policy, with keys 'policy', 'seconds' (wall time), 'rmse' and 'max_error' (root mean square and
+        largest absolute error of the first model output against the reference), 'rel_rmse' (rmse over the standard deviation
+        of the reference) and 'finite' (whether the output stayed finite).
+    """
+
+    saved = (model.dtype_policy, model.noise)
+    output_name = model.output_names[0]
+
+    def run(policy, X0, hE0):
+        model.setDtypePolicy(policy)
+        model.noise = _SilentNoise()
+        external = torch.zeros(model.node_size, model.steps_per_TR, model.TRs_per_window)
+        X = X0.to(policy.state)
+        hE = hE0.to(policy.state)
+        outputs = []
+        start = time.perf_counter()
+        with torch.no_grad():
+            for win_idx in range(num_windows):
+                next_window, hE = model(external, X, hE)
+                X = next_window['current_state']
+                outputs.append(next_window[output_name].to(torch.float64))
+        return torch.cat(outputs, dim = -1), time.perf_counter() - start
+
+    try:
+        model.setDtypePolicy(DtypePolicy.double())
+        X0 = model.createIC(ver = 0)
+        hE0 = model.createDelayIC(ver = 0)
+        reference, _ = run(DtypePolicy.double(), X0, hE0)
+        scale = torch.std(reference).item()
+
+        results = []
+        for policy in policies:
+            output, seconds = run(policy, X0, hE0)
+            error = output - reference
+            rmse = torch.sqrt(torch.mean(error ** 2)).item()
+            results.append({'policy': repr(policy), 'seconds': seconds, 'rmse': rmse,
+                            'max_error': torch.max(torch.abs(error)).item(),
+                            'rel_rmse': rmse / scale if scale > 0 else float('nan'),
+                            'finite': bool(torch.all(torch.isfinite(output)))})
+    finally:
+        model.noise = saved[1]
+        model.setDtypePolicy(saved[0])
+
+    return results
@@ -16,21 +16,179 @@ Importage
 """
 
 # PyTorch stuff
+import torch
 from torch.nn.parameter import Parameter as ptParameter
-from torch.nn import ReLU as ptReLU
+from torch.utils.checkpoint import checkpoint as ptcheckpoint
 from torch.linalg import norm as ptnorm
-from torch import (tensor as pttensor, float32 as ptfloat32, sum as ptsum, exp as ptexp, diag as ptdiag, 
-                   transpose as pttranspose, zeros_like as ptzeros_like, int64 as ptint64, randn as ptrandn, 
-                   matmul as ptmatmul, tanh as pttanh, matmul as ptmatmul, reshape as ptreshape, sqrt as ptsqrt,
-                   ones as ptones, cat as ptcat)
+from torch import (tensor as pttensor, float32 as ptfloat32, sum as ptsum, exp as ptexp, 
+                   transpose as pttranspose, int64 as ptint64, 
+                   matmul as ptmatmul, tanh as pttanh, reshape as ptreshape, sqrt as ptsqrt,
+                   ones as ptones, cat as ptcat, is_tensor as ptis_tensor, is_grad_enabled as ptis_grad_enabled,
+                   stack as ptstack)
 
 # Numpy stuff
 from numpy.random import uniform 
-from numpy import ones,zeros
+from numpy import ones,zeros, asarray, nonzero, unique, searchsorted, concatenate, add as npadd
 
 # WhoBPyT stuff
-from ...datatypes import AbstractNeuralModel, AbstractParams, Parameter as par
+from ...datatypes import AbstractNeuralModel, AbstractParams, Parameter as par, DelayBuffer, NoiseProvider
 from ...functions.arg_type_check import method_arg_type_check
+from ...functions.solvers import EulerSolver
+
+
+
+"""
+JR integration step
+-------------------
+"""
+
+def jansen_rit_rates(P, E, I, LEd_p2e, LEd_p2i, LEd_p2p, u, P_noise, E_noise, I_noise, 
+                     g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b, u_2ndsys_ub: float, x_ub: float = 0.):
+    """
+    Computes the (bounded) total input into the second order system of each JR population. 
+
+    Parameters
+    ----------
+    P, E, I : torch.Tensor
+        Currents of the pyramidal, excitatory and inhibitory populations, of shape (batch_size, num_ROIs, 1).
+    LEd_p2e, LEd_p2i, LEd_p2p : torch.Tensor
+        Long-range (delayed) input into each population.
+    u : torch.Tensor
+        External input (e.g. TMS, sensory).
+    P_noise, E_noise, I_noise : torch.Tensor
+        Noise input into each population (already scaled by std_in).
+    g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b : torch.Tensor
+        Model parameters (see JansenRitParams).
+    u_2ndsys_ub : float
+        The bound of the input for second order system.
+    x_ub : float
+        If positive, the bound of the states read by the rates, which are then smoothly saturated as x_ub*tanh(x/x_ub).
+        This is how the solvers other than Euler saturate the states (see `JansenRitModel.setSolver`).
+
+    Returns
+    -------
+    tuple of torch.Tensor
+        rP, rE, rI, the inputs into the pyramidal, excitatory and inhibitory populations.
+    """
+
+    # Saturate the states read by the rates, as part of the model equations rather than after every step
+    if x_ub > 0:
+        P = x_ub*pttanh(P/x_ub)
+        E = x_ub*pttanh(E/x_ub)
+        I = x_ub*pttanh(I/x_ub)
+
+    # Compute the firing rate for each neural populatin 
+    # at every node using the wave-to-pulse (sigmoid) functino
+    # (vmax = max value of sigmoid, v0 = midpoint of sigmoid)
+    P_sigm = vmax / ( 1 + ptexp ( r*(v0 -  (E-I) ) ) )
+    E_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c1*P) ) ) )
+    I_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c3*P) ) ) )
+
+    # Sum the four different input types into a single input value for each neural 
+    # populatin state variable
+    # The four input types are:
+    # - Local      (L)      - from other neural populations within a node (E->P,P->I, etc.)
+    # - Long-range (L-R)    - from other nodes in the network, weighted by the long-range 
+    #                         connectivity matrices, and time-delayed
+    # - Noise      (N)      - stochastic noise input
+    # - External   (E)      - external stimulation, eg from TMS or sensory stimulus
+    #
+    #        Local    Long-range   Noise   External
+    rP =     P_sigm  + g*LEd_p2p   + P_noise + k*ki*u 
+    rE =  c2*E_sigm  + g_f*LEd_p2e + E_noise          
+    rI =  c4*I_sigm  + g_b*LEd_p2i + I_noise          
+
+    # Apply some additional scaling
+    rP = u_2ndsys_ub * pttanh(rP / u_2ndsys_ub)
+    rE = u_2ndsys_ub * pttanh(rE / u_2ndsys_ub)
+    rI = u_2ndsys_ub * pttanh(rI / u_2ndsys_ub)
+
+    return rP, rE, rI
+
+
+def jansen_rit_step(P, E, I, Pv, Ev, Iv, LEd_p2e, LEd_p2i, LEd_p2p, u, P_noise, E_noise, I_noise, 
+                    A, a, B, b, g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b, dt, u_2ndsys_ub: float):
+    """
+    Advances the JR states by one forward Euler step. 
+
+    This is a pure function of tensors, so that it can be scripted or compiled into a single fused kernel (see `stepKernel`).
+    It is the built-in implementation of `EulerSolver` for the JR model; other solvers go through `JansenRitModel.setSolver`.
+
+    Parameters
+    ----------
+    P, E, I, Pv, Ev, Iv : torch.Tensor
+        Currents and voltages of the pyramidal, excitatory and inhibitory populations, of shape (batch_size, num_ROIs, 1).
+    LEd_p2e, LEd_p2i, LEd_p2p : torch.Tensor
+        Long-range (delayed) input into each population.
+    u : torch.Tensor
+        External input (e.g. TMS, sensory).
+    P_noise, E_noise, I_noise : torch.Tensor
+        Noise input into each population (already scaled by std_in).
+    A, a, B, b, g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b : torch.Tensor
+        Model parameters (see JansenRitParams).
+    dt : torch.Tensor
+        Integration step.
+    u_2ndsys_ub : float
+        The bound of the input for second order system.
+
+    Returns
+    -------
+    tuple of torch.Tensor
+        P, E, I, Pv, Ev, Iv after the step.
+    """
+
+    rP, rE, rI = jansen_rit_rates(P, E, I, LEd_p2e, LEd_p2i, LEd_p2p, u, P_noise, E_noise, I_noise, 
+                                  g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b, u_2ndsys_ub)
+    
+    # Compute d/dt   ('_tp1' = state variable at time t+1) 
+    P_tp1 =  P + dt * Pv
+    E_tp1 =  E + dt * Ev
+    I_tp1 =  I + dt * Iv
+    Pv_tp1 = Pv + dt * ( A*a*rP  -  2*a*Pv  -  a**2 * P )
+    Ev_tp1 = Ev + dt * ( A*a*rE  -  2*a*Ev  -  a**2 * E )
+    Iv_tp1 = Iv + dt * ( B*b*rI  -  2*b*Iv  -  b**2 * I )
+
+    # Add some additional saturation on the model states
+    # (for stability and gradient calculation).
+    P_tp1 = 1000*pttanh(P_tp1/1000)
+    E_tp1 = 1000*pttanh(E_tp1/1000)
+    I_tp1 = 1000*pttanh(I_tp1/1000)
+    Pv_tp1 = 1000*pttanh(Pv_tp1/1000)
+    Ev_tp1 = 1000*pttanh(Ev_tp1/1000)
+    Iv_tp1 = 1000*pttanh(Iv_tp1/1000)
+    
+    return P_tp1, E_tp1, I_tp1, Pv_tp1, Ev_tp1, Iv_tp1
+
+
+_step_kernels = {}
+
+def stepKernel(mode='eager'):
+    """
+    Returns the function used for a single JR integration step.
+
+    Parameters
+    ----------
+    mode : str
+        'eager' for the plain Python function `jansen_rit_step`, 'script' for a TorchScript version, or 'compile' for a 
+        `torch.compile` version (PyTorch 2 or later). The latter two fuse the step's elementwise operations, removing most of the Python 
+        dispatch overhead, and give the same results as 'eager' up to floating point rounding. They are compiled once and shared by all models.
+
+    Returns
+    -------
+    function
+        The step function, with the signature of `jansen_rit_step`.
+    """
+
+    if mode == 'eager':
+        return jansen_rit_step
+    if mode not in _step_kernels:
+        if mode == 'script':
+            _step_kernels[mode] = torch.jit.script(jansen_rit_step)
+        elif mode == 'compile':
+            _step_kernels[mode] = torch.compile(jansen_rit_step)
+        else:
+            raise ValueError(f"step kernel mode should be 'eager', 'script' or 'compile', but got {mode} instead.")
+    return _step_kernels[mode]
 
 
 
@@ -152,12 +310,42 @@ class JansenRitModel(AbstractNeuralModel):
     use_fit_lfm: bool
         Flag for fitting the leadfield matrix. 1: fit, 0: not fit
 
+    use_sparse_sc: bool
+        Flag for the sparse coupling backend, in which sc, distances and gains are stored per SC edge. 1: sparse, 0: dense
+
     # FIGURE OUT: g, c1, c2, c3, c4: tensor with gradient on 
     #     model parameters to be fit
 
     std_in: tensor with gradient on
         Standard deviation for input noise
 
+    noise: NoiseProvider
+        Source of the standard normal noise driving the populations (see setNoise)
+
+    step_kernel: str
+        How the integration step is run: 'eager', 'script' or 'compile' (see setStepKernel)
+
+    solver: AbstractSolver
+        The numerical integration scheme, EulerSolver by default (see setSolver)
+
+    record: list of str
+        The state variables and outputs recorded by forward, None for all of them (see setRecord)
+
+    record_every: int
+        forward records every record_every sample points (see setRecord)
+
+    checkpoint: bool
+        Whether forward checkpoints every sample point (TR) for backward, instead of keeping every integration step (see setCheckpointing)
+
+    num_blocks: int
+        The number of simulations (blocks) run at once by the batched fitting classes (see setBlocks)
+
+    next_start_state: tensor
+        The initial state last created by createIC (or set by a fitting class), from which the batched fitting classes start
+
+    next_start_hE: tensor
+        The delay history last created by createDelayIC (or set by a fitting class), from which the batched fitting classes start
+
     params: ParamsJR
         Model parameters object.
 
@@ -190,7 +378,8 @@ class JansenRitModel(AbstractNeuralModel):
                  dist=ones((200,200)),
                  use_fit_gains=True,
                  use_laplacian=True,
-                 use_fit_lfm=False
+                 use_fit_lfm=False,
+                 use_sparse_sc=False
                  ):               
         """
         Parameters
@@ -206,7 +395,7 @@ class JansenRitModel(AbstractNeuralModel):
         tr : float # TODO: CHANGE THE NAME TO sampling_rate
             Sampling rate of the simulated EEG signals 
         sc: ndarray node_size x node_size float array
-            Structural connectivity
+            Structural connectivity (with use_sparse_sc, a scipy.sparse matrix is also accepted)
         lm: ndarray float array
             Leadfield matrix from source space to EEG space
         dist: ndarray float array
@@ -217,6 +406,9 @@ class JansenRitModel(AbstractNeuralModel):
             Flat for using laplacian. 1: yes, 0: no. 
         use_fit_lfm: bool
             Flag for fitting the leadfield matrix. 1: fit, 0: not fit
+        use_sparse_sc: bool
+            Flag for the sparse coupling backend. The delayed coupling then costs O(num_edges) instead of O(node_size^2)
+            per step, and w_p2e, w_p2i and w_p2p hold one gain per SC edge (see setSparseSC).
         params: ParamsJR
             Model parameters object.
         """
@@ -241,15 +433,26 @@ class JansenRitModel(AbstractNeuralModel):
         self.use_fit_gains = use_fit_gains  # flag for fitting gains
         self.use_laplacian = use_laplacian
         self.use_fit_lfm = use_fit_lfm
+        self.use_sparse_sc = use_sparse_sc
         self.params = params
         self.output_size = lm.shape[0]  # number of EEG channels
+        self.coupling = None  # cached output of compileCoupling()
+        self.noise = NoiseProvider()  # unseeded: uses the global PyTorch random number generator
+        self.step_kernel = 'eager'
+        self.solver = EulerSolver()
+        self.sc_mask = None  # optional per-simulation mask of the connections (see setSCMask)
+        self.num_blocks = 1  # number of simulations run at once by the batched fitting classes (see setBlocks)
+        self.next_start_state = None  # last initial state of createIC
+        self.next_start_hE = None  # last delay history of createDelayIC
         
         self.setModelParameters()
+        if self.use_sparse_sc:
+            self.setSparseSC()
         self.setModelSCParameters()
 
     
     
-    def createIC(self, ver, state_lb = -0.5, state_ub = 0.5):
+    def createIC(self, ver, state_lb = -0.5, state_ub = 0.5, batch_size = None):
         """
         Creates the initial conditions for the model.
 
@@ -257,22 +460,29 @@ class JansenRitModel(AbstractNeuralModel):
         ----------
         ver : int # TODO: ADD MORE DESCRIPTION
             Initial condition version. (in the JR model, the version is not used. It is just for consistency with other models)
+        batch_size : int
+            If given, one initial condition is drawn for each of `batch_size` independent simulations.
 
         Returns
         -------
         torch.Tensor
-            Tensor of shape (node_size, state_size) with random values between `state_lb` and `state_ub`.
+            Tensor of shape (node_size, state_size) (or (batch_size, node_size, state_size)) with random values between `state_lb` and `state_ub`,
+            in the state dtype of the model's DtypePolicy.
         """
 
         n_nodes = self.node_size
         n_states = self.state_size
-        init_conds = uniform(state_lb, state_ub, (n_nodes, n_states))
-        ptinit_conds = pttensor(init_conds, dtype=ptfloat32)
+        if batch_size is None:
+            init_conds = uniform(state_lb, state_ub, (n_nodes, n_states))
+        else:
+            init_conds = uniform(state_lb, state_ub, (batch_size, n_nodes, n_states))
+        ptinit_conds = pttensor(init_conds, dtype=self.dtype_policy.state)
+        self.next_start_state = ptinit_conds
                              
         return ptinit_conds
                             
 
-    def createDelayIC(self, ver, delays_max=500, state_lb=-0.5, state_ub=0.5):
+    def createDelayIC(self, ver, delays_max=500, state_lb=-0.5, state_ub=0.5, batch_size=None, as_buffer=False):
         """
         Creates the initial conditions for the delays.
 
@@ -281,20 +491,249 @@ class JansenRitModel(AbstractNeuralModel):
         ver : int
             Initial condition version. 
             (in the JR model, the version is not used. It is just for consistency with other models)
+        batch_size : int
+            If given, one delay history is drawn for each of `batch_size` independent simulations.
+        as_buffer : bool
+            Whether to return the history as a DelayBuffer, which `forward` then updates and returns directly.
 
         Returns
         -------
-        torch.Tensor
-            Tensor of shape (node_size, delays_max) with random values between `state_lb` and `state_ub`.
+        torch.Tensor or DelayBuffer
+            Tensor of shape (node_size, delays_max) (or (batch_size, node_size, delays_max)) with random values between `state_lb` and `state_ub`,
+            in the state dtype of the model's DtypePolicy.
         """
 
         n_nodes = self.node_size
-        init_delays = uniform(state_lb, state_ub, (n_nodes, delays_max))
-        ptinit_delays = pttensor(init_delays, dtype=ptfloat32)
-  
+        if batch_size is None:
+            init_delays = uniform(state_lb, state_ub, (n_nodes, delays_max))
+        else:
+            init_delays = uniform(state_lb, state_ub, (batch_size, n_nodes, delays_max))
+        ptinit_delays = pttensor(init_delays, dtype=self.dtype_policy.state)
+        self.next_start_hE = ptinit_delays
+
+        if as_buffer:
+            return DelayBuffer(ptinit_delays)
         return ptinit_delays
 
 
+    def setSparseSC(self):
+        """
+        Builds the edge list of the sparse coupling backend from `sc`.
+
+        The pyramidal to pyramidal gains are symmetrised, so the edge list holds both directions of every 
+        connection (an edge absent from `sc` has an SC value of zero). Sets `sc_dst`, `sc_src` (target and source 
+        node of every edge), `sc_rev` (position of the reversed edge), `sc_edges` (SC value) and `dist_edges` (distance).
+        """
+
+        n_nodes = self.node_size
+        if hasattr(self.sc, 'tocoo'):
+            coo = self.sc.tocoo()
+            rows, cols, vals = coo.row, coo.col, coo.data
+        else:
+            sc = self.sc.detach().cpu().numpy() if ptis_tensor(self.sc) else asarray(self.sc)
+            rows, cols = nonzero(sc)
+            vals = sc[rows, cols]
+
+        # Edges are keyed (and sorted) by target * node_size + source
+        rows = asarray(rows, dtype='int64')
+        cols = asarray(cols, dtype='int64')
+        keys = rows * n_nodes + cols
+        edge_keys = unique(concatenate([keys, cols * n_nodes + rows]))
+        dst = edge_keys // n_nodes
+        src = edge_keys % n_nodes
+        sc_edges = zeros(len(edge_keys))
+        npadd.at(sc_edges, searchsorted(edge_keys, keys), vals)
+
+        self.sc_dst = pttensor(dst, dtype=ptint64)
+        self.sc_src = pttensor(src, dtype=ptint64)
+        self.sc_rev = pttensor(searchsorted(edge_keys, src * n_nodes + dst), dtype=ptint64)
+        self.sc_edges = pttensor(sc_edges, dtype=ptfloat32)
+        self.dist_edges = self.dist[self.sc_src, self.sc_dst]
+
+
+    def setNoise(self, seed=None):
+        """
+        Sets the source of the noise driving the populations.
+
+        Parameters
+        ----------
+        seed : int
+            Seed of the noise generator. If None, the global PyTorch random number generator is used.
+            With a seed, `noise.reset()` replays exactly the same noise (e.g. for `ModelFitting.evaluate`).
+        """
+
+        self.noise = NoiseProvider(seed, dtype=self.dtype_policy.state)
+
+
+    @property
+    def sim_len(self):
+        """
+        The number of sample points (TRs) simulated by one `forward` call without explicit noise, i.e. `TRs_per_window`.
+        """
+        return self.TRs_per_window
+
+
+    def setBlocks(self, num_blocks):
+        """
+        Sets the number of simulations (blocks) the batched fitting classes run at once, in one batched `forward` call.
+
+        Parameters
+        ----------
+        num_blocks : int
+            The number of blocks, i.e. the `batch_size` of `createIC`, `createDelayIC` and `genNoise`.
+        """
+
+        if num_blocks < 1:
+            raise ValueError(f"num_blocks should be a positive number of simulations, but got {num_blocks} instead.")
+        self.num_blocks = num_blocks
+
+
+    def genNoise(self, block_len, batched=False):
+        """
+        Draws the noise of a simulation split into blocks, both as one serial simulation and as a batch of blocks
+        holding the same values, so that a serial `forward` and a batched `forward` of the blocks (from the serial
+        states at the block boundaries) integrate exactly the same realisation.
+
+        Parameters
+        ----------
+        block_len : int
+            The number of sample points (TRs) of each block.
+        batched : bool
+            If False, one simulation of `sim_len` sample points is split into `sim_len // block_len` blocks.
+            If True, `num_blocks` (see `setBlocks`) independent blocks are drawn, which laid end to end form the serial noise.
+
+        Returns
+        -------
+        list of torch.Tensor
+            [serialNoise, blockNoise]: the serial noise, of shape (3, 1, num_ROIs, steps_per_TR, num * block_len), and the
+            block noise, of shape (3, num, num_ROIs, steps_per_TR, block_len), where num is the number of blocks.
+            Both can be passed as `noise` to `forward`.
+        """
+
+        num = self.num_blocks if batched else self.sim_len // block_len
+        if num < 1:
+            raise ValueError(f"block_len ({block_len}) should not be longer than sim_len ({self.sim_len}).")
+        blockNoise = self.noise.sample((3, num, self.node_size, self.steps_per_TR, block_len))
+        serialNoise = blockNoise.permute(0, 2, 3, 1, 4).reshape(3, 1, self.node_size, self.steps_per_TR, num * block_len)
+        return [serialNoise, blockNoise]
+
+
+    def setStepKernel(self, mode='eager'):
+        """
+        Sets how the integration step is run (see `stepKernel`).
+
+        Parameters
+        ----------
+        mode : str
+            'eager' (default), 'script' (TorchScript) or 'compile' (torch.compile). The step is compiled here, 
+            so that the compilation cost is not part of the first `forward` call.
+        """
+
+        stepKernel(mode)
+        self.step_kernel = mode
+
+
+    def setSolver(self, solver):
+        """
+        Sets the numerical integration scheme.
+
+        With `EulerSolver` (the default) each step runs the fused `jansen_rit_step` (see `setStepKernel`).
+        Any other solver advances the six states through `solver.step`, with the delayed coupling, external input and noise 
+        held constant over the step. The built-in step saturates the states after every step, which makes the integrated system depend
+        on the number of steps; the other solvers instead saturate the states read by the rates (the `x_ub` of `jansen_rit_rates`), 
+        so that they converge as the step is refined. Higher order solvers (e.g. `HeunSolver`, `RK4Solver`) or `ExponentialSolver`, 
+        which solves the linear second order (PSP) part of each population exactly, are then more accurate than Euler at the same 
+        integration step, which is set by `step_size` at construction. `functions.solvers.benchmarkSolvers` measures by how much,
+        against a converged reference and against the Euler output.
+
+        Parameters
+        ----------
+        solver : AbstractSolver
+            The solver, e.g. from `whobpyt.functions.solvers`.
+        """
+
+        self.solver = solver
+
+
+    def setCheckpointing(self, checkpoint=True):
+        """
+        Sets gradient checkpointing across the integration steps.
+
+        When on (and gradients are being recorded), `forward` keeps only the states and delayed inputs at the start of every sample point (TR) 
+        for backward, and recomputes its `steps_per_TR` integration steps during backward. The memory held by the graph of a window then no longer
+        grows with `steps_per_TR`, at the cost of running each step twice. Gradients are unchanged, as the noise is drawn once per window.
+
+        Parameters
+        ----------
+        checkpoint : bool
+            Whether to checkpoint.
+        """
+
+        self.checkpoint = checkpoint
+
+
+    def setDtypePolicy(self, policy):
+        """
+        Sets the numerical precision of the model.
+
+        The parameters, the gains, the step size, the distances and the structural connectivity are cast to the compute dtype
+        of the policy, in which `forward` integrates and couples the populations. The states returned by `forward`, its recorded
+        outputs, the delay history of `createDelayIC` and the noise are in the state dtype. With a half precision state
+        (`DtypePolicy.mixed()`) every step is thus still computed, and every sum accumulated, in float32, while the memory
+        held by the states and outputs is halved. `functions.solvers.comparePrecision` compares policies against float64.
+
+        Fitted parameters are cast in place, so that an existing optimizer keeps working on them.
+        Initial conditions created before the change keep their dtype, and are cast by `forward`.
+
+        Parameters
+        ----------
+        policy : DtypePolicy
+            The policy, e.g. `DtypePolicy.double()` or `DtypePolicy.mixed()`.
+        """
+
+        self.dtype_policy = policy
+        dtype = policy.compute
+
+        var_names = [a for a in dir(self.params) if type(getattr(self.params, a)) == par]
+        for var_name in var_names:
+            var = getattr(self.params, var_name)
+            var.to(var.device, dtype)
+
+        for name in ['w_p2e', 'w_p2i', 'w_p2p']:
+            w = getattr(self, name)
+            if isinstance(w, ptParameter):
+                w.data = w.data.to(dtype)
+            elif ptis_tensor(w):
+                setattr(self, name, w.to(dtype))
+
+        self.step_size = self.step_size.to(dtype)
+        self.dist = self.dist.to(dtype)
+        if self.use_sparse_sc:
+            self.sc_edges = self.sc_edges.to(dtype)
+            self.dist_edges = self.dist_edges.to(dtype)
+        self.noise.dtype = policy.state
+        self.invalidateCoupling()
+
+
+    def setSCMask(self, mask=None):
+        """
+        Sets a mask on the structural connections, e.g. for virtual lesions or dissections of the fitted network.
+
+        The mask multiplies the normalised connectivity terms of `compileCoupling` (all three of p2e, p2i and p2p), 
+        without renormalising them, so that a lesioned connection is removed from an otherwise unchanged fitted network.
+        The Laplacian (self-connection) terms are recomputed from the masked connectivity.
+        With a leading batch axis, each of the `batch_size` simulations of a batched `forward` gets its own mask.
+
+        Parameters
+        ----------
+        mask : torch.Tensor
+            Tensor of shape (node_size, node_size) or (batch_size, node_size, node_size), or with use_sparse_sc one value
+            per edge of `setSparseSC` (num_edges, or (batch_size, num_edges)). None removes the mask.
+        """
+
+        self.sc_mask = mask
+
+
     def setModelSCParameters(self, small_constant=0.05):
         """
         Sets the parameters of the model.
@@ -302,7 +741,10 @@ class JansenRitModel(AbstractNeuralModel):
         
         # Create the arrays in numpy
         n_nodes = self.node_size
-        zsmat = zeros((self.node_size, self.node_size)) + small_constant 
+        if self.use_sparse_sc:
+            zsmat = zeros(self.sc_edges.shape[0]) + small_constant 
+        else:
+            zsmat = zeros((self.node_size, self.node_size)) + small_constant 
         w_p2e = zsmat.copy() # the pyramidal to excitatory interneuron cross-layer gains
         w_p2i = zsmat.copy() # the pyramidal to inhibitory interneuron cross-layer gains
         w_p2p = zsmat.copy() # the pyramidal to pyramidal cells same-layer gains
@@ -310,9 +752,9 @@ class JansenRitModel(AbstractNeuralModel):
         # Set w_p2i, w_p2e, and w_p2p as attributes as type Parameter if use_fit_gains is True
         if self.use_fit_gains:
             
-            w_p2e = ptParameter(pttensor(w_p2e, dtype=ptfloat32))
-            w_p2i = ptParameter(pttensor(w_p2i, dtype=ptfloat32))
-            w_p2p = ptParameter(pttensor(w_p2p, dtype=ptfloat32))
+            w_p2e = ptParameter(pttensor(w_p2e, dtype=self.dtype_policy.compute))
+            w_p2i = ptParameter(pttensor(w_p2i, dtype=self.dtype_policy.compute))
+            w_p2p = ptParameter(pttensor(w_p2p, dtype=self.dtype_policy.compute))
             mps = self.params_fitted['modelparameter']
             mps.append(w_p2e); mps.append(w_p2i); mps.append(w_p2p)
 
@@ -323,247 +765,395 @@ class JansenRitModel(AbstractNeuralModel):
         
 
 
-    def forward(self, external, hx, hE):
+    def compileCoupling(self):
+        """
+        Compiles the parameter-dependent coupling terms used by `forward`: the normalised connectivity 
+        matrices `sc_p2e`, `sc_p2i` and `sc_p2p`, their Laplacian (self-connection) terms and the projected 
+        leadfield `lm_t`.
+
+        The result is cached and only recomputed when `w_p2e`, `w_p2i`, `w_p2p`, the leadfield or `sc` change 
+        (either reassigned or updated in place, e.g. by an optimizer step), or when autograd is switched on or off.
+        Call `invalidateCoupling` after modifying a numpy `sc` in place.
+
+        Returns
+        -------
+        dict
+            The coupling terms, keyed by 'sc_p2e', 'sc_p2i', 'sc_p2p', 'lap_p2e', 'lap_p2i', 'lap_p2p' and 'lm_t'.
+            With use_sparse_sc, the connectivity terms hold one value per edge of `setSparseSC`.
+        """
+
+        sc = self.sc_edges if self.use_sparse_sc else self.sc
+        sources = (self.w_p2e, self.w_p2i, self.w_p2p, self.params.lm.val, sc)
+        versions = tuple(getattr(src, '_version', None) for src in sources) + (ptis_grad_enabled(),)
+
+        coupling = getattr(self, 'coupling', None)
+        if coupling is not None:
+            cached_sources, cached_versions = self.coupling_key
+            if all(a is b for a, b in zip(sources, cached_sources)) and versions == cached_versions:
+                return coupling
+
+        n_chans = self.output_size
+        n_nodes = self.node_size
+        dtype = self.dtype_policy.compute
+        ptsc = sc.to(dtype) if ptis_tensor(sc) else pttensor(sc, dtype=dtype)
+        w_p2e, w_p2i, w_p2p = [w.to(dtype) if ptis_tensor(w) else pttensor(w, dtype=dtype) for w in sources[:3]]
+
+        # Update the pyramidal to excitatory, pyramidal to inhibitory, and pyramidal to pyramidal connectivity matrices based on the gains w_xx
+        w_b = ptexp(w_p2i) * ptsc
+        w_n_b = w_b / ptnorm(w_b)
+
+        w_f = ptexp(w_p2e) * ptsc
+        w_n_f = w_f / ptnorm(w_f)
+
+        w_l = ptexp(w_p2p) * ptsc
+        if self.use_sparse_sc:
+            w_l_sym = 0.5 * (w_l + w_l[self.sc_rev])
+        else:
+            w_l_sym = 0.5 * (w_l + pttranspose(w_l, 0, 1))
+        w_n_l = w_l_sym / ptnorm(w_l_sym)
+
+        coupling = {'sc_p2e': w_n_f, 'sc_p2i': w_n_b, 'sc_p2p': w_n_l}
+
+        # Laplacian terms, kept as (node_size x 1) columns as they act as diagonal matrices
+        if self.use_sparse_sc:
+            row_sum = lambda w: w.new_zeros(n_nodes).index_add(0, self.sc_dst, w)
+        else:
+            row_sum = lambda w: ptsum(w, dim=1)
+        coupling['lap_p2e'] = -row_sum(w_n_f).reshape(-1, 1)
+        coupling['lap_p2i'] = -row_sum(w_n_b).reshape(-1, 1)
+        coupling['lap_p2p'] = -row_sum(w_n_l).reshape(-1, 1)
+
+        # Lead field matrix, row normalised and centred across channels
+        lm = self.params.lm.value()
+        onesmat = lm.new_ones(1,n_chans)
+        lm_t = (lm.T / ptsqrt((lm ** 2).sum(1))).T
+        coupling['lm_t'] = (lm_t - 1 / n_chans * ptmatmul(onesmat, lm_t))
+
+        self.sc_p2e = w_n_f
+        self.sc_p2i = w_n_b
+        self.sc_p2p = w_n_l
+        self.lm_t = coupling['lm_t']
+
+        self.coupling = coupling
+        self.coupling_key = (sources, versions)
+        return coupling
+
+
+    def invalidateCoupling(self):
+        """
+        Discards the cached output of `compileCoupling`, so that it is recomputed on the next `forward` call.
+        """
+        self.coupling = None
+
+
+    def batchParamValue(self, val, batch_size):
+        """
+        Reshapes a parameter value so that it broadcasts against the batched model states.
+
+        Parameters
+        ----------
+        val : torch.Tensor
+            The parameter value, as returned by `Parameter.value()`.
+        batch_size : int
+            Number of independent simulations integrated by `forward`.
+
+        Returns
+        -------
+        torch.Tensor
+            `val` reshaped to (batch_size, 1, 1) (or (batch_size, node_size, 1)) if it carries a leading
+            axis of length `batch_size`, otherwise `val` unchanged so that it is shared across the batch.
+        """
+
+        if batch_size > 1 and val.dim() > 0 and val.shape[0] == batch_size:
+            return val.reshape(batch_size, -1, 1)
+        return val
+
+
+    def forward(self, external, hx, hE, noise=None):
         """
-        This function carries out the forward Euler integration method for the JR neural mass model,
+        This function carries out the forward Euler integration method (or the solver set with `setSolver`) for the JR neural mass model,
         with time delays, connection gains, and external inputs considered. Each population (pyramidal,
         excitatory, inhibitory) in the network is modeled as a nonlinear second order system. The function
         updates the state of each neural population and computes the EEG signals at each time step.
 
+        If `hx` and `hE` carry a leading batch axis, `batch_size` independent simulations are integrated at once
+        with shared SC, distance and leadfield. Any parameter whose value has a leading axis of length
+        `batch_size` then gives one value per simulation (see `batchParamValue`); all other parameters are shared.
+
         Parameters
         ----------
         external : torch.Tensor
-            Input tensor of shape (batch_size, num_ROIs) representing the input to the model.
+            Input tensor of shape (num_ROIs, steps_per_TR, TRs_per_window), or (batch_size, num_ROIs, steps_per_TR, TRs_per_window), 
+            representing the input to the model.
         hx : Optional[torch.Tensor]
-            Optional tensor of shape (batch_size, state_size, num_ROIs) representing the initial hidden state.
-        hE : Optional[torch.Tensor]
-            Optional tensor of shape (batch_size, num_ROIs, delays_max) representing the initial delays.
+            Optional tensor of shape (num_ROIs, state_size), or (batch_size, num_ROIs, state_size), representing the initial hidden state.
+        hE : Optional[torch.Tensor or DelayBuffer]
+            Optional tensor of shape (num_ROIs, delays_max), or (batch_size, num_ROIs, delays_max), representing the initial delays.
+            A DelayBuffer (see `createDelayIC`) is updated in place and returned as is, saving the conversion to and from a tensor.
+        noise : Optional[torch.Tensor]
+            Optional tensor of shape (3, num_ROIs, steps_per_TR, TRs_per_window), or (3, batch_size, num_ROIs, steps_per_TR, TRs_per_window),
+            of standard normal noise for the P, E and I populations. If not given, it is drawn from `self.noise` in one call.
+            Its last axis sets the number of sample points simulated, so that e.g. the blocks of `genNoise` may be shorter or longer than
+            TRs_per_window (`external` should then cover as many sample points).
 
         Returns
         -------
         next_state : dict
             Dictionary containing the updated current state, EEG signals, and the history of
-            each population's current and voltage at each time step.
+            each population's current and voltage at each time step. In batched mode every entry has a leading batch axis.
+            Only the EEG signals and histories selected with `setRecord` are included, at every `record_every` time steps.
 
-        hE : torch.Tensor
-            Tensor representing the updated history of the pyramidal population's current.
+        hE : torch.Tensor or DelayBuffer
+            Tensor (or DelayBuffer, if one was given) representing the updated history of the pyramidal population's current.
         """
 
-        # Generate the ReLU module
-        m = ptReLU()
-        
+        # The states are integrated in the compute dtype, and returned and recorded in the state dtype (see setDtypePolicy)
+        compute_dtype = self.dtype_policy.compute
+        state_dtype = self.dtype_policy.state
+        hx = hx.to(compute_dtype)
+        external = external.to(compute_dtype)
+
         # Define some constants
-        con_1 = pttensor(1.0, dtype=ptfloat32) # Define constant 1 tensor
-       
-        u_2ndsys_ub = 500  # the bound of the input for second order system
+        u_2ndsys_ub = 500.  # the bound of the input for second order system
+        x_ub = 1000.  # the bound of the states read by the rates, for solvers other than Euler
+
+        # The (optionally scripted or compiled) function for a single forward Euler step, or another solver
+        step_kernel = stepKernel(getattr(self, 'step_kernel', 'eager'))
+        solver = getattr(self, 'solver', None)
+        if isinstance(solver, EulerSolver):
+            solver = None
+
+        # Work with a leading batch axis throughout; unbatched inputs are a batch of one
+        batched = hx.dim() == 3
+        if not batched:
+            hx = hx.unsqueeze(0)
+        batch_size = hx.shape[0]
+        bp = lambda val: self.batchParamValue(val, batch_size)
 
         # Defining NMM Parameters to simplify later equations
         #TODO: Change code so that params returns actual value used without extras below
-        A = self.params.A.value()
-        a = self.params.a.value()
-        B = self.params.B.value()
-        b = self.params.b.value()
-        g = self.params.g.value()
-        c1 = self.params.c1.value()
-        c2 = self.params.c2.value()
-        c3 = self.params.c3.value()
-        c4 = self.params.c4.value()
-        std_in = self.params.std_in.value() #around 20
-        vmax = self.params.vmax.value()
-        v0 = self.params.v0.value()
-        r = self.params.r.value()
-        y0 = self.params.y0.value()
-        mu = self.params.mu.value()
-        k =  self.params.k.value()
-        cy0 = self.params.cy0.value()
-        ki = self.params.ki.value()
-
-        g_f = self.params.g_f.value()
-        g_b = self.params.g_b.value()
-        lm = self.params.lm.value()
+        A = bp(self.params.A.value())
+        a = bp(self.params.a.value())
+        B = bp(self.params.B.value())
+        b = bp(self.params.b.value())
+        g = bp(self.params.g.value())
+        c1 = bp(self.params.c1.value())
+        c2 = bp(self.params.c2.value())
+        c3 = bp(self.params.c3.value())
+        c4 = bp(self.params.c4.value())
+        std_in = bp(self.params.std_in.value()) #around 20
+        vmax = bp(self.params.vmax.value())
+        v0 = bp(self.params.v0.value())
+        r = bp(self.params.r.value())
+        y0 = bp(self.params.y0.value())
+        mu = bp(self.params.mu.value())
+        k =  bp(self.params.k.value())
+        cy0 = bp(self.params.cy0.value())
+        ki = bp(self.params.ki.value())
+
+        g_f = bp(self.params.g_f.value())
+        g_b = bp(self.params.g_b.value())
 
         next_state = {}
 
-        P = hx[:, 0:1]  # current of pyramidal population
-        E = hx[:, 1:2]  # current of excitory population
-        I = hx[:, 2:3]  # current of inhibitory population
+        P = hx[..., 0:1]  # current of pyramidal population
+        E = hx[..., 1:2]  # current of excitory population
+        I = hx[..., 2:3]  # current of inhibitory population
 
-        Pv = hx[:, 3:4]  # voltage of pyramidal population
-        Ev = hx[:, 4:5]  # voltage of exictory population
-        Iv = hx[:, 5:6]  # voltage of inhibitory population
+        Pv = hx[..., 3:4]  # voltage of pyramidal population
+        Ev = hx[..., 4:5]  # voltage of exictory population
+        Iv = hx[..., 5:6]  # voltage of inhibitory population
         
         dt = self.step_size
 
+        # Model equations for solvers other than the built-in Euler step: state is (P, E, I, Pv, Ev, Iv), 
+        # and inputs (LEd_p2e, LEd_p2i, LEd_p2p, u, P_noise, E_noise, I_noise) are held constant over a step
+        def dfun(state, inputs):
+            P, E, I, Pv, Ev, Iv = state
+            rP, rE, rI = jansen_rit_rates(P, E, I, *inputs, g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b, u_2ndsys_ub, x_ub)
+            return (Pv, Ev, Iv, 
+                    A*a*rP  -  2*a*Pv  -  a**2 * P,
+                    A*a*rE  -  2*a*Ev  -  a**2 * E,
+                    B*b*rI  -  2*b*Iv  -  b**2 * I)
+
+        # Each population is a critically damped second order system x'' = rate**2 * (target - x) - 2 * rate * x'
+        def sys2nd(state, inputs):
+            P, E, I, Pv, Ev, Iv = state
+            rP, rE, rI = jansen_rit_rates(P, E, I, *inputs, g, c1, c2, c3, c4, vmax, v0, r, k, ki, g_f, g_b, u_2ndsys_ub, x_ub)
+            return ((a, A*rP/a), (a, A*rE/a), (b, B*rI/b))
+
         n_nodes = self.node_size
         n_chans = self.output_size
 
-        sc = self.sc
-        ptsc = pttensor(sc, dtype=ptfloat32)
-
-        if self.use_fit_gains:
-
-            # Update the pyramidal to excitatory, pyramidal to inhibitory, and pyramidal to pyramidal connectivity matrices based on the gains w_xx
-            
-            w_b = ptexp(self.w_p2i) * ptsc
-            w_n_b = w_b / ptnorm(w_b)
-            self.sc_p2i = w_n_b
-
-            w_f = ptexp(self.w_p2e) * ptsc     
-            w_n_f = w_f / ptnorm(w_f)
-            self.sc_p2e = w_n_f
-
-            w_l = ptexp(self.w_p2p) * ptsc         
-            w_n_l = (0.5 * (w_l + pttranspose(w_l, 0, 1))) / ptnorm(   0.5 * (w_l + pttranspose(w_l, 0, 1)))
-            self.sc_p2p = w_n_l
-
-
-        if self.use_laplacian:
-            dg_b = -ptdiag(ptsum(w_n_b, dim=1))
-            dg_l = -ptdiag(ptsum(w_n_l, dim=1))
-            dg_f = -ptdiag(ptsum(w_n_f, dim=1))
-
-
-        self.delays = (self.dist / mu).type(ptint64)
-
-        # Placeholder for the updated current state
-        current_state = ptzeros_like(hx)
-
-        # Initializing lists for the history of the M/EEG signals, as well as each population's current and voltage.
-        E_window   = [];     I_window  = [];  P_window = [];
-        Ev_window  = [];     Iv_window = []; Pv_window = [];
-        eeg_window = []; states_window = [];
-
-        # Use the model to get M/EEG signal at the i-th element in the window.
-
-        # Run through the number of specified sample points for this window 
-        for i_window in range(self.TRs_per_window):
-            
-
-            # For each sample point, run the model by solving the differential 
-            # equations for a defined number of integration steps, 
-            # and keep only the final activity state within this set of steps 
+        # Connectivity, Laplacian and leadfield terms only depend on the parameters, so are compiled once
+        coupling = self.compileCoupling()
+        w_n_f = coupling['sc_p2e']
+        w_n_b = coupling['sc_p2i']
+        w_n_l = coupling['sc_p2p']
+        lap_f = coupling['lap_p2e']
+        lap_b = coupling['lap_p2i']
+        lap_l = coupling['lap_p2p']
+        lm_t = coupling['lm_t']
+
+        # Optional mask of the connections (see setSCMask), possibly with one mask per simulation
+        sc_mask = getattr(self, 'sc_mask', None)
+        if sc_mask is not None:
+            sc_mask = sc_mask.to(w_n_f.dtype)
+            w_n_f = w_n_f * sc_mask
+            w_n_b = w_n_b * sc_mask
+            w_n_l = w_n_l * sc_mask
+            if self.use_sparse_sc:
+                row_sum = lambda w: w.new_zeros(w.shape[:-1] + (n_nodes,)).index_add(w.dim() - 1, self.sc_dst, w)
+            else:
+                row_sum = lambda w: ptsum(w, dim=-1)
+            lap_f = -row_sum(w_n_f).unsqueeze(-1)
+            lap_b = -row_sum(w_n_b).unsqueeze(-1)
+            lap_l = -row_sum(w_n_l).unsqueeze(-1)
+        batched_sc = w_n_f.dim() == (2 if self.use_sparse_sc else 3)
+
+        # The history of the pyramidal population is held in a ring buffer; the offsets of 
+        # the delayed connections into it only depend on the delays, so are computed once
+        buffer = hE if isinstance(hE, DelayBuffer) else DelayBuffer(hE)
+        if self.use_sparse_sc:
+            self.delays = (self.dist_edges / mu.reshape(-1, 1)).type(ptint64)
+            delay_index = buffer.gatherIndex(self.delays, self.sc_src, self.sc_dst)
+        else:
+            self.delays = (self.dist / mu).type(ptint64)
+            delay_index = buffer.gatherIndex(self.delays)
+
+        # Weights of the zero-delay connections, which read the current pyramidal state at every step
+        w_stack = ptstack([w_n_f, -w_n_b, w_n_l])
+        if batched_sc:
+            w_zero = w_stack.reshape(3, batch_size, -1)[:, delay_index['zero_b'], delay_index['zero_pos']]
+        else:
+            w_zero = w_stack.reshape(3, -1)[:, delay_index['zero_pos']]
+
+        # Standard normal noise for the P, E and I populations, for the whole window at once
+        if noise is None:
+            noise = self.noise.sample((3, batch_size, n_nodes, self.steps_per_TR, self.TRs_per_window))
+        elif noise.dim() == 4:
+            noise = noise.unsqueeze(1)
+        num_TRs = noise.shape[-1]
+
+        # The integration steps of one sample point, given the delayed input history collected for it.
+        # This only reads the delay buffer through its arguments, so that it can be recomputed when checkpointed.
+        def integrate_TR(P, E, I, Pv, Ev, Iv, current, LEd_p2e_hist, LEd_p2i_hist, LEd_p2p_hist, external_TR, noise_TR):
             for step_i in range(self.steps_per_TR):
                 
-                # Collect the delayed inputs:
-
-                # i) index the history of E
-                Ed = pttranspose(hE.clone().gather(1,self.delays), 0, 1)
+                # Collect the delayed inputs, adding the zero-delay connections to the history collected above
+                LEd_zero = buffer.gatherCurrent(delay_index, w_zero, current)
 
-                # ii) multiply the past states by the connectivity weights matrix, and sum over rows
-                LEd_p2e =  ptsum(w_n_f * Ed, 1)
-                LEd_p2i = -ptsum(w_n_b * Ed, 1)
-                LEd_p2p =  ptsum(w_n_l * Ed, 1)
-                
                 # iii) reshape for next step
-                LEd_p2e = ptreshape(LEd_p2e, (n_nodes, 1))
-                LEd_p2i = ptreshape(LEd_p2i, (n_nodes, 1))
-                LEd_p2p = ptreshape(LEd_p2p, (n_nodes, 1))
+                LEd_p2e = ptreshape(LEd_p2e_hist + LEd_zero[0], (batch_size, n_nodes, 1))
+                LEd_p2i = ptreshape(LEd_p2i_hist + LEd_zero[1], (batch_size, n_nodes, 1))
+                LEd_p2p = ptreshape(LEd_p2p_hist + LEd_zero[2], (batch_size, n_nodes, 1))
                 
                 # iv) if specified, add the laplacian component (self-connections from diagonals)
                 if self.use_laplacian:
-                    LEd_p2e =  LEd_p2e + ptmatmul(dg_f, E - I)
-                    LEd_p2i =  LEd_p2i - ptmatmul(dg_b, E - I)
-                    LEd_p2p =  LEd_p2p + ptmatmul(dg_l, P)
+                    LEd_p2e =  LEd_p2e + lap_f * (E - I)
+                    LEd_p2i =  LEd_p2i - lap_b * (E - I)
+                    LEd_p2p =  LEd_p2p + lap_l * P
 
                 # External input (e.g. TMS, sensory)
-                u = external[:, step_i:step_i + 1, i_window]
+                u = external_TR[..., step_i:step_i + 1]
                
                 # Stochastic / noise term
-                P_noise = std_in * ptrandn(n_nodes, 1) 
-                E_noise = std_in * ptrandn(n_nodes, 1)
-                I_noise = std_in * ptrandn(n_nodes, 1)
-
-                # Compute the firing rate for each neural populatin 
-                # at every node using the wave-to-pulse (sigmoid) functino
-                # (vmax = max value of sigmoid, v0 = midpoint of sigmoid)
-                P_sigm = vmax / ( 1 + ptexp ( r*(v0 -  (E-I) ) ) )
-                E_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c1*P) ) ) )
-                I_sigm = vmax / ( 1 + ptexp ( r*(v0 - (c3*P) ) ) )
-
-                # Sum the four different input types into a single input value for each neural 
-                # populatin state variable
-                # The four input types are:
-                # - Local      (L)      - from other neural populations within a node (E->P,P->I, etc.)
-                # - Long-range (L-R)    - from other nodes in the network, weighted by the long-range 
-                #                         connectivity matrices, and time-delayed
-                # - Noise      (N)      - stochastic noise input
-                # - External   (E)      - external stimulation, eg from TMS or sensory stimulus
-                #
-                #        Local    Long-range   Noise   External
-                rP =     P_sigm  + g*LEd_p2p   + P_noise + k*ki*u 
-                rE =  c2*E_sigm  + g_f*LEd_p2e + E_noise          
-                rI =  c4*I_sigm  + g_b*LEd_p2i + I_noise          
-
-                # Apply some additional scaling
-                rP = u_2ndsys_ub * pttanh(rP / u_2ndsys_ub)
-                rE = u_2ndsys_ub * pttanh(rE / u_2ndsys_ub)
-                rI = u_2ndsys_ub * pttanh(rI / u_2ndsys_ub)
-                
-                # Compute d/dt   ('_tp1' = state variable at time t+1) 
-                P_tp1 =  P + dt * Pv
-                E_tp1 =  E + dt * Ev
-                I_tp1 =  I + dt * Iv
-                Pv_tp1 = Pv + dt * ( A*a*rP  -  2*a*Pv  -  a**2 * P )
-                Ev_tp1 = Ev + dt * ( A*a*rE  -  2*a*Ev  -  a**2 * E )
-                Iv_tp1 = Iv + dt * ( B*b*rI  -  2*b*Iv  -  b**2 * I )
-
-                # Add some additional saturation on the model states
-                # (for stability and gradient calculation).
-                P_tp1 = 1000*pttanh(P_tp1/1000)
-                E_tp1 = 1000*pttanh(E_tp1/1000)
-                I_tp1 = 1000*pttanh(I_tp1/1000)
-                Pv_tp1 = 1000*pttanh(Pv_tp1/1000)
-                Ev_tp1 = 1000*pttanh(Ev_tp1/1000)
-                Iv_tp1 = 1000*pttanh(Iv_tp1/1000)
-                
-                # Update placeholders for pyramidal buffer
-                hE[:, 0] = P_tp1[:, 0]
-            
-                # Set state variables to currrent values for next round of the loop
-                P = P_tp1
-                E = E_tp1
-                I = I_tp1
-                Pv = Pv_tp1
-                Ev = Ev_tp1
-                Iv = Iv_tp1
-                # (note - we do this because we aren't (explicitly) keeping the history 
-                # by doing something like P[t+1] = P + dt*Pv 
-                # because (for the purpose of the paramer estimation) we don't want to 
-                # keep the entire integration loop history of P
-                #
+                P_noise = std_in * noise_TR[0, ..., step_i:step_i + 1]
+                E_noise = std_in * noise_TR[1, ..., step_i:step_i + 1]
+                I_noise = std_in * noise_TR[2, ..., step_i:step_i + 1]
+
+                # Advance all population states by one integration step
+                if solver is None:
+                    P, E, I, Pv, Ev, Iv = step_kernel(P, E, I, Pv, Ev, Iv, LEd_p2e, LEd_p2i, LEd_p2p, u, 
+                                                      P_noise, E_noise, I_noise, A, a, B, b, g, c1, c2, c3, c4, 
+                                                      vmax, v0, r, k, ki, g_f, g_b, dt, u_2ndsys_ub)
+                else:
+                    inputs = (LEd_p2e, LEd_p2i, LEd_p2p, u, P_noise, E_noise, I_noise)
+                    P, E, I, Pv, Ev, Iv = solver.step(dfun, (P, E, I, Pv, Ev, Iv), inputs, dt, sys2nd = sys2nd)
+
+                # The pyramidal current read by the zero-delay connections at the next step
+                current = P[..., 0]
 
                 # *end 'step_i' loop*
 
-            # Capture the states at the end of every window in the placeholders for checking them visually
-            P_window.append(P);    I_window.append(I) ;  E_window.append(E)
-            Pv_window.append(Pv);  Iv_window.append(Iv); Ev_window.append(Ev)
+            return P, E, I, Pv, Ev, Iv
+
+        # Gradient checkpointing only matters when a graph is being recorded
+        checkpoint = getattr(self, 'checkpoint', False) and ptis_grad_enabled()
+
+        # Preallocated placeholders for the recorded history of the M/EEG signals and each population's current and voltage,
+        # written in place every record_every sample points (see setRecord)
+        record = self.recordNames()
+        record_every = getattr(self, 'record_every', 1)
+        num_records = -(-num_TRs // record_every)
+        window = {}
+        for name in record:
+            window[name] = hx.new_zeros(batch_size, n_chans if name == 'eeg' else n_nodes, num_records, dtype=state_dtype)
+
+        # Use the model to get M/EEG signal at the i-th element in the window.
+
+        # Run through the number of specified sample points for this window 
+        for i_window in range(num_TRs):
             
-            # Capture the states at every tr in the placeholders for checking them visually.
-            hE = ptcat([P, hE[:, :-1]], dim=1)  # update placeholders for pyramidal buffer
 
-            # Lead field matrix
-            onesmat = ptones(1,n_chans)
-            lm_t = (lm.T / ptsqrt((lm ** 2).sum(1))).T
-            self.lm_t = (lm_t - 1 / n_chans * ptmatmul(onesmat, lm_t))
+            # The delayed history only changes once per sample point, so is collected here:
+
+            # i) index the history of E
+            Ed = buffer.gather(delay_index).to(compute_dtype)
+
+            # ii) multiply the past states by the connectivity weights matrix, and sum over rows
+            if self.use_sparse_sc:
+                # (summing the weighted edges into their target nodes)
+                LEd_hist = Ed.new_zeros(3, batch_size, n_nodes).index_add(2, self.sc_dst, (w_stack if batched_sc else w_stack.unsqueeze(1)) * Ed)
+                LEd_p2e_hist, LEd_p2i_hist, LEd_p2p_hist = LEd_hist[0], LEd_hist[1], LEd_hist[2]
+            else:
+                LEd_p2e_hist =  ptsum(w_n_f * Ed, 2)
+                LEd_p2i_hist = -ptsum(w_n_b * Ed, 2)
+                LEd_p2p_hist =  ptsum(w_n_l * Ed, 2)
+
+            # For each sample point, run the model by solving the differential 
+            # equations for a defined number of integration steps, 
+            # and keep only the final activity state within this set of steps 
+            if checkpoint:
+                # Only the inputs of the sample point are kept for backward, where its steps are recomputed
+                P, E, I, Pv, Ev, Iv = ptcheckpoint(integrate_TR, P, E, I, Pv, Ev, Iv, buffer.current, 
+                                                   LEd_p2e_hist, LEd_p2i_hist, LEd_p2p_hist, 
+                                                   external[..., i_window], noise[..., i_window],
+                                                   use_reentrant=False, preserve_rng_state=False)
+            else:
+                P, E, I, Pv, Ev, Iv = integrate_TR(P, E, I, Pv, Ev, Iv, buffer.current, 
+                                                   LEd_p2e_hist, LEd_p2i_hist, LEd_p2p_hist, 
+                                                   external[..., i_window], noise[..., i_window])
+
+            # Update placeholders for pyramidal buffer
+            buffer.current = P[..., 0].to(buffer.ring.dtype)
 
-            # Compute M/EEG window
-            temp = cy0 * ptmatmul(self.lm_t, E-I) - 1 * y0
-            eeg_window.append(temp)
+            # Capture the states at every tr in the placeholders for checking them visually.
+            buffer.push(P[..., 0].to(buffer.ring.dtype))  # update placeholders for pyramidal buffer
+
+            # Capture the recorded states, and compute the M/EEG window, at the end of every recorded sample point
+            if i_window % record_every == 0:
+                rec_i = i_window // record_every
+                states = {'P': P, 'E': E, 'I': I, 'Pv': Pv, 'Ev': Ev, 'Iv': Iv}
+                for name in record:
+                    if name == 'eeg':
+                        window[name][..., rec_i:rec_i + 1] = cy0 * ptmatmul(lm_t, E-I) - 1 * y0
+                    else:
+                        window[name][..., rec_i:rec_i + 1] = states[name]
 
             # *end 'i_window' loop
 
         # Update the current state.
-        current_state = ptcat([P, E, I, Pv, Ev, Iv], dim=1)
+        current_state = ptcat([P, E, I, Pv, Ev, Iv], dim=-1).to(state_dtype)
         next_state['current_state'] = current_state
-        next_state['eeg'] = ptcat(eeg_window, dim=1)
-        next_state['E'] = ptcat(E_window, dim=1)
-        next_state['I'] = ptcat(I_window, dim=1)
-        next_state['P'] = ptcat(P_window, dim=1)
-        next_state['Ev'] = ptcat(Ev_window, dim=1)
-        next_state['Iv'] = ptcat(Iv_window, dim=1)
-        next_state['Pv'] = ptcat(Pv_window, dim=1)
+        next_state.update(window)
 
+        # Drop the batch axis again for unbatched calls
+        if not batched:
+            for name in next_state:
+                next_state[name] = next_state[name].squeeze(0)
 
-        return next_state, hE
-
+        if not isinstance(hE, DelayBuffer):
+            hE = buffer.toTensor()
 
+        return next_state, hE
@@ -1,6 +1,8 @@
 from .cost_TS import CostsTS
 from .cost_FC import CostsFC
 from .cost_FC import CostsFixedFC
+from .cost_FC import calcFC
 from .cost_Mean import CostsMean
 from .cost_PSD import CostsPSD
-from .cost_PSD import CostsFixedPSD
\ No newline at end of file
+from .cost_PSD import CostsFixedPSD
+from .summary_features import SummaryFeatures
\ No newline at end of file
@@ -8,12 +8,31 @@ import numpy as np  # for numerical operations
 from torch import (Tensor as ptTensor, reshape as ptreshape, mean as ptmean, matmul as ptmatmul, transpose as pttranspose, 
                    diag as ptdiag, reciprocal as ptreciprocal, sqrt as ptsqrt, tril as pttril, ones_like as ptones_like, 
                    zeros_like as ptzeros_like, greater as ptgreater, masked_select as ptmasked_select, sum as ptsum, 
-                   multiply as ptmultiply, log as ptlog, device as ptdevice)
+                   multiply as ptmultiply, log as ptlog, device as ptdevice, diagonal as ptdiagonal)
 
 from ..datatypes import AbstractLoss 
 from ..functions.arg_type_check import method_arg_type_check
 
 
+def calcFC(ts: ptTensor):
+    """Calculates the Functional Connectivity (FC) matrix as in CostsFC: the Pearson correlation between the mean-zero time series of every pair of nodes.
+
+    Parameters
+    ----------
+    ts: torch.Tensor with node_size X datapoint, or batch_size X node_size X datapoint
+        time series (e.g. BOLD or EEG)
+
+    Returns
+    -------
+    torch.Tensor with node_size X node_size, or batch_size X node_size X node_size
+        FC matrix
+    """
+    ts_n = ts - ptmean(ts, -1, keepdim=True)
+    cov = ptmatmul(ts_n, pttranspose(ts_n, -1, -2))
+    std = ptsqrt(ptdiagonal(cov, dim1=-2, dim2=-1))
+    return cov / (std.unsqueeze(-1) * std.unsqueeze(-2))
+
+
 class CostsFC(AbstractLoss):
     """
     Cost function for Fitting the Functional Connectivity (FC) matrix.
@@ -56,31 +75,14 @@ class CostsFC(AbstractLoss):
         """
         method_arg_type_check(self.main_loss) # Check that the passed arguments (excluding self) abide by their expected data types
         
-        sim = simData[self.simKey]
+        sim = self.castData(simData[self.simKey])
         
         logits_series_tf = sim
-        labels_series_tf = empData
-        # get node_size() and TRs_per_window()
-        node_size = logits_series_tf.shape[0]
-        truncated_backprop_length = logits_series_tf.shape[1]
-
-        # remove mean across time
-        labels_series_tf_n = labels_series_tf - ptreshape(ptmean(labels_series_tf, 1),
-                                                          [node_size, 1])  # - torch.matmul(
-
-        logits_series_tf_n = logits_series_tf - ptreshape(ptmean(logits_series_tf, 1),
-                                                          [node_size, 1])  # - torch.matmul(
-
-        # correlation
-        cov_sim = ptmatmul(logits_series_tf_n, pttranspose(logits_series_tf_n, 0, 1))
-        cov_def = ptmatmul(labels_series_tf_n, pttranspose(labels_series_tf_n, 0, 1))
+        labels_series_tf = self.castData(empData)
 
         # Getting the FC matrix for the simulated and empirical BOLD signals
-        FC_sim_T = ptmatmul(ptmatmul(ptdiag(ptreciprocal(ptsqrt(
-            ptdiag(cov_sim)))), cov_sim),
-            ptdiag(ptreciprocal(ptsqrt(ptdiag(cov_sim))))) # SIMULATED FC
-        FC_T = ptmatmul(ptmatmul(ptdiag(ptreciprocal(ptsqrt(ptdiag(cov_def)))), cov_def),
-                        ptdiag(ptreciprocal(ptsqrt(ptdiag(cov_def))))) # EMPIRICAL FC
+        FC_sim_T = calcFC(logits_series_tf) # SIMULATED FC
+        FC_T = calcFC(labels_series_tf) # EMPIRICAL FC
 
         # Masking out the upper triangle of the FC matrix and keeping the lower triangle
         ones_tri = pttril(ptones_like(FC_T), -1)
@@ -156,24 +158,13 @@ class CostsFixedFC(AbstractLoss):
         losses_corr: torch.tensor
             cost function value
         """
-        simTS = simData[self.simKey]
-        empFC = empData
+        simTS = self.castData(simData[self.simKey])
+        empFC = self.castData(empData)
         
         logits_series_tf = simTS
 
-        # get node_size() and TRs_per_window()
-        node_size = logits_series_tf.shape[0]
-        truncated_backprop_length = logits_series_tf.shape[1]
-
-        # remove mean across time
-        logits_series_tf_n = logits_series_tf - ptreshape(ptmean(logits_series_tf, 1), [node_size, 1])
-
-        # correlation
-        cov_sim = ptmatmul(logits_series_tf_n, pttranspose(logits_series_tf_n, 0, 1))
-
-        # Getting the FC matrix for the simulated and empirical BOLD signals
-        FC_sim_T = ptmatmul(ptmatmul(ptdiag(ptreciprocal(ptsqrt(ptdiag(cov_sim)))), cov_sim),
-                                             ptdiag(ptreciprocal(ptsqrt(ptdiag(cov_sim))))) # SIMULATED FC
+        # Getting the FC matrix for the simulated BOLD signals
+        FC_sim_T = calcFC(logits_series_tf) # SIMULATED FC
 
         # Masking out the upper triangle of the FC matrix and keeping the lower triangle
         ones_tri = pttril(ptones_like(empFC).to(self.device), -1)
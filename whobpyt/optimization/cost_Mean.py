@@ -73,7 +73,7 @@ class CostsMean(AbstractLoss):
         
         '''
         
-        sim = simData[self.simKey]
+        sim = self.castData(simData[self.simKey])
         
         meanVar = ptmean(sim, 1)
         
@@ -264,7 +264,7 @@ class CostsFixedPSD(AbstractLoss):
             The MSE of the difference between the simulated and target power spectrum within the specified range
         
         """
-        sim = simData[self.simKey]
+        sim = self.castData(simData[self.simKey])
         
         psdAxis, psdValues = self.calcPSD(sim, sampleFreqHz = self.sampleFreqHz, minFreq = self.minFreq, maxFreq = self.maxFreq) # TODO: Sampling frequency of simulated data and target time series is currently assumed to be the same.
         
@@ -22,14 +22,17 @@ class CostsTS(AbstractLoss):
         
         Parameters
         ----------
-        simData: dict of tensor with node_size X datapoint
+        simData: dict of tensor with node_size X datapoint (or node_size X datapoint X batch)
             simulated EEG
         empData: tensor with node_size X datapoint
             empirical EEG
         """
         method_arg_type_check(self.main_loss) # Check that the passed arguments (excluding self) abide by their expected data types
-        sim = simData[self.simKey]
-        emp = empData
+        sim = self.castData(simData[self.simKey])
+        emp = self.castData(empData)
+        if sim.dim() == emp.dim() + 1:
+            # Batched simulations (node_size X datapoint X batch, see FittingBatch) are all compared to the same data
+            emp = emp.unsqueeze(-1)
 
         losses = torch.sqrt(torch.mean((sim - emp) ** 2))  #
         return losses
@@ -0,0 +1,120 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting
+module for summary features of simulated and empirical time series (for simulation-based inference)
+"""
+
+from torch import (device as ptdevice, as_tensor as ptas_tensor, cat as ptcat, log10 as ptlog10,
+                   tril_indices as pttril_indices, float32 as ptfloat32)
+from torch.nn.functional import adaptive_avg_pool1d as ptadaptive_avg_pool1d
+
+from ..datatypes import Timeseries
+from .cost_FC import calcFC
+from .cost_PSD import CostsFixedPSD
+
+
+class SummaryFeatures:
+    """
+    Summary features of a time series, computed as in the objective functions, for simulation-based inference
+    (see SimulationBasedInference):
+        - 'erp': the time series averaged into erp_bins consecutive bins (the evoked response, as fitted by CostsTS)
+        - 'psd': the log10 power spectral density between minFreq and maxFreq, of every node (as fitted by CostsFixedPSD)
+        - 'fc': the lower triangle of the functional connectivity matrix (as fitted by CostsFC)
+
+    The features of a batch of time series are computed at once. All the time series should have the same length,
+    as the PSD features depend on it.
+
+    Attributes
+    ----------
+    simKey: str
+        The state variable or output of the model the features are computed from
+    num_regions: int
+        The number of nodes (or channels) of the time series
+    features: list of str
+        The features computed, among 'erp', 'psd' and 'fc', in the order they are concatenated
+    erp_bins: int
+        The number of time bins of the 'erp' features
+    psd: CostsFixedPSD
+        The objective function whose calcPSD computes the 'psd' features
+    device: torch.device
+        Whether to compute the features on CPU or GPU
+    """
+
+    def __init__(self, simKey: str, num_regions: int, sampleFreqHz: float, features = ('erp', 'psd', 'fc'), erp_bins: int = 20,
+                 minFreq: float = 2, maxFreq: float = 40, rmTransient: int = 0, device = ptdevice('cpu')):
+        """
+        Parameters
+        ----------
+        simKey: str
+            The state variable or output of the model the features are computed from
+        num_regions: int
+            The number of nodes (or channels) of the time series
+        sampleFreqHz: float
+            The sampling frequency of the time series
+        features: list of str
+            The features computed, among 'erp', 'psd' and 'fc'
+        erp_bins: int
+            The number of time bins of the 'erp' features
+        minFreq: float
+            The minimum frequency of the 'psd' features
+        maxFreq: float
+            The maximum frequency of the 'psd' features
+        rmTransient: int
+            The number of initial time points removed before computing the 'psd' features
+        device: torch.device
+            Whether to compute the features on CPU or GPU
+        """
+
+        for feature in features:
+            if feature not in ['erp', 'psd', 'fc']:
+                raise ValueError(f"features should be among 'erp', 'psd' and 'fc', but got {feature} instead.")
+
+        self.simKey = simKey
+        self.num_regions = num_regions
+        self.features = list(features)
+        self.erp_bins = erp_bins
+        self.psd = CostsFixedPSD(num_regions, simKey, sampleFreqHz, minFreq, maxFreq, rmTransient = rmTransient, device = device)
+        self.device = device
+
+    def _timeSeries(self, data):
+        # From a Timeseries, a dict of model outputs or a tensor, to a batch_size x num_regions x time tensor
+        if isinstance(data, Timeseries):
+            data = data.pyTS()
+        elif isinstance(data, dict):
+            data = data[self.simKey]
+        ts = ptas_tensor(data, device = self.device)
+        if not ts.is_floating_point() or ts.element_size() < 4:
+            ts = ts.to(ptfloat32)
+        if ts.dim() == 2:
+            ts = ts.unsqueeze(0)
+        return ts
+
+    def compute(self, data):
+        """
+        Parameters
+        ----------
+        data: Timeseries, dict of torch.Tensor or torch.Tensor
+            A time series of num_regions x time, or a batch of them (batch_size x num_regions x time).
+            A dict (e.g. the outputs of the model) gives the time series of simKey.
+
+        Returns
+        -------
+        torch.Tensor with batch_size X number of features
+            The features of every time series
+        """
+
+        ts = self._timeSeries(data)
+        batch_size = ts.shape[0]
+
+        parts = []
+        for feature in self.features:
+            if feature == 'erp':
+                parts.append(ptadaptive_avg_pool1d(ts, self.erp_bins).reshape(batch_size, -1))
+            elif feature == 'psd':
+                psdAxis, psdValues = self.psd.calcPSD(ts.permute(1, 2, 0), sampleFreqHz = self.psd.sampleFreqHz,
+                                                      minFreq = self.psd.minFreq, maxFreq = self.psd.maxFreq)
+                parts.append(ptlog10(psdValues + 1e-12).permute(2, 0, 1).reshape(batch_size, -1))
+            elif feature == 'fc':
+                rows, cols = pttril_indices(self.num_regions, self.num_regions, -1, device = ts.device)
+                parts.append(calcFC(ts)[:, rows, cols])
+        return ptcat(parts, dim = 1)
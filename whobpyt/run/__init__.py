@@ -1,3 +1,9 @@
 from .model_fitting import ModelFitting
 from .custom_fitting import FittingFNGFPG
 from .batch_fitting import FittingBatch
+from .cohort_fitting import CohortFitting
+from .distributed_fitting import DistributedFitting, fitDistributed
+from .evolutionary_fitting import EvolutionaryFitting
+from .sbi import SimulationBasedInference, MixtureDensityEstimator
+from .early_stopping import EarlyStopping
+from .telemetry import Telemetry, MemorySink, JSONLSink, CSVSink, PrintSink
@@ -0,0 +1,98 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for the adjoint gradient engine
+"""
+
+import torch
+
+
+def windowAdjoint(model, cost, X, hE, externals, targets):
+    """
+    Computes the gradient of the mean loss of several consecutive windows with respect to the fitted parameters,
+    backpropagating through the state carried from window to window, keeping the autograd graph of only one window at a time.
+
+    This is the discrete adjoint of the model's solver. A forward pass without gradient stores only a checkpoint of the
+    state (current state and delay history) at the start of every window, as well as the state of the model's noise.
+    The adjoint is then propagated backwards one window at a time: each window is re-simulated from its checkpoint
+    with the same noise, and the gradient of its loss, plus the adjoint of its end state handed back by the following window,
+    is backpropagated to its start state and to the parameters. Only one window of the autograd graph is alive at a time,
+    the delayed coupling being carried exactly by the delay history in the checkpoints. The memory of the graph therefore
+    does not grow with the number of windows, but the checkpoints (one state and delay history per window) do.
+
+    The gradients are accumulated into the .grad of the parameters, as loss.backward() would.
+
+    Parameters
+    ----------
+    model : AbstractNeuralModel
+        The model, with a `noise` NoiseProvider.
+    cost : AbstractLoss
+        The objective function, whose loss() returns (loss, loss_main) for a window.
+    X : Tensor
+        The state at the start of the first window.
+    hE : Tensor
+        The delay history at the start of the first window.
+    externals : list of Tensor
+        The external input of each window.
+    targets : list of Tensor
+        The empirical data of each window.
+
+    Returns
+    -------
+    windows : list of dict
+        The (detached) output of model.forward for each window.
+    X : Tensor
+        The (detached) state at the end of the last window.
+    hE : Tensor
+        The (detached) delay history at the end of the last window.
+    losses : list of Tensor
+        The (detached) loss_main of each window.
+    """
+
+    num_windows = len(externals)
+
+    # Forward pass: keep only the checkpoints at window boundaries
+    checkpoints = []
+    noise_states = []
+    windows = []
+    with torch.no_grad():
+        for external in externals:
+            checkpoints.append((X.detach(), hE.detach()))
+            noise_states.append(model.noise.getState())
+            next_window, hE = model(external, X, hE)
+            X = next_window['current_state']
+            windows.append(next_window)
+    noise_end = model.noise.getState()
+
+    # Backward pass: re-simulate each window from its checkpoint and backpropagate, last window first
+    losses = [None] * num_windows
+    adj_X = None
+    adj_hE = None
+    for win_idx in reversed(range(num_windows)):
+        model.noise.setState(noise_states[win_idx])
+        # The coupling cached by the model for the previous window was freed by its backward, so it is rebuilt
+        if hasattr(model, 'invalidateCoupling'):
+            model.invalidateCoupling()
+        X_start = checkpoints[win_idx][0].clone().requires_grad_(True)
+        hE_start = checkpoints[win_idx][1].clone().requires_grad_(True)
+
+        next_window, hE_end = model(externals[win_idx], X_start, hE_start)
+        loss, loss_main = cost.loss(next_window, targets[win_idx])
+        losses[win_idx] = loss_main.detach()
+
+        tensors = [loss / num_windows]
+        grads = [None]
+        if adj_X is not None:
+            tensors += [next_window['current_state'], hE_end]
+            grads += [adj_X, adj_hE]
+        torch.autograd.backward(tensors, grads)
+
+        # The adjoint of the start state of this window is the one of the end state of the previous window
+        adj_X = X_start.grad if X_start.grad is not None else torch.zeros_like(X_start)
+        adj_hE = hE_start.grad if hE_start.grad is not None else torch.zeros_like(hE_start)
+
+    model.noise.setState(noise_end)
+    if hasattr(model, 'invalidateCoupling'):
+        model.invalidateCoupling()
+
+    windows = [{name: val.detach() for name, val in window.items()} for window in windows]
+    return windows, X.detach(), hE.detach(), losses
@@ -2,10 +2,12 @@
 # github.com/GriffithsLab/whobpyt/blob/dev/whobpyt/run/customfitting.py
 
 
+import time
 import torch
 import numpy as np
 from ..datatypes import Timeseries as Recording # JG: switch this to Timeseries soon
 from ..datatypes import TrainingStats, AbstractFitting
+from .telemetry import Telemetry
 
 class FittingBatch(AbstractFitting):
     """
@@ -13,6 +15,19 @@ class FittingBatch(AbstractFitting):
     
     This is a specalized model fitting class to train using a batched approach.
     
+    Every backpropagation runs `batch_size` stochastic realisations (blocks) of the same simulation at once, in one
+    batched forward call, and backpropagates the objective function of all of them together, instead of looping over noise seeds.
+    
+    The model should implement the batched-model protocol (as JansenRitModel does):
+        - setBlocks(num_blocks) sets the number of simulations run at once
+        - createIC(ver, batch_size) and createDelayIC(ver, batch_size) create (batched) initial states and delay histories,
+          and keep the last ones as next_start_state and next_start_hE
+        - genNoise(block_len, batched = True) draws the noise of num_blocks blocks
+        - sim_len is the number of sample points simulated by one forward call
+        - forward(external, hx, hE, noise) simulates the blocks given a leading batch axis
+    
+    The simulated outputs are given to the objective function as node_size x time x batch_size tensors (see CostsTS, CostsMean and CostsFixedPSD).
+    
     Attributes
     -----------
     model : AbstractNMM
@@ -22,12 +37,14 @@ class FittingBatch(AbstractFitting):
     trainingStats : TrainingStats
         An object that will keep track of optimization/machine learning statistics during training.
     lastRec :  Recording
-        The simulated data from the last batch run
+        The simulated data from the last batch run (node_size x time x batch_size)
     device : torch.device
         Whether the fitting is to run on CPU or GPU
+    telemetry : Telemetry
+        Where the timings and losses of the fitting are sent
     """
     
-    def __init__(self, model, cost, device = torch.device('cpu')):
+    def __init__(self, model, cost, device = torch.device('cpu'), telemetry = None):
         
         self.model = model
         self.cost = cost
@@ -35,8 +52,41 @@ class FittingBatch(AbstractFitting):
         self.device = device
         
         self.trainingStats = TrainingStats(self.model)
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
         self.lastRec = None
+    
+    def _external(self, stim, start, length):
+        # The external input of `length` sample points from sample point `start`: a constant for an Int or Float stim,
+        # otherwise a slice of the stim tensor (num_ROIs x steps_per_TR x time points, with an optional leading batch axis)
         
+        dtype = self.model.dtype_policy.compute
+        if isinstance(stim, (int, float)):
+            return torch.full((self.model.node_size, self.model.steps_per_TR, length), float(stim), dtype = dtype, device = self.device)
+        stim = torch.as_tensor(stim, dtype = dtype, device = self.device)
+        if stim.shape[-1] < start + length:
+            raise ValueError(f"The stimulus has {stim.shape[-1]} time points, but {start + length} are simulated.")
+        return stim[..., start:start + length]
+    
+    def _target(self, empData):
+        # Recordings are given to the objective function as tensors, other targets (e.g. a fixed FC or PSD) as they are
+        
+        if isinstance(empData, Recording):
+            return empData.pyTS().to(self.device, self.model.dtype_policy.compute)
+        return empData
+    
+    def _costLayout(self, sim_vals):
+        # From the batch first outputs of the model (batch_size x node_size x time) to node_size x time x batch_size
+        
+        return {name: sim_vals[name].permute(1, 2, 0) for name in self.model.recordNames()}
+    
+    def _loss(self, sim_vals, empData):
+        # Objective functions return either the loss, or the loss and its main component (e.g. CostsJR)
+        
+        loss = self.cost.loss(sim_vals, empData)
+        if isinstance(loss, tuple):
+            loss = loss[0]
+        return loss
+    
     def train(self, stim, empDatas, num_epochs, batch_size, learningrate = 0.05, staticIC = True, staticNoise = False):
         '''
         
@@ -45,76 +95,75 @@ class FittingBatch(AbstractFitting):
         Parameters
         -----------
         stim : Int or Tensor
-            The input into the NMM (is 0 for the resting state case).
+            The input into the NMM (is 0 for the resting state case), as a constant, or a tensor of num_ROIs x steps_per_TR x sim_len
+            (optionally with a leading batch_size axis, for a different input to every block) applied in every simulation.
         empDatas : List of Recording or other object
-            The empirical data compared to in the objective function. 
+            The empirical data compared to in the objective function, one per backpropagation (a Recording of sim_len time points, or e.g. a fixed FC).
         num_epochs : Int
             Number of epochs for training.
         batch_size : Int
-            The number of simulations run that will be backpropagated through simultaneously.    
+            The number of simulations run that will be backpropagated through simultaneously.
         learningrate : Float
             Learning rate used by backpropagation optimizer.
         staticIC : Bool
-            Whether to reset the models initial condition after every backpropagation
+            Whether every simulation starts from the same initial conditions (created once, before training), or from new random ones
         staticNoise : Bool
             Whether to use the same noise for each epoch
         '''
         
         optim = torch.optim.Adam(self.model.params_fitted['modelparameter'], lr = learningrate)
-                        
-        self.model.setBlocks(batch_size) # Set Block Size to one before creating IC
-        initCond = self.model.createIC(ver = 0) #initCond is not being used, but this method resets the next_start_state of the model directly
-        stateHist = self.model.createDelayIC(ver = 0)
+        
+        self.model.setBlocks(batch_size) # Set the number of blocks before creating IC
+        self.model.createIC(ver = 0, batch_size = batch_size) # This sets the next_start_state of the model directly
+        self.model.createDelayIC(ver = 0, batch_size = batch_size) # This sets the next_start_hE of the model directly
         [serialNoise, blockNoise] = self.model.genNoise(self.model.sim_len, batched = True)
         del serialNoise
         
-        dummyVal = torch.tensor(0).to(self.device)
+        external = self._external(stim, 0, self.model.sim_len)
+        window_sim_time = self.model.sim_len * self.model.steps_per_TR * float(self.model.step_size)
         
         for e in range(num_epochs):
-            print("epoch: ", e)
+            epoch_start = time.perf_counter()
             
             # TRAINING_STATS: placeholders for the history of trainingStats
             loss_his = []  # loss placeholder to take the average for the epoch at the end of the epoch
             
             for empData in empDatas:
-            
+                
                 if not staticIC:
                     # initial state
-                    firstIC = self.model.createIC(ver = 0)
+                    firstIC = self.model.createIC(ver = 0, batch_size = batch_size)
                     # initials of history of E
-                    delayHist = self.model.createDelayIC(ver = 0) #TODO: Delays are currently is not implemented in various places
+                    delayHist = self.model.createDelayIC(ver = 0, batch_size = batch_size)
                 else:
                     firstIC = self.model.next_start_state
-                    delayHist = dummyVal # TODO: Delays are currently is not implemented in various places
-
-                # initial the external inputs
-                external = dummyVal # TODO: Currenlty this code only works for resting state
-                
-                num_blocks = batch_size
+                    delayHist = self.model.next_start_hE
                 
                 if not staticNoise:
                     [serialNoise, blockNoise] = self.model.genNoise(self.model.sim_len, batched = True)
                     del serialNoise
-
-                sim_vals, delayHist = self.model.forward(external, firstIC, delayHist, blockNoise, batched = True)
-
-                
-                print("Batched Forward Finished")
                 
+                with self.telemetry.phase('forward'):
+                    sim_vals, _ = self.model.forward(external, firstIC.to(self.device), delayHist.to(self.device), blockNoise.to(self.device))
+                    sim_vals = self._costLayout(sim_vals)
                 
                 # calculating loss
-                loss = self.cost.loss(sim_vals, empData)
+                with self.telemetry.phase('loss'):
+                    loss = self._loss(sim_vals, self._target(empData))
                 
                 optim.zero_grad()
-                loss.backward()
-                optim.step()
+                with self.telemetry.phase('backward'):
+                    loss.backward()
+                with self.telemetry.phase('step'):
+                    optim.step()
+                
+                self.telemetry.window(window_sim_time * batch_size, epoch = e, loss = loss.detach())
                 
-                print("Batched Backwards Finished")
-                                                
                 # TRAINING_STATS: Adding Loss for every training backpropagation
                 loss_his.append(loss.detach().cpu().numpy().copy())
-                
+            
             self.trainingStats.appendLoss(np.mean(loss_his))
+            self.telemetry.event('epoch', epoch = e, loss = self.trainingStats.loss[-1], seconds = time.perf_counter() - epoch_start)
             trackedParams = {}
             if(self.model.track_params):
                 for parKey in self.model.track_params:
@@ -122,23 +171,115 @@ class FittingBatch(AbstractFitting):
                     if (var.fit_par):
                         trackedParams[parKey] = var.value().detach().cpu().numpy().copy()
             self.trainingStats.appendParam(trackedParams)
-    
+        
         # Saving the last recording of training as a Model_fitting attribute
         self.lastRec = {}
-        for simKey in set(self.model.state_names + self.model.output_names):
-            self.lastRec[simKey] = Recording(sim_vals[simKey].detach().cpu().numpy().copy(), step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
+        for simKey in self.model.recordNames():
+            self.lastRec[simKey] = Recording(sim_vals[simKey].detach().cpu(), step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
+    
+    
+    def evaluate(self, stim, empData, batch_size = None, noise_seed = None):
+        '''
+        Method to calculate the objective function of a batch of simulations, as during training, but without updating the model parameters.
         
+        The simulations start from the initial conditions of the last training (next_start_state and next_start_hE), or new random ones
+        if the number of blocks differs.
         
-    def evaluate(self, stim, empData):
-        '''
-        Not implemented yet. 
+        Parameters
+        -----------
+        stim : Int or Tensor
+            The input into the NMM (see train).
+        empData : Recording or other object
+            The empirical data compared to in the objective function.
+        batch_size : Int
+            The number of simulations. Defaults to the number of blocks of the model (see setBlocks).
+        noise_seed : Int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
+        
+        Returns
+        --------
+        Dict
+            'loss': the objective function over all the simulations, and 'loss_per_block': the objective function of each simulation
         '''
-        pass
+        
+        if batch_size is not None:
+            self.model.setBlocks(batch_size)
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
+        firstIC, delayHist = self._startState()
+        
+        with torch.no_grad():
+            blockNoise = self.model.genNoise(self.model.sim_len, batched = True)[1]
+            sim_vals, _ = self.model.forward(self._external(stim, 0, self.model.sim_len), firstIC, delayHist, blockNoise.to(self.device))
+            sim_vals = self._costLayout(sim_vals)
+            target = self._target(empData)
+            loss = self._loss(sim_vals, target)
+            loss_per_block = [float(self._loss({name: values[..., block:block + 1] for name, values in sim_vals.items()}, target))
+                              for block in range(self.model.num_blocks)]
+        
+        metrics = {'loss': float(loss), 'loss_per_block': loss_per_block}
+        self.telemetry.event('evaluate', loss = metrics['loss'])
+        
+        self.lastRec = {}
+        for simKey in self.model.recordNames():
+            self.lastRec[simKey] = Recording(sim_vals[simKey].cpu(), step_size = self.model.step_size)
+        
+        return metrics
     
     
-    def simulate(self, stim, numTP):
+    def simulate(self, stim, numTP, batch_size = None, noise_seed = None):
         '''
-        Not implemented yet.
+        Method to simulate a batch of independent stochastic realisations, continuing each across forward calls (with its states and delays),
+        without gradients.
+        
+        The simulations start from the initial conditions of the last training (next_start_state and next_start_hE), or new random ones
+        if the number of blocks differs.
+        
+        Parameters
+        -----------
+        stim : Int or Tensor
+            The input into the NMM, as a constant, or a tensor of num_ROIs x steps_per_TR x numTP (optionally with a leading batch_size axis).
+        numTP : Int
+            The number of time points to simulate, rounded up to whole forward calls (of sim_len time points).
+        batch_size : Int
+            The number of simulations. Defaults to the number of blocks of the model (see setBlocks).
+        noise_seed : Int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
         '''
-        pass
+        
+        if batch_size is not None:
+            self.model.setBlocks(batch_size)
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
+        X, hE = self._startState()
+        
+        sim_len = self.model.sim_len
+        num_windows = max(1, -(-numTP // sim_len))
+        windListDict = {name: [] for name in self.model.recordNames()}
+        with torch.no_grad():
+            for win_idx in range(num_windows):
+                if isinstance(stim, (int, float)) or torch.as_tensor(stim).shape[-1] >= (win_idx + 1) * sim_len:
+                    external = self._external(stim, win_idx * sim_len, sim_len)
+                else:
+                    external = self._external(0, 0, sim_len) # No stimulus after the end of stim
+                blockNoise = self.model.genNoise(sim_len, batched = True)[1]
+                sim_vals, hE = self.model.forward(external, X, hE, blockNoise.to(self.device))
+                X = sim_vals['current_state']
+                for name in windListDict:
+                    windListDict[name].append(sim_vals[name])
+        
+        self.lastRec = {}
+        for simKey in self.model.recordNames():
+            data = torch.cat(windListDict[simKey], dim = -1).permute(1, 2, 0).cpu()
+            self.lastRec[simKey] = Recording(data, step_size = self.model.step_size)
+    
     
+    def _startState(self):
+        # The initial conditions of the last training if they match the number of blocks, otherwise new ones
+        
+        X = self.model.next_start_state
+        hE = self.model.next_start_hE
+        if X is None or hE is None or X.dim() != 3 or X.shape[0] != self.model.num_blocks:
+            X = self.model.createIC(ver = 0, batch_size = self.model.num_blocks)
+            hE = self.model.createDelayIC(ver = 0, batch_size = self.model.num_blocks)
+        return X.to(self.device), hE.to(self.device)
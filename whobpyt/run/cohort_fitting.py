@@ -0,0 +1,291 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for fitting many subjects (or conditions) in parallel
+"""
+
+import os
+import copy
+import math
+import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from queue import Empty
+
+import torch
+
+from ..datatypes import AbstractSink
+from .model_fitting import ModelFitting
+from .telemetry import Telemetry
+
+
+class _ProgressCost:
+    # Wraps the objective function of a fit, to report the loss of every training window as it completes,
+    # and to stop a fit as soon as it diverges
+
+    def __init__(self, cost, queue, job_id, attempt):
+        self.cost = cost
+        self.queue = queue
+        self.job_id = job_id
+        self.attempt = attempt
+        self.num_windows = 0
+
+    def loss(self, *args, **kwargs):
+        loss, loss_main = self.cost.loss(*args, **kwargs)
+        loss_value = float(loss_main.detach())
+        self.queue.put({'job': self.job_id, 'attempt': self.attempt, 'event': 'window', 'window': self.num_windows, 'loss': loss_value})
+        self.num_windows += 1
+        if not math.isfinite(loss_value):
+            raise FloatingPointError(f"The fit diverged at window {self.num_windows} (loss {loss_value}).")
+        return loss, loss_main
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'cost':
+            raise AttributeError(name)
+        return getattr(self.cost, name)
+
+
+class _ProgressSink(AbstractSink):
+    # Streams the TrainingStats of a fit after every epoch. ModelFitting appends the parameters of an epoch just after
+    # its 'epoch' record, so the stats are sent on the next record (or by flush at the end of the fit).
+
+    def __init__(self, queue, job_id, attempt):
+        self.diagnostics = []
+        self.queue = queue
+        self.job_id = job_id
+        self.attempt = attempt
+        self.fit = None
+        self.pending_epoch = None
+
+    def write(self, record):
+        self.flush()
+        if record['event'] == 'epoch':
+            self.pending_epoch = record['epoch']
+
+    def flush(self):
+        if self.pending_epoch is None or self.fit is None:
+            return
+        self.queue.put({'job': self.job_id, 'attempt': self.attempt, 'event': 'epoch', 'epoch': self.pending_epoch,
+                        'loss': self.fit.trainingStats.loss[-1], 'trainingStats': copy.deepcopy(self.fit.trainingStats)})
+        self.pending_epoch = None
+
+
+def _detachFit(fit):
+    # The results are sent back through torch's pickler, which refuses tensors holding an autograd graph,
+    # such as the coupling cached by the model during training, so these are dropped or detached
+    if hasattr(fit.model, 'invalidateCoupling'):
+        fit.model.invalidateCoupling()
+    for owner in [fit.model, fit]:
+        for name, value in list(vars(owner).items()):
+            if torch.is_tensor(value) and value.grad_fn is not None:
+                setattr(owner, name, value.detach())
+    return fit
+
+
+def _initWorker(threads_per_worker):
+    # Pins the number of threads of every worker, so that the workers do not oversubscribe the CPUs
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def _fitJob(job_id, attempt, model, cost, empRecs, u, train_args, queue):
+    # Fits one job in a worker process, and returns the ModelFitting object
+
+    train_args = dict(train_args)
+    if attempt > 0 and train_args.get('noise_seed') is not None:
+        # A retry gets a different noise realisation
+        train_args['noise_seed'] = train_args['noise_seed'] + attempt
+
+    queue.put({'job': job_id, 'attempt': attempt, 'event': 'start'})
+    sink = _ProgressSink(queue, job_id, attempt)
+    fit = ModelFitting(model, _ProgressCost(cost, queue, job_id, attempt), telemetry = Telemetry(sinks = [sink]))
+    sink.fit = fit
+    fit.train(u, empRecs, **train_args)
+    sink.flush()
+    fit.cost = cost
+    fit.telemetry = Telemetry()
+
+    for name, value in fit.model.state_dict().items():
+        if not torch.all(torch.isfinite(value)):
+            raise FloatingPointError(f"The fit diverged ({name} is not finite).")
+
+    return _detachFit(fit)
+
+
+class CohortFitting:
+    """
+    This class fits the model of every subject (or condition) of a cohort with ModelFitting, running the fits in parallel
+    in a pool of worker processes.
+
+    The loss of every training window, and the TrainingStats of every epoch, are streamed back to the main process as they complete,
+    and passed to a progress function.
+    Fits which fail or diverge (a non-finite loss or parameter) are retried, with a different noise seed if one is given.
+    With a results directory, every completed fit is written there as soon as it completes, and jobs whose result
+    is already there are not run again, so that an interrupted cohort can be resumed.
+
+    Attributes
+    ----------
+    jobs : list of tuple
+        The fits to run, each a tuple (model, cost, empRecs, u) of the arguments of ModelFitting and ModelFitting.train
+    num_workers : int
+        The number of worker processes
+    threads_per_worker : int
+        The number of PyTorch threads of each worker
+    max_retries : int
+        The number of times a failed or diverged fit is retried
+    results_dir : str
+        Directory where the fits are written as they complete (None to keep them in memory only)
+    results : dict
+        The ModelFitting object of every completed job, by job index
+    trainingStats : dict
+        The TrainingStats of every completed job, by job index
+    errors : dict
+        The error of the last attempt of every job which failed
+    """
+
+    def __init__(self, jobs, num_workers: int = None, threads_per_worker: int = 1, max_retries: int = 1, results_dir: str = None):
+        """
+        Parameters
+        ----------
+        jobs : list of tuple
+            The fits to run, each a tuple (model, cost, empRecs, u)
+        num_workers : int
+            The number of worker processes. Defaults to the number of CPUs divided by threads_per_worker.
+        threads_per_worker : int
+            The number of PyTorch threads of each worker
+        max_retries : int
+            The number of times a failed or diverged fit is retried
+        results_dir : str
+            Directory where the fits are written as they complete (None to keep them in memory only)
+        """
+
+        self.jobs = jobs
+        self.threads_per_worker = threads_per_worker
+        self.num_workers = num_workers if num_workers is not None else max(1, os.cpu_count() // threads_per_worker)
+        self.max_retries = max_retries
+        self.results_dir = results_dir
+
+        self.results = {}
+        self.trainingStats = {}
+        self.errors = {}
+
+        if self.results_dir is not None:
+            os.makedirs(self.results_dir, exist_ok = True)
+
+    def resultFile(self, job_id):
+        """
+        Parameters
+        ----------
+        job_id : int
+            Index of the job
+
+        Returns
+        -------
+        str
+            The file the fit of the job is written to
+        """
+
+        return os.path.join(self.results_dir, f"fit_{job_id}.pkl")
+
+    def _saveResult(self, job_id, fit):
+        # Written to a temporary file first, so that an interrupted run never leaves a partial result
+        filename = self.resultFile(job_id)
+        fit.save(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    def train(self, progress = None, **train_args):
+        """
+        Runs the fits.
+
+        Parameters
+        ----------
+        progress : function
+            Called in the main process with every progress event, a dict with the keys 'job', 'attempt' and 'event'
+            ('start', 'window', 'epoch', 'done', 'retry' or 'failed'), as well as 'window' and 'loss' for 'window' events,
+            'epoch', 'loss' and 'trainingStats' (the TrainingStats so far) for 'epoch' events, 'trainingStats' for 'done' events
+            and 'error' for 'retry' and 'failed' events. By default, events are printed.
+        **train_args
+            Arguments of ModelFitting.train (other than u and empRecs), e.g. num_epochs and TPperWindow
+
+        Returns
+        -------
+        dict
+            The ModelFitting object of every completed job, by job index
+        """
+
+        if progress is None:
+            progress = self._printProgress
+
+        # Resume from the results already written
+        pending = []
+        for job_id in range(len(self.jobs)):
+            if self.results_dir is not None and os.path.exists(self.resultFile(job_id)):
+                with open(self.resultFile(job_id), 'rb') as f:
+                    self.results[job_id] = pickle.load(f)
+                self.trainingStats[job_id] = self.results[job_id].trainingStats
+            else:
+                pending.append(job_id)
+
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Manager() as manager:
+            queue = manager.Queue()
+            with ProcessPoolExecutor(max_workers = self.num_workers, mp_context = ctx,
+                                     initializer = _initWorker, initargs = (self.threads_per_worker,)) as pool:
+
+                def submit(job_id, attempt):
+                    model, cost, empRecs, u = self.jobs[job_id]
+                    future = pool.submit(_fitJob, job_id, attempt, model, cost, empRecs, u, train_args, queue)
+                    futures[future] = (job_id, attempt)
+
+                futures = {}
+                for job_id in pending:
+                    submit(job_id, 0)
+
+                while futures:
+                    done, _ = wait(list(futures), timeout = 0.5, return_when = FIRST_COMPLETED)
+                    self._drain(queue, progress)
+
+                    for future in done:
+                        job_id, attempt = futures.pop(future)
+                        try:
+                            fit = future.result()
+                        except Exception as error:
+                            if attempt < self.max_retries:
+                                progress({'job': job_id, 'attempt': attempt, 'event': 'retry', 'error': repr(error)})
+                                submit(job_id, attempt + 1)
+                            else:
+                                self.errors[job_id] = repr(error)
+                                progress({'job': job_id, 'attempt': attempt, 'event': 'failed', 'error': repr(error)})
+                            continue
+
+                        self.results[job_id] = fit
+                        self.trainingStats[job_id] = fit.trainingStats
+                        self.errors.pop(job_id, None)
+                        if self.results_dir is not None:
+                            self._saveResult(job_id, fit)
+                        progress({'job': job_id, 'attempt': attempt, 'event': 'done', 'trainingStats': fit.trainingStats})
+
+                self._drain(queue, progress)
+
+        return self.results
+
+    def _drain(self, queue, progress):
+        # Passes on all the progress events sent by the workers so far
+        while True:
+            try:
+                event = queue.get_nowait()
+            except Empty:
+                return
+            progress(event)
+
+    def _printProgress(self, event):
+        if event['event'] == 'window':
+            print('job: ', event['job'], 'attempt: ', event['attempt'], 'window: ', event['window'], 'loss: ', event['loss'])
+        elif event['event'] == 'epoch':
+            print('job: ', event['job'], 'attempt: ', event['attempt'], 'epoch: ', event['epoch'], 'loss: ', event['loss'])
+        elif event['event'] in ['retry', 'failed']:
+            print('job: ', event['job'], 'attempt: ', event['attempt'], event['event'], event['error'])
+        else:
+            print('job: ', event['job'], 'attempt: ', event['attempt'], event['event'])
@@ -3,10 +3,12 @@
 # github.com/Andrew-Clappison/whobpyt/blob/parallel_idea/examples/Multimodal_Parallel_Simulation_Example_v6.ipynb
 
 
+import time
 import torch
 import numpy as np
 from ..datatypes import Timeseries 
-from ..datatypes import TrainingStats,AbstractFitting
+from ..datatypes import TrainingStats,AbstractFitting, DelayBuffer
+from .telemetry import Telemetry
 
 class FittingFNGFPG(AbstractFitting):
     """
@@ -16,6 +18,7 @@ class FittingFNGFPG(AbstractFitting):
         - backpropagate through time of the duration of 10's of seconds of real time scale simulation
         - learn generalized NMM parameters such that given a SC the model predicts the corresponding FC
         - the label can be a fixed value (example a FC matrix, instead of a neuroimaging recording)
+        - handle delays exactly: every parallel block starts from the delay history of the serial run at its start (see train)
     
     Attributes
     -----------
@@ -31,9 +34,11 @@ class FittingFNGFPG(AbstractFitting):
         The simulated data from the last parallel run (FPG)
     device : torch.device
         Whether the fitting is to run on CPU or GPU
+    telemetry : Telemetry
+        Where the timings and losses of the fitting are sent
     """
     
-    def __init__(self, model, cost, device = torch.device('cpu')):
+    def __init__(self, model, cost, device = torch.device('cpu'), telemetry = None):
         
         self.model = model
         self.cost = cost
@@ -41,37 +46,87 @@ class FittingFNGFPG(AbstractFitting):
         self.device = device
         
         self.trainingStats = TrainingStats(self.model)
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
         self.lastSerial = None #The last FNG run
         self.lastRec = None # The last FPG run
         
+    def _external(self, stim, length):
+        # The external input of `length` sample points: a constant for an Int or Float stim, otherwise the stim tensor
+        # (num_ROIs x steps_per_TR x time points)
+        
+        dtype = self.model.dtype_policy.compute
+        if isinstance(stim, (int, float)):
+            return torch.full((self.model.node_size, self.model.steps_per_TR, length), float(stim), dtype = dtype, device = self.device)
+        stim = torch.as_tensor(stim, dtype = dtype, device = self.device)
+        if stim.shape[-1] < length:
+            raise ValueError(f"The stimulus has {stim.shape[-1]} time points, but {length} are simulated.")
+        return stim[..., :length]
+    
+    def _target(self, empData):
+        # Recordings are given to the objective function as tensors, other targets (e.g. a fixed FC) as they are
+        
+        if isinstance(empData, Timeseries):
+            return empData.pyTS().to(self.device, self.model.dtype_policy.compute)
+        return empData
+    
+    def _loss(self, sim_vals, empData):
+        # Objective functions return either the loss, or the loss and its main component (e.g. CostsJR)
+        
+        loss = self.cost.loss(sim_vals, empData)
+        if isinstance(loss, tuple):
+            loss = loss[0]
+        return loss
+    
     def train(self, stim, empDatas, num_epochs, block_len, learningrate = 0.05, resetIC = True):
         '''
         Method to train the model.
         
+        The model should implement the batched-model protocol (setBlocks, genNoise, sim_len, next_start_state and next_start_hE, 
+        and a forward taking a leading batch axis, as JansenRitModel does; see FittingBatch).
+        
+        Every backpropagation covers sim_len sample points, simulated in two steps:
+            1. FNG: the sim_len sample points are simulated serially, one block of block_len sample points at a time, without gradients.
+               The state and the whole delay history (hE) at every block boundary are kept.
+            2. FPG: all the blocks are simulated again at once, as a batch, with gradients, each from the state and delay history 
+               of the serial run at its start, and with the same noise and stimulus. This gives the same time series as the serial run,
+               but the graph of each block is only block_len sample points long.
+        The blocks are then put back end to end, so that the objective function gets node_size x sim_len time series.
+        
         Parameters
         -----------
         stim : Int or Tensor
-            The input into the NMM (is 0 for the resting state case).
+            The input into the NMM (is 0 for the resting state case), as a constant, or a tensor of num_ROIs x steps_per_TR x sim_len.
         empDatas : List of Recording or other object
-            The empirical data compared to in the objective function. 
+            The empirical data compared to in the objective function (a Recording of sim_len time points, or e.g. a fixed FC). 
         num_epochs : Int
             Number of epochs for training.
         block_len : Int
-            The number of simulation steps per block. Total number of steps should be divisable by this number.    
+            The number of sample points per block. sim_len should be divisable by this number.    
         learningrate : Float
             Learning rate used by backpropagation optimizer.
         resetIC : Bool
-            Whether to reset the models initial condition after every backpropagation
+            Whether to restart from new random initial conditions at every backpropagation, or to continue from the end of the last one
         
         '''
         
+        sim_len = self.model.sim_len
+        if sim_len % block_len != 0:
+            raise ValueError(f"sim_len ({sim_len}) should be divisable by block_len ({block_len}).")
+        num_blocks = sim_len // block_len
+        
         optim = torch.optim.Adam(self.model.params_fitted['modelparameter'], lr = learningrate)
         
-        initCond = self.model.createIC(ver = 0) #initCond is not being used, but this method resets the next_start_state of the model directly
-        stateHist = self.model.createDelayIC(ver = 0)
+        self.model.createIC(ver = 0) # This sets the next_start_state of the model directly
+        self.model.createDelayIC(ver = 0) # This sets the next_start_hE of the model directly
+        
+        # the external inputs, as one serial input and as one input per block
+        external = self._external(stim, sim_len)
+        serialExternal = external.reshape(external.shape[:-1] + (num_blocks, block_len))
+        blockExternal = serialExternal.permute(2, 0, 1, 3) # blocks x nodes x steps_per_TR x block_len
+        window_sim_time = sim_len * self.model.steps_per_TR * float(self.model.step_size)
         
         for e in range(num_epochs):
-            print("epoch: ", e)
+            epoch_start = time.perf_counter()
             
             # TRAINING_STATS: placeholders for the history of trainingStats
             loss_his = []  # loss placeholder to take the average for the epoch at the end of the epoch
@@ -88,64 +143,71 @@ class FittingFNGFPG(AbstractFitting):
                     # initial state
                     firstIC = self.model.createIC(ver = 0)
                     # initials of history of E
-                    delayHist = self.model.createDelayIC(ver = 0) #TODO: Delays are currently is not implemented in various places
+                    delayHist = self.model.createDelayIC(ver = 0)
                 else:
                     firstIC = self.model.next_start_state
-                    delayHist = torch.tensor(1.0, device = self.device) # TODO: Delays are currently is not implemented in various places
-
-                # initial the external inputs
-                external = torch.tensor([0], device = self.device) # TODO: Currenlty this code only works for resting state
+                    delayHist = self.model.next_start_hE
                 
-                num_blocks = int(self.model.sim_len/block_len)
-            
-                ## Noise for the epoch (which has 1 batch)
+                ## Noise for the epoch, as one serial run and as blocks holding the same values
                 [serialNoise, blockNoise] = self.model.genNoise(block_len)
-
-                with torch.no_grad():
-                    sim_vals, delayHist = self.model.forward(external, firstIC, delayHist, serialNoise)
+                serialNoise = serialNoise.to(self.device)
+                
+                X = firstIC.to(self.device)
+                hE = DelayBuffer(delayHist.to(self.device))
+                blockICs = []
+                blockHists = []
+                serialVals = {simKey: [] for simKey in self.model.recordNames()}
+                with torch.no_grad(), self.telemetry.phase('serial'):
+                    for block in range(num_blocks):
+                        # The state and delay history at the start of every block
+                        blockICs.append(X)
+                        blockHists.append(hE.toTensor())
+                        sim_vals, hE = self.model.forward(serialExternal[..., block, :], X, hE, 
+                                                          serialNoise[..., block * block_len:(block + 1) * block_len])
+                        X = sim_vals['current_state']
+                        for simKey in serialVals:
+                            serialVals[simKey].append(sim_vals[simKey])
+                nextIC = X
+                nextHist = hE.toTensor()
                 
                 # Saving last Serial Run for Confirming it matches the Block Run
                 if e == (num_epochs - 1):
                     lastSerial = {}
-                    for simKey in set(self.model.state_names + self.model.output_names):
-                        lastSerial[simKey] = Timeseries(sim_vals[simKey].detach().cpu().numpy().copy(), step_size = self.model.step_size) 
-
-                print("Serial Finished")
+                    for simKey in self.model.recordNames():
+                        lastSerial[simKey] = Timeseries(torch.cat(serialVals[simKey], dim = -1).cpu(), step_size = self.model.step_size) 
     
                 # STEP 2/2 FPG (Forward in "Parallel" with Gradients)
-                # Using initial conditions acquired for serial run and with the same noise
+                # Using initial conditions and delay histories acquired for serial run and with the same noise and stimulus
                 
-                #print(blockNoise['E'].shape) # Time x Nodes x Blocks
-                newICs = torch.zeros(self.model.node_size, len(self.model.state_names), num_blocks).to(self.device) # nodes x state_variables x blocks
-                idx = 0
-                for name in (self.model.state_names): #WARNING: Cannot use set() here as it does not preserve order, also this code assumes order of model.state_names is correct
-                    newICs[:, idx, :] = sim_vals[name][:,(int(block_len/self.model.step_size)-1)::int(block_len/self.model.step_size)]
-                    idx += 1
-                ICs = torch.cat((firstIC, newICs), dim = 2)
-                newICs = ICs[:,:,0:num_blocks] #This gets rid of the last state, for which would be the IC of the next forward() call
-                nextICs = ICs[:,:,[-1]] #Brackets are to keep the dimension
-
-                self.model.setBlocks(num_blocks)
-                self.model.next_start_state = newICs
-                sim_vals, delayHist = self.model.forward(external, newICs, delayHist, blockNoise)
-                self.model.next_start_state = nextICs #TODO: Update to deal with delays as well
-                
-                print("Blocked Finished")
+                newICs = torch.stack(blockICs) # blocks x nodes x state_variables
+                newHists = torch.stack(blockHists) # blocks x nodes x delays_max
                 
+                self.model.setBlocks(num_blocks)
+                with self.telemetry.phase('forward'):
+                    sim_vals, _ = self.model.forward(blockExternal, newICs, newHists, blockNoise.to(self.device))
+                    # blocks x nodes x block_len back to nodes x sim_len
+                    sim_vals = {simKey: sim_vals[simKey].permute(1, 0, 2).reshape(sim_vals[simKey].shape[1], -1) 
+                                for simKey in self.model.recordNames()}
+                self.model.next_start_state = nextIC
+                self.model.next_start_hE = nextHist
                 
                 # calculating loss
-                loss = self.cost.loss(sim_vals, empData)
+                with self.telemetry.phase('loss'):
+                    loss = self._loss(sim_vals, self._target(empData))
                 
                 optim.zero_grad()
-                loss.backward()
-                optim.step()
+                with self.telemetry.phase('backward'):
+                    loss.backward()
+                with self.telemetry.phase('step'):
+                    optim.step()
                 
-                print("Params Updated")
+                self.telemetry.window(window_sim_time, epoch = e, num_blocks = num_blocks, loss = loss.detach())
                                                 
                 # TRAINING_STATS: Adding Loss for every training backpropagation
                 loss_his.append(loss.detach().cpu().numpy().copy())
                 
             self.trainingStats.appendLoss(np.mean(loss_his))
+            self.telemetry.event('epoch', epoch = e, loss = self.trainingStats.loss[-1], seconds = time.perf_counter() - epoch_start)
             trackedParams = {}
             if(self.model.track_params):
                 for parKey in self.model.track_params:
@@ -157,8 +219,8 @@ class FittingFNGFPG(AbstractFitting):
         # Saving the last recording of training as a Model_fitting attribute
         self.lastSerial = lastSerial
         self.lastRec = {}
-        for simKey in set(self.model.state_names + self.model.output_names):
-            self.lastRec[simKey] = Timeseries(sim_vals[simKey].detach().cpu().numpy().copy(), step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
+        for simKey in self.model.recordNames():
+            self.lastRec[simKey] = Timeseries(sim_vals[simKey].detach().cpu(), step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
         
         
     def evaluate(self, stim, empData):
@@ -0,0 +1,212 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for data-parallel model fitting across processes, with torch.distributed
+"""
+
+import os
+import pickle
+import socket
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from .model_fitting import ModelFitting
+from .telemetry import Telemetry
+
+
+class DistributedFitting(ModelFitting):
+    """
+    This class trains a model as ModelFitting does, in every process of a torch.distributed process group (e.g. with the gloo
+    backend, on the cores of one machine), averaging the gradients of every parameter update across the processes (ranks)
+    before the Adam steps on params_fitted['modelparameter'] and params_fitted['hyperparameter'].
+
+    The gradient of a window then comes from world_size noise realisations (or recordings) instead of one, at the wall time of one.
+    Each rank runs its own copy of the model, from the parameters of rank 0, so that all ranks keep the same parameters throughout.
+
+    The training is split across the ranks in one of two ways:
+        - 'noise': every rank fits all the recordings, with its own noise realisation (the noise seed plus the rank)
+        - 'recordings': every rank fits its own subset of the recordings (every world_size-th one), which should all have the
+          same number of windows, as the ranks update the parameters in lockstep
+
+    Most simply, fitDistributed runs the training in world_size processes started on this machine.
+    Otherwise, the process group is initialized by the caller (e.g. with torchrun) before creating this class.
+
+    Attributes
+    ----------
+    rank : int
+        The rank of this process
+    world_size : int
+        The number of processes
+    split : str
+        How the training is split across the ranks: 'noise' or 'recordings'
+    """
+
+    def __init__(self, model, cost, device = torch.device('cpu'), split: str = 'noise', warm_cache = None, telemetry: Telemetry = None):
+        """
+        Parameters
+        ----------
+        model: AbstractNMM
+            Whole Brain Model to Simulate
+        cost: AbstractLoss
+            A particular objective function which the model will be optimized for.
+        device : torch.device
+            Whether the fitting is to run on CPU or GPU
+        split : str
+            How the training is split across the ranks: 'noise' or 'recordings'
+        warm_cache : WarmStateCache
+            If given, the cache of the warm-up state (see ModelFitting)
+        telemetry : Telemetry
+            Where the timings, losses and diagnostics of the fitting are sent. Defaults to printing on rank 0 only.
+        """
+
+        if not dist.is_initialized():
+            raise RuntimeError("DistributedFitting needs an initialized torch.distributed process group (see fitDistributed).")
+        if split not in ['noise', 'recordings']:
+            raise ValueError(f"split should be 'noise' or 'recordings', but got {split} instead.")
+
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.split = split
+        if telemetry is None and self.rank != 0:
+            telemetry = Telemetry(sinks = [])
+
+        super(DistributedFitting, self).__init__(model, cost, device = device, warm_cache = warm_cache, telemetry = telemetry)
+
+    def _fittedParameters(self):
+        return self.model.params_fitted['modelparameter'] + self.model.params_fitted['hyperparameter']
+
+    def broadcastParameters(self):
+        """
+        Sets the fitted parameters of every rank to those of rank 0.
+        """
+
+        with torch.no_grad():
+            for param in self._fittedParameters():
+                dist.broadcast(param.data, src = 0)
+
+    def _reduceGradients(self):
+        # Averages the gradients across the ranks, in one all-reduce of all the parameters
+        params = [param for param in self._fittedParameters() if param.grad is not None]
+        if not params:
+            return
+        flat = torch.cat([param.grad.reshape(-1) for param in params])
+        dist.all_reduce(flat, op = dist.ReduceOp.SUM)
+        flat /= self.world_size
+        offset = 0
+        for param in params:
+            numel = param.grad.numel()
+            param.grad.copy_(flat[offset:offset + numel].view_as(param.grad))
+            offset += numel
+
+    def _rankFile(self, filename):
+        # Each rank saves and resumes its own training state, which holds its own noise state
+        return f"{filename}.rank{self.rank}"
+
+    def saveTrainState(self, filename, *args, **kwargs):
+        super(DistributedFitting, self).saveTrainState(self._rankFile(filename), *args, **kwargs)
+
+    def loadTrainState(self, filename, *args, **kwargs):
+        return super(DistributedFitting, self).loadTrainState(self._rankFile(filename), *args, **kwargs)
+
+    def train(self, u, empRecs: list, num_epochs: int, TPperWindow: int, noise_seed: int = None, **kwargs):
+        """
+        Trains the model in this rank, as ModelFitting.train, averaging the gradients across the ranks.
+        Every rank should call it, with the same arguments.
+
+        Parameters
+        ----------
+        u: int or Tensor
+            The stimulus (see ModelFitting.train)
+        empRecs: list of Recording
+            All the recordings. With split 'recordings', this rank fits every world_size-th one, from the rank-th one.
+        num_epochs: int
+            the number of times to go through the entire training data set
+        TPperWindow: int
+            Number of Empirical Time Points per window.
+        noise_seed: int
+            The noise seed of rank 0; rank r uses noise_seed + r. If None, rank 0 draws one, and shares it with the other ranks.
+        **kwargs
+            Other arguments of ModelFitting.train (early_stopping is not supported, as the ranks see different losses)
+        """
+
+        if kwargs.get('early_stopping') is not None:
+            raise ValueError("early_stopping is not supported by DistributedFitting, as the ranks see different losses.")
+
+        if self.split == 'recordings':
+            # The ranks update the parameters in lockstep, so all of them should fit as many windows
+            if len(empRecs) % self.world_size != 0:
+                raise ValueError(f"With split 'recordings', the number of recordings ({len(empRecs)}) should be a multiple of world_size ({self.world_size}).")
+            if len(set(int(empRec.length / TPperWindow) for empRec in empRecs)) > 1:
+                raise ValueError("With split 'recordings', all the recordings should have the same number of windows.")
+            empRecs = empRecs[self.rank::self.world_size]
+
+        if noise_seed is None:
+            seed = torch.randint(0, 2**31 - 1, (1,)) if self.rank == 0 else torch.zeros(1, dtype = torch.int64)
+            dist.broadcast(seed, src = 0)
+            noise_seed = int(seed)
+
+        self.broadcastParameters()
+        super(DistributedFitting, self).train(u, empRecs, num_epochs, TPperWindow, noise_seed = noise_seed + self.rank, **kwargs)
+
+
+def _freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _fitWorker(rank, world_size, port, threads_per_rank, model, cost, u, empRecs, split, train_args, result_file):
+    # Trains in one process of the group, and writes the fitting object of rank 0 to result_file
+
+    torch.set_num_threads(threads_per_rank)
+    dist.init_process_group('gloo', init_method = f"tcp://127.0.0.1:{port}", rank = rank, world_size = world_size)
+    try:
+        fit = DistributedFitting(model, cost, split = split)
+        fit.train(u, empRecs, **train_args)
+        dist.barrier()
+        if rank == 0:
+            fit.telemetry = Telemetry()
+            fit.save(result_file)
+    finally:
+        dist.destroy_process_group()
+
+
+def fitDistributed(model, cost, u, empRecs, world_size: int, split: str = 'noise', threads_per_rank: int = None, **train_args):
+    """
+    Trains a model with DistributedFitting in world_size processes on this machine, connected with the gloo backend.
+
+    Parameters
+    ----------
+    model: AbstractNMM
+        Whole Brain Model to Simulate (copied to every process)
+    cost: AbstractLoss
+        A particular objective function which the model will be optimized for.
+    u: int or Tensor
+        The stimulus (see ModelFitting.train)
+    empRecs: list of Recording
+        The recordings (see DistributedFitting.train)
+    world_size: int
+        The number of processes
+    split : str
+        How the training is split across the processes: 'noise' or 'recordings'
+    threads_per_rank : int
+        The number of PyTorch threads of each process. Defaults to the number of CPUs divided by world_size.
+    **train_args
+        Arguments of DistributedFitting.train (other than u and empRecs), e.g. num_epochs, TPperWindow and noise_seed
+
+    Returns
+    -------
+    DistributedFitting
+        The fitting object of rank 0, with its trainingStats and the fitted model (shared by all the ranks)
+    """
+
+    if threads_per_rank is None:
+        threads_per_rank = max(1, os.cpu_count() // world_size)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'fit.pkl')
+        mp.spawn(_fitWorker, args = (world_size, _freePort(), threads_per_rank, model, cost, u, empRecs, split, train_args, result_file),
+                 nprocs = world_size, join = True)
+        with open(result_file, 'rb') as f:
+            return pickle.load(f)
@@ -0,0 +1,231 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for convergence monitoring and early stopping
+"""
+
+import math
+
+import numpy as np
+import torch
+
+
+class EarlyStopping:
+    """
+    This class monitors the convergence of ModelFitting.train at the end of every epoch, and stops the training when it
+    has plateaued or diverged.
+
+    Every epoch it tracks the mean training loss, the largest relative change of the tracked parameters (model.track_params),
+    and, if a held-out recording is given, a validation metric computed with ModelFitting.evaluate.
+    The score is the validation metric (higher is better) if there is one, and the training loss (lower is better) otherwise.
+
+    The training stops on a plateau, when the score has not improved by more than min_delta (relative) for patience epochs,
+    or when the tracked parameters have changed by less than param_tol (relative) for patience epochs.
+    It also stops on divergence, when the loss is not finite or exceeds divergence_factor times the best loss.
+    The parameters of the best epoch are kept, and optionally restored at the end of the training.
+
+    Attributes
+    ----------
+    patience : int
+        The number of epochs without improvement before stopping
+    min_delta : float
+        The smallest relative improvement of the score that counts as an improvement
+    param_tol : float
+        The relative parameter change below which the parameters count as converged (None to not use this criterion)
+    divergence_factor : float
+        The factor over the best loss above which the training counts as diverged (None to only stop on non-finite losses)
+    validation : dict
+        The arguments of ModelFitting.evaluate for the held-out data (u, empRec, TPperWindow, ...), or None
+    val_metric : str
+        The key of the validation metric returned by ModelFitting.evaluate: 'FC_cor' or 'cos_sim'
+    restore_best : bool
+        Whether to restore the parameters of the best epoch at the end of the training
+    history : list of dict
+        The loss, parameter change, validation metric and score of every epoch
+    best_epoch : int
+        The epoch with the best score
+    best_score : float
+        The best score, as a value to minimize
+    stop_reason : str
+        Why the training stopped ('plateau', 'parameters converged' or 'diverged'), or None
+    """
+
+    def __init__(self, patience: int = 5, min_delta: float = 1e-3, param_tol: float = None, divergence_factor: float = 10.0,
+                 validation: dict = None, val_metric: str = 'cos_sim', restore_best: bool = True):
+        """
+        Parameters
+        ----------
+        patience : int
+            The number of epochs without improvement before stopping
+        min_delta : float
+            The smallest relative improvement of the score that counts as an improvement
+        param_tol : float
+            The relative parameter change below which the parameters count as converged (None to not use this criterion)
+        divergence_factor : float
+            The factor over the best loss above which the training counts as diverged (None to only stop on non-finite losses)
+        validation : dict
+            The arguments of ModelFitting.evaluate for the held-out data (u, empRec, TPperWindow, ...), or None
+        val_metric : str
+            The key of the validation metric returned by ModelFitting.evaluate: 'FC_cor' or 'cos_sim'
+        restore_best : bool
+            Whether to restore the parameters of the best epoch at the end of the training
+        """
+
+        self.patience = patience
+        self.min_delta = min_delta
+        self.param_tol = param_tol
+        self.divergence_factor = divergence_factor
+        self.validation = validation
+        self.val_metric = val_metric
+        self.restore_best = restore_best
+
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the monitor to a pre-training state.
+        """
+
+        self.history = []
+        self.best_epoch = None
+        self.best_score = math.inf
+        self.best_loss = math.inf
+        self.best_params = None
+        self.stop_reason = None
+        self._epochs_no_improvement = 0
+        self._epochs_params_converged = 0
+
+    def stateDict(self):
+        """
+        Returns
+        -------
+        dict
+            The state of the monitor (history, counters and best epoch), which ModelFitting.saveTrainState saves with the
+            training state, so that a resumed training keeps its patience count
+        """
+
+        return {'history': list(self.history), 'best_epoch': self.best_epoch, 'best_score': self.best_score,
+                'best_loss': self.best_loss, 'best_params': self.best_params, 'stop_reason': self.stop_reason,
+                'epochs_no_improvement': self._epochs_no_improvement, 'epochs_params_converged': self._epochs_params_converged}
+
+    def loadStateDict(self, state):
+        """
+        Parameters
+        ----------
+        state : dict
+            A state of the monitor returned by stateDict
+        """
+
+        self.history = list(state['history'])
+        self.best_epoch = state['best_epoch']
+        self.best_score = state['best_score']
+        self.best_loss = state['best_loss']
+        self.best_params = state['best_params']
+        self.stop_reason = state['stop_reason']
+        self._epochs_no_improvement = state['epochs_no_improvement']
+        self._epochs_params_converged = state['epochs_params_converged']
+
+    def _paramDelta(self, trainingStats):
+        # The largest relative change of the tracked parameters over the last epoch
+        delta = None
+        for name in trainingStats.track_params:
+            values = trainingStats.fit_params.get(name, [])
+            if len(values) < 2:
+                continue
+            old = np.asarray(values[-2], dtype = float)
+            new = np.asarray(values[-1], dtype = float)
+            change = float(np.max(np.abs(new - old) / (np.abs(old) + 1e-8)))
+            delta = change if delta is None else max(delta, change)
+        return delta
+
+    def _validate(self, fit):
+        # Computes the validation metric, leaving the last recording and the random streams of the training untouched
+        # (evaluate draws initial conditions from numpy's global generator, and may reseed the noise), so that
+        # a training with early stopping follows the same random streams as one without, and resumes exactly
+        lastRec = fit.lastRec
+        noise_state = fit.model.noise.getState()
+        numpy_state = np.random.get_state()
+        torch_state = torch.get_rng_state()
+        try:
+            with torch.no_grad():
+                metrics = fit.evaluate(**self.validation)
+        finally:
+            np.random.set_state(numpy_state)
+            torch.set_rng_state(torch_state)
+            fit.model.noise.setState(noise_state)
+            fit.lastRec = lastRec
+        return metrics[self.val_metric]
+
+    def _saveBest(self, fit):
+        self.best_params = {'params_fitted': {group: [param.detach().clone() for param in params]
+                                              for group, params in fit.model.params_fitted.items()},
+                            'model_state': {key: value.detach().clone() for key, value in fit.model.state_dict().items()}}
+
+    def update(self, fit, epoch):
+        """
+        Records the end of an epoch of training.
+
+        Parameters
+        ----------
+        fit : ModelFitting
+            The fitting object, whose trainingStats has the loss and parameters of the epoch
+        epoch : int
+            The epoch which ended
+
+        Returns
+        -------
+        bool
+            Whether the training should stop
+        """
+
+        loss = fit.trainingStats.loss[-1]
+        param_delta = self._paramDelta(fit.trainingStats)
+        val = self._validate(fit) if self.validation is not None else None
+        score = -val if val is not None else loss
+
+        self.history.append({'epoch': epoch, 'loss': loss, 'param_delta': param_delta, 'val_metric': val, 'score': score})
+
+        # Divergence
+        if not math.isfinite(loss) or (val is not None and not math.isfinite(val)) or \
+           (self.divergence_factor is not None and math.isfinite(self.best_loss) and self.best_loss > 0 and
+            loss > self.divergence_factor * self.best_loss):
+            self.stop_reason = 'diverged'
+            return True
+        self.best_loss = min(self.best_loss, loss)
+
+        # Plateau of the score
+        if score < self.best_score - self.min_delta * abs(self.best_score) or self.best_epoch is None:
+            self.best_score = score
+            self.best_epoch = epoch
+            self._saveBest(fit)
+            self._epochs_no_improvement = 0
+        else:
+            self._epochs_no_improvement += 1
+        if self._epochs_no_improvement >= self.patience:
+            self.stop_reason = 'plateau'
+            return True
+
+        # Convergence of the parameters
+        if self.param_tol is not None and param_delta is not None:
+            self._epochs_params_converged = self._epochs_params_converged + 1 if param_delta < self.param_tol else 0
+            if self._epochs_params_converged >= self.patience:
+                self.stop_reason = 'parameters converged'
+                return True
+
+        return False
+
+    def finish(self, fit):
+        """
+        Ends the monitoring of a training, restoring the parameters of the best epoch if restore_best is set.
+
+        Parameters
+        ----------
+        fit : ModelFitting
+            The fitting object
+        """
+
+        if self.restore_best and self.best_params is not None:
+            with torch.no_grad():
+                for group, params in fit.model.params_fitted.items():
+                    for param, value in zip(params, self.best_params['params_fitted'][group]):
+                        param.copy_(value)
+            fit.model.load_state_dict(self.best_params['model_state'])
@@ -0,0 +1,452 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for gradient-free (evolutionary) model fitting with batched simulations
+"""
+
+import math
+import time
+
+import numpy as np
+import torch
+
+from ..datatypes import AbstractFitting, TrainingStats, Parameter as par
+from .telemetry import Telemetry
+
+
+class _CMAES:
+    # Covariance Matrix Adaptation Evolution Strategy (Hansen's (mu/mu_w, lambda)-CMA-ES), minimizing in a space of dim dimensions
+    # where the search starts from the origin with a unit step size
+
+    def __init__(self, dim, popsize, sigma0, rng):
+        self.dim = dim
+        self.popsize = popsize
+        self.rng = rng
+
+        self.mu = popsize // 2
+        weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mueff = 1 / np.sum(self.weights ** 2)
+
+        self.cc = (4 + self.mueff / dim) / (dim + 4 + 2 * self.mueff / dim)
+        self.cs = (self.mueff + 2) / (dim + self.mueff + 5)
+        self.c1 = 2 / ((dim + 1.3) ** 2 + self.mueff)
+        self.cmu = min(1 - self.c1, 2 * (self.mueff - 2 + 1 / self.mueff) / ((dim + 2) ** 2 + self.mueff))
+        self.damps = 1 + 2 * max(0, math.sqrt((self.mueff - 1) / (dim + 1)) - 1) + self.cs
+        self.chiN = math.sqrt(dim) * (1 - 1 / (4 * dim) + 1 / (21 * dim ** 2))
+
+        self.mean = np.zeros(dim)
+        self.sigma = sigma0
+        self.C = np.eye(dim)
+        self.B = np.eye(dim)
+        self.D = np.ones(dim)
+        self.pc = np.zeros(dim)
+        self.ps = np.zeros(dim)
+        self.generation = 0
+
+    def ask(self):
+        z = self.rng.standard_normal((self.popsize, self.dim))
+        return self.mean + self.sigma * (z * self.D) @ self.B.T
+
+    def tell(self, x, fitness):
+        order = np.argsort(fitness)
+        x_best = x[order[:self.mu]]
+        self.generation += 1
+
+        mean_old = self.mean
+        self.mean = self.weights @ x_best
+        y_w = (self.mean - mean_old) / self.sigma
+
+        invsqrtC = self.B @ np.diag(1 / self.D) @ self.B.T
+        self.ps = (1 - self.cs) * self.ps + math.sqrt(self.cs * (2 - self.cs) * self.mueff) * invsqrtC @ y_w
+        hsig = np.linalg.norm(self.ps) / math.sqrt(1 - (1 - self.cs) ** (2 * self.generation)) / self.chiN < 1.4 + 2 / (self.dim + 1)
+        self.pc = (1 - self.cc) * self.pc + hsig * math.sqrt(self.cc * (2 - self.cc) * self.mueff) * y_w
+
+        y = (x_best - mean_old) / self.sigma
+        self.C = ((1 - self.c1 - self.cmu) * self.C
+                  + self.c1 * (np.outer(self.pc, self.pc) + (1 - hsig) * self.cc * (2 - self.cc) * self.C)
+                  + self.cmu * (y.T * self.weights) @ y)
+        self.sigma *= math.exp((self.cs / self.damps) * (np.linalg.norm(self.ps) / self.chiN - 1))
+
+        self.C = (self.C + self.C.T) / 2
+        eigenvalues, self.B = np.linalg.eigh(self.C)
+        self.D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+
+    def center(self):
+        return self.mean
+
+
+class _DifferentialEvolution:
+    # Differential evolution (DE/rand/1/bin), minimizing in a space of dim dimensions, from a standard normal initial population
+
+    def __init__(self, dim, popsize, sigma0, rng, F = 0.8, CR = 0.9):
+        self.dim = dim
+        self.popsize = max(popsize, 4)
+        self.rng = rng
+        self.F = F
+        self.CR = CR
+        self.sigma = sigma0
+
+        self.population = sigma0 * rng.standard_normal((self.popsize, dim))
+        self.fitness = None
+
+    def ask(self):
+        if self.fitness is None:
+            return self.population.copy()
+        trials = np.empty_like(self.population)
+        for i in range(self.popsize):
+            a, b, c = self.rng.choice([j for j in range(self.popsize) if j != i], 3, replace = False)
+            mutant = self.population[a] + self.F * (self.population[b] - self.population[c])
+            cross = self.rng.random(self.dim) < self.CR
+            cross[self.rng.integers(self.dim)] = True
+            trials[i] = np.where(cross, mutant, self.population[i])
+        return trials
+
+    def tell(self, x, fitness):
+        if self.fitness is None:
+            self.population, self.fitness = x.copy(), fitness.copy()
+            return
+        better = fitness <= self.fitness
+        self.population[better] = x[better]
+        self.fitness[better] = fitness[better]
+
+    def center(self):
+        return self.population[np.argmin(self.fitness)]
+
+
+class EvolutionaryFitting(AbstractFitting):
+    """
+    This class fits the parameters of a model without gradients, with CMA-ES or differential evolution, as an alternative to
+    ModelFitting.train where the gradient descent gets stuck in local minima.
+
+    The search is over the values (val) of every Parameter fitted by the model (fit_par), except the leadfield (lm).
+    It starts from the priors: each value is searched in units of its prior standard deviation (1/sqrt(prior_precision))
+    around its prior mean (or, without priors, in units of a tenth of its magnitude around its current value).
+
+    Every generation is evaluated in batched simulations without gradients, one candidate per simulation of the batch
+    (see batchParamValue of the model), sharing the same initial conditions and noise, so that the candidates are ranked
+    on their parameters rather than on their noise. The initial conditions are drawn once per training, and shared by all
+    the generations. The fitness of a candidate is the main loss of the objective function (the loss, or the second value 
+    it returns, e.g. the data term of CostsJR), averaged over all the windows of all the recordings.
+
+    The best loss and the parameters of the best candidate of every generation are kept in trainingStats.
+    As each generation sees one noise realisation, its lowest fitness is biased low. At the end of training, the center of the
+    search (the mean of CMA-ES, or the best member of the population of differential evolution) and the best candidate of every
+    generation are therefore evaluated again on common noise, and the model parameters are set to the best of them.
+
+    Attributes
+    ----------
+    model: AbstractNMM
+        Whole Brain Model to Simulate
+    cost: AbstractLoss
+        The objective function giving the fitness of a candidate
+    method: str
+        'cmaes' or 'de' (differential evolution)
+    popsize: int
+        The number of candidates of every generation
+    max_batch: int
+        The largest number of candidates simulated at once
+    trainingStats: TrainingStats
+        The best loss and its parameters over the generations
+    best_fitness: float
+        The fitness of the final parameters, evaluated on common noise at the end of training
+    best_params: dict
+        The values (val) of the final fitted parameters
+    device : torch.device
+        Whether the fitting is to run on CPU or GPU
+    telemetry : Telemetry
+        Where the timings and losses of the fitting are sent
+    """
+
+    def __init__(self, model, cost, device = torch.device('cpu'), method: str = 'cmaes', popsize: int = None, max_batch: int = None,
+                 telemetry: Telemetry = None):
+        """
+        Parameters
+        ----------
+        model: AbstractNMM
+            Whole Brain Model to Simulate
+        cost: AbstractLoss
+            The objective function giving the fitness of a candidate
+        device : torch.device
+            Whether the fitting is to run on CPU or GPU
+        method: str
+            'cmaes' or 'de' (differential evolution)
+        popsize: int
+            The number of candidates of every generation. Defaults to 4 + 3 log(number of searched values) for CMA-ES,
+            and 10 times the number of searched values for differential evolution.
+        max_batch: int
+            The largest number of candidates simulated at once (all of them by default), to bound the memory used
+        telemetry : Telemetry
+            Where the timings and losses of the fitting are sent
+        """
+
+        if method not in ['cmaes', 'de']:
+            raise ValueError(f"method should be 'cmaes' or 'de', but got {method} instead.")
+
+        self.model = model
+        self.cost = cost
+        self.device = device
+        self.method = method
+
+        self.searched = []
+        var_names = [a for a in dir(self.model.params) if type(getattr(self.model.params, a)) == par]
+        for var_name in var_names:
+            var = getattr(self.model.params, var_name)
+            if var.fit_par and var_name != 'lm':
+                self.searched.append((var_name, var))
+        if not self.searched:
+            raise ValueError("The model has no fitted parameters (fit_par) to search.")
+        self.dim = sum(var.val.numel() for var_name, var in self.searched)
+
+        if popsize is None:
+            popsize = 4 + int(3 * math.log(self.dim)) if method == 'cmaes' else 10 * self.dim
+        self.popsize = popsize
+        self.max_batch = max_batch if max_batch is not None else popsize
+
+        self.trainingStats = TrainingStats(self.model)
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.lastRec = None
+        self.best_fitness = math.inf
+        self.best_params = None
+
+    def _searchScale(self):
+        # The center and scale of the search space of every searched value, from the priors
+        centers = []
+        scales = []
+        for var_name, var in self.searched:
+            val = var.val.detach()
+            if var.fit_hyper:
+                center = var.prior_mean.detach().expand_as(val)
+                scale = (1 / torch.sqrt(var.prior_precision.detach())).expand_as(val)
+            else:
+                center = val
+                scale = 0.1 * val.abs() + 1e-3
+            centers.append(center.reshape(-1).cpu().double().numpy())
+            scales.append(scale.reshape(-1).cpu().double().numpy())
+        return np.concatenate(centers), np.concatenate(scales)
+
+    def _toValues(self, thetas):
+        # Splits candidates (num_candidates x dim) into the values (val) of every searched parameter (num_candidates x shape of val)
+        values = {}
+        offset = 0
+        for var_name, var in self.searched:
+            numel = var.val.numel()
+            theta = torch.as_tensor(thetas[:, offset:offset + numel], dtype = var.val.dtype, device = var.val.device)
+            values[var_name] = theta.reshape((thetas.shape[0],) + tuple(var.val.shape))
+            offset += numel
+        return values
+
+    def _trackedParams(self, values, idx):
+        # The values of the tracked parameters (as returned by Parameter.value()) of one candidate
+        trackedParams = {}
+        for var_name, var in self.searched:
+            if var_name in self.model.track_params:
+                val = values[var_name][idx]
+                value = var.lb + (torch.exp(val) if var.asLog else val)
+                trackedParams[var_name] = value.cpu().numpy().copy()
+        return trackedParams
+
+    def _mainLoss(self, sim, emp):
+        loss = self.cost.loss(sim, emp)
+        if isinstance(loss, tuple):
+            loss = loss[1]
+        return float(loss)
+
+    def evaluateCandidates(self, u, empRecs: list, TPperWindow: int, values: dict, warmupWindow: int = 10, noise_seed: int = None,
+                           initial_state: tuple = None):
+        """
+        Computes the fitness of candidate parameter values, in batched simulations without gradients.
+
+        Parameters
+        ----------
+        u: int or Tensor
+            The stimulus, as for ModelFitting.train
+        empRecs: list of Recording
+            The recordings the candidates are fitted to
+        TPperWindow: int
+            Number of Empirical Time Points per window (the TRs_per_window of the model)
+        values: dict
+            For every searched parameter, the values (val) of the candidates (num_candidates x shape of val)
+        warmupWindow: int
+            The number of windows simulated before the first recording
+        noise_seed: int
+            If given, the seed of the noise shared by all the candidates
+        initial_state: tuple
+            The initial conditions (X, hE) shared by all the candidates, as created by model.createIC and model.createDelayIC.
+            If None, new ones are drawn.
+
+        Returns
+        -------
+        numpy array
+            The fitness of every candidate (inf for a diverged simulation)
+        """
+
+        num_candidates = next(iter(values.values())).shape[0]
+        windowedTSs = [empRec.windowedTensor(TPperWindow).to(self.device, self.model.dtype_policy.compute) for empRec in empRecs]
+        no_external = torch.zeros(self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window, device = self.device)
+        if not isinstance(u, int):
+            u = torch.as_tensor(u, dtype = self.model.dtype_policy.compute, device = self.device)
+
+        # The same initial conditions (and noise) for all the candidates
+        if initial_state is None:
+            initial_state = (self.model.createIC(ver = 0), self.model.createDelayIC(ver = 0))
+        X0 = initial_state[0].to(self.device)
+        hE0 = initial_state[1].to(self.device)
+        noise_state = self.model.noise.getState()
+        noise_shape = (3, 1, self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window)
+
+        fitness = np.zeros(num_candidates)
+        saved = {var_name: var.val for var_name, var in self.searched}
+        try:
+            for start in range(0, num_candidates, self.max_batch):
+                stop = min(start + self.max_batch, num_candidates)
+                n = stop - start
+                for var_name, var in self.searched:
+                    var.val = values[var_name][start:stop]
+
+                if noise_seed is not None:
+                    self.model.noise.reset(noise_seed)
+                else:
+                    self.model.noise.setState(noise_state)
+                X = X0.expand((n,) + tuple(X0.shape)).clone()
+                hE = hE0.expand((n,) + tuple(hE0.shape)).clone()
+                losses = np.zeros(n)
+                num_windows = 0
+                with torch.no_grad():
+                    for win_idx in range(warmupWindow):
+                        noise = self.model.noise.sample(noise_shape).to(self.device).expand(3, n, *noise_shape[2:])
+                        next_window, hE = self.model.forward(no_external, X, hE, noise)
+                        X = next_window['current_state']
+
+                    for windowedTS in windowedTSs:
+                        for win_idx in range(windowedTS.shape[0]):
+                            external = no_external
+                            if not isinstance(u, int):
+                                external = u[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]
+                            noise = self.model.noise.sample(noise_shape).to(self.device).expand(3, n, *noise_shape[2:])
+                            next_window, hE = self.model.forward(external, X, hE, noise)
+                            X = next_window['current_state']
+                            for k in range(n):
+                                sim = {name: next_window[name][k] for name in self.model.recordNames()}
+                                losses[k] += self._mainLoss(sim, windowedTS[win_idx])
+                            num_windows += 1
+
+                fitness[start:stop] = losses / max(num_windows, 1)
+        finally:
+            for var_name, var in self.searched:
+                var.val = saved[var_name]
+
+        fitness[~np.isfinite(fitness)] = np.inf
+        return fitness
+
+    def train(self, u, empRecs: list, num_generations: int, TPperWindow: int, warmupWindow: int = 10, sigma0: float = 1.0,
+              noise_seed: int = None, seed: int = None, F: float = 0.8, CR: float = 0.9):
+        """
+        Parameters
+        ----------
+        u: int or Tensor
+            The stimulus, as for ModelFitting.train
+        empRecs: list of Recording
+            The recordings the model is fitted to
+        num_generations: int
+            The number of generations
+        TPperWindow: int
+            Number of Empirical Time Points per window (the TRs_per_window of the model)
+        warmupWindow: int
+            The number of windows simulated before the first recording, in every simulation
+        sigma0: float
+            The initial step size of the search, in prior standard deviations (for differential evolution, the spread of the initial population)
+        noise_seed: int
+            If given, generation g is simulated with the noise seed noise_seed + g (shared by all its candidates),
+            and the final candidates with noise_seed
+        seed: int
+            The seed of the random numbers of the search
+        F: float
+            The differential weight of differential evolution
+        CR: float
+            The crossover probability of differential evolution
+        """
+
+        rng = np.random.default_rng(seed)
+        if self.method == 'cmaes':
+            search = _CMAES(self.dim, self.popsize, sigma0, rng)
+        else:
+            search = _DifferentialEvolution(self.dim, self.popsize, sigma0, rng, F, CR)
+        center, scale = self._searchScale()
+
+        window_sim_time = self.model.TRs_per_window * self.model.steps_per_TR * float(self.model.step_size)
+        num_windows = warmupWindow + sum(int(empRec.length / TPperWindow) for empRec in empRecs)
+
+        # The initial conditions are drawn once, so that all the generations are simulated from the same state
+        initial_state = (self.model.createIC(ver = 0), self.model.createDelayIC(ver = 0))
+        # The best candidate of every generation, evaluated again at the end of training
+        elites = []
+
+        for generation in range(num_generations):
+            generation_start = time.perf_counter()
+
+            with self.telemetry.phase('step'):
+                z = search.ask()
+                values = self._toValues(center + scale * z)
+
+            with self.telemetry.phase('forward'):
+                fitness = self.evaluateCandidates(u, empRecs, TPperWindow, values, warmupWindow,
+                                                  None if noise_seed is None else noise_seed + generation, initial_state)
+
+            with self.telemetry.phase('step'):
+                search.tell(z, fitness)
+
+            self.telemetry.window(window_sim_time * num_windows * len(z), epoch = generation, loss = float(np.min(fitness)))
+
+            best = int(np.argmin(fitness))
+            elites.append(z[best].copy())
+
+            # TRAINING_STATS: the best loss and parameters of every generation
+            self.trainingStats.appendLoss(float(fitness[best]))
+            self.trainingStats.appendParam(self._trackedParams(values, best))
+
+            finite = fitness[np.isfinite(fitness)]
+            self.telemetry.event('epoch', epoch = generation, loss = float(fitness[best]),
+                                 mean_loss = float(finite.mean()) if len(finite) else float('inf'),
+                                 sigma = float(search.sigma), seconds = time.perf_counter() - generation_start)
+
+        if num_generations == 0:
+            return
+
+        # The model keeps the best of the center of the search and the best candidates of the generations, on common noise
+        finalists = np.stack([search.center()] + elites)
+        values = self._toValues(center + scale * finalists)
+        fitness = self.evaluateCandidates(u, empRecs, TPperWindow, values, warmupWindow, noise_seed, initial_state)
+        best = int(np.argmin(fitness))
+        self.best_fitness = float(fitness[best])
+        self.best_params = {var_name: value[best].clone() for var_name, value in values.items()}
+        self.telemetry.event('evaluate', loss = self.best_fitness)
+
+        with torch.no_grad():
+            for var_name, var in self.searched:
+                var.val.copy_(self.best_params[var_name])
+
+    def evaluate(self, u, empRecs: list, TPperWindow: int, warmupWindow: int = 10, noise_seed: int = None):
+        """
+        Parameters
+        ----------
+        u: int or Tensor
+            The stimulus, as for ModelFitting.train
+        empRecs: list of Recording
+            The recordings the model is compared to
+        TPperWindow: int
+            Number of Empirical Time Points per window (the TRs_per_window of the model)
+        warmupWindow: int
+            The number of windows simulated before the first recording
+        noise_seed: int
+            If given, the seed of the noise
+
+        Returns
+        -------
+        float
+            The fitness (main loss) of the current model parameters
+        """
+
+        values = {var_name: var.val.detach().unsqueeze(0) for var_name, var in self.searched}
+        fitness = float(self.evaluateCandidates(u, empRecs, TPperWindow, values, warmupWindow, noise_seed)[0])
+        self.telemetry.event('evaluate', loss = fitness)
+        return fitness
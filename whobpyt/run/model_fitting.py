@@ -8,9 +8,14 @@ import torch
 import torch.optim as optim
 from ..datatypes import Timeseries as Recording # JG: rename this to just Timeseries
 from ..datatypes import AbstractNeuralModel,AbstractFitting,AbstractLoss
-from ..datatypes import TrainingStats
+from ..datatypes import TrainingStats, WarmStateCache, ConditionResults, TimeseriesStore
 #from whobpyt.models.RWW.RWW_np import RWW_np #This should be removed and made general
 from ..functions.arg_type_check import method_arg_type_check
+from .adjoint import windowAdjoint
+from .early_stopping import EarlyStopping
+from .telemetry import Telemetry
+import time
+import os
 import pickle
 from sklearn.metrics.pairwise import cosine_similarity
 
@@ -36,9 +41,14 @@ class ModelFitting(AbstractFitting):
         The last simulation of fitting(), evaluation(), or simulation()
     device : torch.device
         Whether the fitting is to run on CPU or GPU
+    warmCache : WarmStateCache
+        Cache of the model state after warm-up, reused by train(), evaluate() and simulate() (None for no caching)
+    telemetry : Telemetry
+        Where the timings, losses and diagnostics of the fitting are sent
     """
 
-    def __init__(self, model: AbstractNeuralModel, cost: AbstractLoss, device = torch.device('cpu')):
+    def __init__(self, model: AbstractNeuralModel, cost: AbstractLoss, device = torch.device('cpu'), warm_cache: WarmStateCache = None,
+                 telemetry: Telemetry = None):
         """
         Parameters
         ----------
@@ -48,6 +58,12 @@ class ModelFitting(AbstractFitting):
             A particular objective function which the model will be optimized for. 
         device : torch.device
             Whether the fitting is to run on CPU or GPU
+        warm_cache : WarmStateCache
+            If given, the state after the warm-up windows of train(), and after the base windows of evaluate() and simulate(),
+            is cached, and restored instead of recomputed when the model parameters, SC and noise seed match.
+        telemetry : Telemetry
+            Where the timings, losses and diagnostics of the fitting are sent. Defaults to a Telemetry printing one line per
+            recording and epoch (with the pseudo FC correlation and cosine similarity of each recording).
         """
         method_arg_type_check(self.__init__) # Check that the passed arguments (excluding self) abide by their expected data types
         
@@ -58,6 +74,8 @@ class ModelFitting(AbstractFitting):
         
         self.trainingStats = TrainingStats(self.model)
         self.lastRec = None #A dictionary or Recordings of the last simulation preformed (either training or evaluation)
+        self.warmCache = warm_cache
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
         
         #self.u = None #This is the ML "Training Input"                
         #self.empTS = ts #This is the ML "Training Labels" - A list
@@ -72,8 +90,106 @@ class ModelFitting(AbstractFitting):
         with open(filename, 'wb') as f:
             pickle.dump(self, f)
 
+    def saveTrainState(self, filename, state, modelparameter_optimizer, hyperparameter_optimizer, 
+                       modelparameter_scheduler = None, hyperparameter_scheduler = None):
+        """
+        Saves everything needed to resume training: the fitted parameters and model state, the optimizer and learning rate 
+        scheduler states, the random number generator and noise states, the TrainingStats, and the given state of the 
+        training loop (position, carried state X and hE, simulated windows so far, and the state of the EarlyStopping monitor, if any). 
+        
+        The file is written atomically (to a temporary file which then replaces it), so that an interruption never leaves a corrupt file.
+
+        Parameters
+        ----------
+        filename: String
+            filename to save the training state to
+        state: dict
+            The state of the training loop
+        modelparameter_optimizer: torch.optim.Optimizer
+            The optimizer of the model parameters
+        hyperparameter_optimizer: torch.optim.Optimizer
+            The optimizer of the hyper parameters
+        modelparameter_scheduler: torch.optim.lr_scheduler.LRScheduler
+            The learning rate scheduler of the model parameters, if any
+        hyperparameter_scheduler: torch.optim.lr_scheduler.LRScheduler
+            The learning rate scheduler of the hyper parameters, if any
+        """
+
+        state = dict(state)
+        state['X'] = state['X'].detach().cpu()
+        state['hE'] = state['hE'].detach().cpu()
+        state['loss_his'] = [loss.cpu() for loss in state['loss_his']]
+        state['loss_main'] = state['loss_main'].detach().cpu()
+        state['windListDict'] = {name: (wind if isinstance(wind, np.ndarray) else [w.cpu() for w in wind]) 
+                                 for name, wind in state['windListDict'].items()}
+        state['modelparameter'] = [param.detach().cpu().clone() for param in self.model.params_fitted['modelparameter']]
+        state['hyperparameter'] = [param.detach().cpu().clone() for param in self.model.params_fitted['hyperparameter']]
+        state['model_state'] = self.model.state_dict()
+        state['modelparameter_optimizer'] = modelparameter_optimizer.state_dict()
+        state['hyperparameter_optimizer'] = hyperparameter_optimizer.state_dict()
+        state['modelparameter_scheduler'] = None if modelparameter_scheduler is None else modelparameter_scheduler.state_dict()
+        state['hyperparameter_scheduler'] = None if hyperparameter_scheduler is None else hyperparameter_scheduler.state_dict()
+        state['torch_rng'] = torch.get_rng_state()
+        state['numpy_rng'] = np.random.get_state()
+        state['noise'] = self.model.noise.getState()
+        state['trainingStats'] = self.trainingStats
+
+        torch.save(state, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    def loadTrainState(self, filename, modelparameter_optimizer, hyperparameter_optimizer, 
+                       modelparameter_scheduler = None, hyperparameter_scheduler = None):
+        """
+        Restores a training state saved with saveTrainState into the model, optimizers, schedulers, random number generators
+        and TrainingStats.
+
+        Parameters
+        ----------
+        filename: String
+            filename the training state was saved to
+        modelparameter_optimizer: torch.optim.Optimizer
+            The optimizer of the model parameters
+        hyperparameter_optimizer: torch.optim.Optimizer
+            The optimizer of the hyper parameters
+        modelparameter_scheduler: torch.optim.lr_scheduler.LRScheduler
+            The learning rate scheduler of the model parameters, if any
+        hyperparameter_scheduler: torch.optim.lr_scheduler.LRScheduler
+            The learning rate scheduler of the hyper parameters, if any
+
+        Returns
+        -------
+        dict
+            The saved state of the training loop
+        """
+
+        state = torch.load(filename, map_location = 'cpu', weights_only = False)
+
+        with torch.no_grad():
+            for group in ['modelparameter', 'hyperparameter']:
+                for param, value in zip(self.model.params_fitted[group], state[group]):
+                    param.copy_(value)
+        self.model.load_state_dict(state['model_state'])
+        modelparameter_optimizer.load_state_dict(state['modelparameter_optimizer'])
+        hyperparameter_optimizer.load_state_dict(state['hyperparameter_optimizer'])
+        if modelparameter_scheduler is not None:
+            modelparameter_scheduler.load_state_dict(state['modelparameter_scheduler'])
+        if hyperparameter_scheduler is not None:
+            hyperparameter_scheduler.load_state_dict(state['hyperparameter_scheduler'])
+        torch.set_rng_state(state['torch_rng'])
+        np.random.set_state(state['numpy_rng'])
+        self.model.noise.setState(state['noise'])
+        self.trainingStats = state['trainingStats']
+
+        state['loss_his'] = [loss.to(self.device) for loss in state['loss_his']]
+        state['windListDict'] = {name: (wind if isinstance(wind, np.ndarray) else [w.to(self.device) for w in wind]) 
+                                 for name, wind in state['windListDict'].items()}
+        return state
+
     def train(self, u, empRecs: list, 
-              num_epochs: int, TPperWindow: int, warmupWindow: int = 0, learningrate: float = 0.05, lr_2ndLevel: float = 0.05, lr_scheduler: bool = False):
+              num_epochs: int, TPperWindow: int, warmupWindow: int = 0, learningrate: float = 0.05, lr_2ndLevel: float = 0.05, lr_scheduler: bool = False,
+              noise_seed: int = None, checkpoint: bool = False, gradient: str = 'bptt', adjoint_windows: int = 10,
+              save_state: str = None, save_state_every: int = 1, save_state_unit: str = 'epoch', resume_from: str = None,
+              early_stopping: EarlyStopping = None):
         """
         Parameters
         ----------
@@ -91,9 +207,44 @@ class ModelFitting(AbstractFitting):
             learning rate for priors of model parameters, and possibly others
         lr_scheduler: bool
             Whether to use the learning rate scheduler
+        noise_seed: int
+            If given, the noise of the model is restarted from this seed (see NoiseProvider)
+        checkpoint: bool
+            Whether to use gradient checkpointing across the integration steps of each window (see model.setCheckpointing). 
+            This bounds the memory of backpropagation for long windows (large TPperWindow), at the cost of recomputing the steps.
+        gradient: str
+            The gradient engine. 'bptt' (default) backpropagates through each window on its own, updating the parameters after every window.
+            'adjoint' backpropagates the mean loss of adjoint_windows consecutive windows through the state carried between them 
+            (see windowAdjoint), updating the parameters once per segment, in memory of one window plus a checkpoint per window.
+        adjoint_windows: int
+            Number of consecutive windows per parameter update for the 'adjoint' gradient engine
+        save_state: str
+            If given, the file the training state is saved to (see saveTrainState), so that the training can be resumed with resume_from
+        save_state_every: int
+            The training state is saved every save_state_every epochs or parameter updates (windows)
+        save_state_unit: str
+            'epoch' or 'window', the unit of save_state_every
+        resume_from: str
+            If given, a file written with save_state, from which the training is resumed. The other arguments should be those of the interrupted call.
+        early_stopping: EarlyStopping
+            If given, the convergence monitor checked at the end of every epoch, which stops the training on a plateau or divergence
+            (and, if set to, restores the parameters of the best epoch)
         """            
         method_arg_type_check(self.train, exclude = ['u']) # Check that the passed arguments (excluding self) abide by their expected data types
 
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
+
+        if save_state_unit not in ['epoch', 'window']:
+            raise ValueError(f"save_state_unit should be 'epoch' or 'window', but got {save_state_unit} instead.")
+        if gradient not in ['bptt', 'adjoint']:
+            raise ValueError(f"gradient should be 'bptt' or 'adjoint', but got {gradient} instead.")
+        windows_per_update = adjoint_windows if gradient == 'adjoint' else 1
+
+        # Gradient checkpointing is only used for the duration of training
+        checkpoint_prev = self.model.checkpoint
+        self.model.setCheckpointing(checkpoint)
+
         # Define two different optimizers for each group
         modelparameter_optimizer = optim.Adam(self.model.params_fitted['modelparameter'], lr=learningrate, eps=1e-7)
         hyperparameter_optimizer = optim.Adam(self.model.params_fitted['hyperparameter'], lr=lr_2ndLevel, eps=1e-7)
@@ -103,11 +254,11 @@ class ModelFitting(AbstractFitting):
         if lr_scheduler:
             total_steps = 0
             for empRec in empRecs:
-                total_steps += int(empRec.length/TPperWindow)*num_epochs
+                total_steps += int(np.ceil(int(empRec.length/TPperWindow) / windows_per_update))*num_epochs
         
             # total_steps = self.num_windows*num_epochs
             hyperparameter_scheduler = optim.lr_scheduler.OneCycleLR(hyperparameter_optimizer, 
-                                                                     lr_hyper, 
+                                                                     lr_2ndLevel, 
                                                                      total_steps, 
                                                                      anneal_strategy = "cos")
             hlrs = []
@@ -116,18 +267,65 @@ class ModelFitting(AbstractFitting):
                                                                      total_steps, 
                                                                      anneal_strategy = "cos")
             mlrs = []
+        else:
+            modelparameter_scheduler = None
+            hyperparameter_scheduler = None
+            hlrs = None
+            mlrs = None
         
         # initial state
-        X = self.model.createIC(ver = 0)
+        X = self.model.createIC(ver = 0).to(self.device)
         # initials of history of E
-        hE = self.model.createDelayIC(ver = 0)
+        hE = self.model.createDelayIC(ver = 0).to(self.device)
+
+        # The position (epoch, recording, window) the training starts from, and the number of parameter updates so far
+        start_epoch, start_rec, start_win = 0, 0, 0
+        num_updates = 0
+        resuming = resume_from is not None
+        if resuming:
+            resumed = self.loadTrainState(resume_from, modelparameter_optimizer, hyperparameter_optimizer,
+                                          modelparameter_scheduler, hyperparameter_scheduler)
+            start_epoch, start_rec, start_win = resumed['position']
+            num_updates = resumed['num_updates']
+            X = resumed['X'].to(self.device)
+            hE = resumed['hE'].to(self.device)
+            windListDict = resumed['windListDict']
+            loss_main = resumed['loss_main']
+            if lr_scheduler:
+                hlrs, mlrs = resumed['hlrs'], resumed['mlrs']
+            if early_stopping is not None and resumed.get('early_stopping') is not None:
+                early_stopping.loadStateDict(resumed['early_stopping'])
+
+        def save_train_state(position, epoch_losses):
+            self.saveTrainState(save_state, {'position': position, 'num_updates': num_updates, 'X': X, 'hE': hE,
+                                             'windListDict': windListDict, 'loss_his': epoch_losses, 'loss_main': loss_main,
+                                             'hlrs': hlrs, 'mlrs': mlrs,
+                                             'early_stopping': None if early_stopping is None else early_stopping.stateDict()},
+                                modelparameter_optimizer, hyperparameter_optimizer, modelparameter_scheduler, hyperparameter_scheduler)
 
         # define masks for getting lower triangle matrix indices
         mask = np.tril_indices(self.model.node_size, -1)
         mask_e = np.tril_indices(self.model.output_size, -1)
+
+        # The training data are moved to the device once, and then only sliced (without copies) into windows
+        if not isinstance(u, int):
+            u = torch.as_tensor(u, dtype=self.model.dtype_policy.compute, device=self.device)
+        windowedTSs = [empRec.windowedTensor(TPperWindow).to(self.device, self.model.dtype_policy.compute) for empRec in empRecs]
+
+        # the external inputs when there is no stimulus (and during warm-up)
+        no_external = torch.zeros(self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window, device=self.device)
         
+        # Only the first warm-up starts from the initial conditions, so only it can be cached
+        first_warmup = not resuming
+
+        telemetry = self.telemetry
+        window_sim_time = self.model.TRs_per_window * self.model.steps_per_TR * float(self.model.step_size)
+
+        if early_stopping is not None and not resuming:
+            early_stopping.reset()
+
         # LOOP 1/4: Number of Training Epochs
-        for i_epoch in range(num_epochs):
+        for i_epoch in range(start_epoch, num_epochs):
             
             # Perform the training in windows.
             if i_epoch == 0:
@@ -138,104 +336,185 @@ class ModelFitting(AbstractFitting):
         
             # TRAINING_STATS: placeholders for the history of trainingStats
             loss_his = []  # loss placeholder to take the average for the epoch at the end of the epoch
+            if resuming:
+                loss_his = resumed['loss_his']
 
-            print("Epoch: ", i_epoch)
+            epoch_start = time.perf_counter()
                    
             # LOOP 2/4: Number of Recordings in the Training Dataset
-            for empRec in empRecs: 
-                windowedTS = empRec.windowedTensor(TPperWindow)
+            for rec_idx, windowedTS in enumerate(windowedTSs): 
+                if resuming and rec_idx < start_rec:
+                    continue
 
-                # TIME SERIES: Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
-                windListDict = {} # A Dictionary with a List of windowed time series
-                for name in set(self.model.state_names + self.model.output_names):
-                    windListDict[name] = []
-                
-                # initial the external inputs
-                external = torch.tensor(
-                    np.zeros([self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window]),
-                    dtype=torch.float32)
-                for TR_i in range(warmup_windows):
-                
+                rec_start = time.perf_counter()
 
+                # The first window to fit, which is not the first one when resuming part way through the recording
+                first_win = start_win if resuming else 0
+                resuming = False
 
+                cached = None
+                if first_warmup and self.warmCache is not None:
+                    cached = self.warmCache.lookup(self.model, warmup_windows)
 
-                    # Use the model.forward() function to update next state and get simulated EEG in this batch.
-                    next_window, hE_new = self.model(external, X, hE)
-                    #print(next_window['current_state'])
-                    X = torch.tensor(next_window['current_state'].detach().numpy(), dtype=torch.float32)
-                    hE = torch.tensor(hE_new.detach().numpy(), dtype=torch.float32)
-                # LOOP 3/4: Number of windowed segments for the recording
-                for win_idx in range(windowedTS.shape[0]):
+                if first_win > 0:
+                    # The state and simulated windows so far were restored with the training state
+                    pass
+                elif cached is not None:
+                    X, hE = cached[0].to(self.device), cached[1].to(self.device)
+                else:
+                    # The warm-up only carries the state forward, so needs no gradient
+                    with torch.no_grad():
+                        for TR_i in range(warmup_windows):
 
-                    # Reset the gradient to zeros after update model parameters.
-                    hyperparameter_optimizer.zero_grad()
-                    modelparameter_optimizer.zero_grad()
+                            # Use the model.forward() function to update next state and get simulated EEG in this batch.
+                            next_window, hE = self.model(no_external, X, hE)
+                            X = next_window['current_state']
 
-                    # if the external not empty
-                    if not isinstance(u, int):
-                        external = torch.tensor(
-                            (u[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]), 
-                            dtype=torch.float32)
+                    if first_warmup and self.warmCache is not None:
+                        self.warmCache.store(self.model, warmup_windows, X, hE)
+                first_warmup = False
 
-                    # LOOP 4/4: The loop within the forward model (numerical solver), which is number of time points per windowed segment
-                    next_window, hE_new = self.model(external, X, hE)
+                if first_win == 0:
+                    # TIME SERIES: Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
+                    windListDict = {} # A Dictionary with a List of windowed time series
+                    for name in self.model.recordNames():
+                        windListDict[name] = []
 
-                    # Get the batch of empirical signal.
-                    ts_window = torch.tensor(windowedTS[win_idx, :, :], dtype=torch.float32)
+                # LOOP 3/4: Number of windowed segments for the recording
+                if gradient == 'adjoint':
+                    # The windows are fitted in segments, each backpropagated through all of its windows
+                    for seg_start in range(first_win, windowedTS.shape[0], windows_per_update):
+                        seg = range(seg_start, min(seg_start + windows_per_update, windowedTS.shape[0]))
+
+                        # Reset the gradient to zeros after update model parameters.
+                        hyperparameter_optimizer.zero_grad()
+                        modelparameter_optimizer.zero_grad()
+
+                        # The external input and batch of empirical signal of each window in the segment
+                        externals = [no_external if isinstance(u, int) else 
+                                     u[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]
+                                     for win_idx in seg]
+                        ts_windows = [windowedTS[win_idx] for win_idx in seg]
+
+                        # LOOP 4/4: Forward through the segment, then adjoint backward through it
+                        # (timed as one 'backward' phase, which includes the forward passes and losses)
+                        with telemetry.phase('backward'):
+                            windows, X, hE, losses = windowAdjoint(self.model, self.cost, X, hE, externals, ts_windows)
+
+                        for next_window, loss_main in zip(windows, losses):
+                            # TIME SERIES: Put the window of simulated forward model.
+                            for name in self.model.recordNames():
+                                windListDict[name].append(next_window[name])
+
+                            # TRAINING_STATS: Adding Loss for every training window
+                            loss_his.append(loss_main)
+
+                        # Optimize the model based on the gradient method in updating the model parameters.
+                        with telemetry.phase('step'):
+                            self._reduceGradients()
+                            hyperparameter_optimizer.step()
+                            modelparameter_optimizer.step()
+
+                            if lr_scheduler:
+                                #appending (needed to plot learning rate)
+                                hlrs.append(hyperparameter_optimizer.param_groups[0]["lr"])
+                                mlrs.append(modelparameter_optimizer.param_groups[0]["lr"])
+
+                                # schedular step 
+                                hyperparameter_scheduler.step()
+                                modelparameter_scheduler.step()
+
+                        telemetry.window(window_sim_time * len(seg), epoch = i_epoch, recording = rec_idx, window = seg.start,
+                                         num_windows = len(seg), loss = torch.stack(losses).mean())
+
+                        num_updates += 1
+                        if save_state is not None and save_state_unit == 'window' and num_updates % save_state_every == 0:
+                            save_train_state((i_epoch, rec_idx, seg.stop), loss_his)
 
-                    # calculating loss
-                    loss, loss_main = self.cost.loss(next_window, ts_window)
-                    
-                    # TIME SERIES: Put the window of simulated forward model.
-                    for name in set(self.model.state_names + self.model.output_names):
-                        windListDict[name].append(next_window[name].detach().cpu().numpy())
+                else:
+                    for win_idx in range(first_win, windowedTS.shape[0]):
+
+                        # Reset the gradient to zeros after update model parameters.
+                        hyperparameter_optimizer.zero_grad()
+                        modelparameter_optimizer.zero_grad()
 
-                    # TRAINING_STATS: Adding Loss for every training window (corresponding to one backpropagation)
-                    loss_his.append(loss_main.detach().cpu().numpy())
+                        # if the external not empty
+                        external = no_external
+                        if not isinstance(u, int):
+                            external = u[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]
 
-                    # Calculate gradient using backward (backpropagation) method of the loss function.
-                    loss.backward(retain_graph=True)
+                        # LOOP 4/4: The loop within the forward model (numerical solver), which is number of time points per windowed segment
+                        with telemetry.phase('forward'):
+                            next_window, hE_new = self.model(external, X, hE)
 
-                    # Optimize the model based on the gradient method in updating the model parameters.
-                    hyperparameter_optimizer.step()
-                    modelparameter_optimizer.step()
+                        # Get the batch of empirical signal.
+                        ts_window = windowedTS[win_idx]
+
+                        # calculating loss
+                        with telemetry.phase('loss'):
+                            loss, loss_main = self.cost.loss(next_window, ts_window)
+                    
+                        # TIME SERIES: Put the window of simulated forward model.
+                        for name in self.model.recordNames():
+                            windListDict[name].append(next_window[name].detach())
+
+                        # TRAINING_STATS: Adding Loss for every training window (corresponding to one backpropagation)
+                        loss_his.append(loss_main.detach())
+
+                        # Calculate gradient using backward (backpropagation) method of the loss function.
+                        with telemetry.phase('backward'):
+                            loss.backward(retain_graph=True)
+
+                        # Optimize the model based on the gradient method in updating the model parameters.
+                        with telemetry.phase('step'):
+                            self._reduceGradients()
+                            hyperparameter_optimizer.step()
+                            modelparameter_optimizer.step()
                     
-                    if lr_scheduler:
-                        #appending (needed to plot learning rate)
-                        hlrs.append(hyperparameter_optimizer.param_groups[0]["lr"])
-                        mlrs.append(modelparameter_optimizer.param_groups[0]["lr"])
+                            if lr_scheduler:
+                                #appending (needed to plot learning rate)
+                                hlrs.append(hyperparameter_optimizer.param_groups[0]["lr"])
+                                mlrs.append(modelparameter_optimizer.param_groups[0]["lr"])
                         
-                        # schedular step 
-                        hyperparameter_scheduler.step()
-                        modelparameter_scheduler.step()
+                                # schedular step 
+                                hyperparameter_scheduler.step()
+                                modelparameter_scheduler.step()
 
-                    # last update current state using next state...
-                    # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-                    X = next_window['current_state'].detach().clone() # dtype=torch.float32
-                    hE = hE_new.detach().clone() #dtype=torch.float32
+                        telemetry.window(window_sim_time, epoch = i_epoch, recording = rec_idx, window = win_idx, loss = loss_main)
 
-                ts_emp = np.concatenate(list(windowedTS),1) #TODO: Check this code
-                fc = np.corrcoef(ts_emp)
+                        # last update current state using next state...
+                        # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
+                        X = next_window['current_state'].detach()
+                        hE = hE_new.detach()
 
-                # TIME SERIES: Concatenate all windows together to get one recording
-                for name in set(self.model.state_names + self.model.output_names):
-                        windListDict[name] = np.concatenate(windListDict[name], axis=1)
+                        num_updates += 1
+                        if save_state is not None and save_state_unit == 'window' and num_updates % save_state_every == 0:
+                            save_train_state((i_epoch, rec_idx, win_idx + 1), loss_his)
 
-                ts_sim = windListDict[self.model.output_names[0]]
-                fc_sim = np.corrcoef(ts_sim[:, 10:])
+                # TIME SERIES: Concatenate all windows together to get one recording (copied off the device once)
+                for name in self.model.recordNames():
+                        windListDict[name] = torch.cat(windListDict[name], dim=1).cpu().to(self.model.dtype_policy.compute).numpy()
 
-                print('epoch: ', i_epoch, 
-                      'loss:', loss_main.detach().cpu().numpy(),
-                      'Pseudo FC_cor: ', np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1], #Calling this Pseudo as different windows of the time series have slighly different parameter values
-                      'cos_sim: ', np.diag(cosine_similarity(ts_sim, ts_emp)).mean())
-                      
+                # The diagnostics of the recording are only computed if a telemetry sink asks for them
+                ts_sim = windListDict[self.model.output_names[0]]
+                diagnostics = {
+                    # Calling this Pseudo as different windows of the time series have slighly different parameter values
+                    'pseudo_FC_cor': lambda: np.corrcoef(np.corrcoef(ts_sim[:, 10:])[mask_e], 
+                                                         np.corrcoef(torch.cat(list(windowedTS), 1).cpu().numpy())[mask_e])[0, 1],
+                    'cos_sim': lambda: np.diag(cosine_similarity(ts_sim, torch.cat(list(windowedTS), 1).cpu().numpy())).mean()}
+                lrs = {}
                 if lr_scheduler:
-                    print('Modelparam_lr: ', modelparameter_scheduler.get_last_lr()[0])
-                    print('Hyperparam_lr: ', hyperparameter_scheduler.get_last_lr()[0])
+                    lrs = {'modelparam_lr': modelparameter_scheduler.get_last_lr()[0],
+                           'hyperparam_lr': hyperparameter_scheduler.get_last_lr()[0]}
+                rec_seconds = time.perf_counter() - rec_start
+                rec_sim_time = window_sim_time * windowedTS.shape[0]
+                telemetry.event('recording', diagnostics, epoch = i_epoch, recording = rec_idx, loss = loss_his[-1],
+                                seconds = rec_seconds, sim_time = rec_sim_time, throughput = rec_sim_time / rec_seconds, **lrs)
                     
             # TRAINING_STATS: Put the updated model parameters into the history placeholders at the end of every epoch.
             # Additing Mean Loss for the Epoch
-            self.trainingStats.appendLoss(np.mean(loss_his))
+            self.trainingStats.appendLoss(torch.stack(loss_his).mean().item())
+            telemetry.event('epoch', epoch = i_epoch, loss = self.trainingStats.loss[-1], seconds = time.perf_counter() - epoch_start)
             # NMM/Other Parameter info for the Epoch (a list where a number is recorded every window of every record)            
             trackedParam = {}
             exclude_param = ['gains_con', 'lm'] #This stores SC and LF which are saved seperately
@@ -263,13 +542,160 @@ class ModelFitting(AbstractFitting):
                     self.trainingStats.appendSC(self.model.sc_fitted.detach().cpu().numpy())
             #if self.model.use_fit_lfm:
                 #self.trainingStats.appendLF(self.model.lm.detach().cpu().numpy())
+
+            # The monitor is updated before the epoch is saved, so that a resumed training keeps its patience count
+            stop = early_stopping is not None and early_stopping.update(self, i_epoch)
+
+            if save_state is not None and save_state_unit == 'epoch' and (i_epoch + 1) % save_state_every == 0:
+                save_train_state((i_epoch + 1, 0, 0), [])
+
+            if stop:
+                telemetry.event('early_stop', epoch = i_epoch, reason = early_stopping.stop_reason, best_epoch = early_stopping.best_epoch)
+                break
+
+        if early_stopping is not None:
+            early_stopping.finish(self)
         
+        self.model.setCheckpointing(checkpoint_prev)
+
         # Saving the last recording of training as a Model_fitting attribute
         self.lastRec = {}
-        for name in set(self.model.state_names + self.model.output_names):
+        for name in self.model.recordNames():
             self.lastRec[name] = Recording(windListDict[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
 
-    def evaluate(self, u, empRec: list, TPperWindow: int, base_window_num: int = 0, transient_num: int = 10): 
+    def _windowStream(self, u, num_windows, base_window_num, inference_mode):
+        # Runs base_window_num windows without input, then the windows of the stimulus u, without gradients 
+        # (under torch.inference_mode() if asked), yielding (index, output of model.forward) for each stimulus window.
+        # It runs num_windows windows, or until the stimulus ends if num_windows is None.
+        # The autograd mode is entered around each window, rather than around the loop, so that it does not leak to the consumer.
+
+        TRs = self.model.TRs_per_window
+        grad_mode = torch.inference_mode if inference_mode else torch.no_grad
+
+        with grad_mode():
+            # initial state
+            X = self.model.createIC(ver = 1).to(self.device)
+            # initials of history of E
+            hE = self.model.createDelayIC(ver = 1).to(self.device)
+            # the external inputs when there is no stimulus (and during the base windows)
+            no_external = torch.zeros(self.model.node_size, self.model.steps_per_TR, TRs, device=self.device)
+
+        # The stimulus of each window: None for no input, and end_of_stimulus once it is over
+        end_of_stimulus = object()
+        if isinstance(u, (int, float)):
+            const_external = None if u == 0 else torch.full_like(no_external, float(u))
+            stimulus = lambda stim_idx: const_external
+        elif callable(u):
+            def stimulus(stim_idx):
+                ext = u(stim_idx)
+                return end_of_stimulus if ext is None else ext
+        elif hasattr(u, '__next__') or (not torch.is_tensor(u) and not isinstance(u, np.ndarray)):
+            u_iter = iter(u)
+            stimulus = lambda stim_idx: next(u_iter, end_of_stimulus)
+        else:
+            # the stimulus stays a tensor on the device, and is only sliced into windows
+            u = torch.as_tensor(u, dtype=self.model.dtype_policy.compute, device=self.device)
+            stimulus = lambda stim_idx: u[:, :, stim_idx * TRs:(stim_idx + 1) * TRs] if stim_idx * TRs < u.shape[-1] else end_of_stimulus
+
+        # Restore the state after the base windows from the cache, if there
+        win_idx = 0
+        if self.warmCache is not None and base_window_num > 0:
+            cached = self.warmCache.lookup(self.model, base_window_num)
+            if cached is not None:
+                X, hE = cached[0].to(self.device), cached[1].to(self.device)
+                win_idx = base_window_num
+
+        # LOOP 1/2: The number of windows in a recording
+        while num_windows is None or win_idx < base_window_num + num_windows:
+            stim_idx = win_idx - base_window_num
+
+            external = no_external
+            if stim_idx >= 0:
+                ext = stimulus(stim_idx)
+                if ext is end_of_stimulus:
+                    if num_windows is None:
+                        return
+                    ext = None
+                if ext is not None:
+                    external = torch.as_tensor(ext, dtype=self.model.dtype_policy.compute, device=self.device)
+
+            with grad_mode():
+                # LOOP 2/2: The loop within the forward model (numerical solver), which is number of time points per windowed segment
+                next_window, hE = self.model.forward(external, X, hE)
+                X = next_window['current_state']
+
+                # Cache the state after the base windows
+                if self.warmCache is not None and win_idx == base_window_num - 1:
+                    self.warmCache.store(self.model, base_window_num, X, hE)
+
+            if stim_idx >= 0:
+                yield stim_idx, next_window
+            win_idx += 1
+
+    def _simulateWindows(self, u, num_windows, base_window_num, inference_mode):
+        # Runs a simulation (see _windowStream), writing the recorded windows in place into tensors
+        # preallocated for the whole simulation, which are returned by name
+
+        outputs = {}
+        for stim_idx, next_window in self._windowStream(u, num_windows, base_window_num, inference_mode):
+            # TIME SERIES: Write the window of simulated forward model in place.
+            for name in self.model.recordNames():
+                window = next_window[name]
+                width = window.shape[-1]
+                if name not in outputs:
+                    outputs[name] = window.new_empty(window.shape[0], num_windows * width)
+                outputs[name][:, stim_idx * width:(stim_idx + 1) * width] = window
+
+        return outputs
+
+    def simulateStream(self, u, numTP: int = None, base_window_num: int = 0, noise_seed: int = None, 
+                       store: TimeseriesStore = None, inference_mode: bool = True):
+        """
+        Simulates the model one window at a time, as a generator, so that simulations of any length run in constant memory.
+        lastRec is not set.
+
+        Parameters
+        ----------
+        u : int, Tensor, function or iterator
+            external or stimulus: 0 for none, a Tensor of num_nodes x steps_per_TR x time points, a function taking the window index 
+            and returning the input of that window (num_nodes x steps_per_TR x TRs_per_window, or None to end the simulation), 
+            or an iterator of the inputs of successive windows (the simulation ends with it)
+        numTP : int
+            The number of time points to simulate, rounded up to whole windows. If None, the simulation runs until the stimulus ends
+            (or forever for a constant stimulus, until the consumer stops).
+        base_window_num : int
+            length of num_windows for resting
+        noise_seed : int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
+        store : TimeseriesStore
+            If given, every window is also written to this on-disk store (which is flushed when the generator ends or is closed)
+        inference_mode : bool
+            Whether to simulate under torch.inference_mode() (otherwise torch.no_grad())
+
+        Yields
+        ------
+        dict
+            The recorded states and outputs of each window (see model.setRecord), Tensors of num_regions x window length
+        """
+
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
+        if store is not None and store.step_size is None:
+            store.step_size = float(self.model.step_size)
+
+        num_windows = None if numTP is None else max(1, -(-numTP // self.model.TRs_per_window))
+        try:
+            for stim_idx, next_window in self._windowStream(u, num_windows, base_window_num, inference_mode):
+                window = {name: next_window[name] for name in self.model.recordNames()}
+                if store is not None:
+                    store.append(window)
+                yield window
+        finally:
+            if store is not None:
+                store.flush()
+
+    def evaluate(self, u, empRec: list, TPperWindow: int, base_window_num: int = 0, transient_num: int = 10, noise_seed: int = None,
+                 inference_mode: bool = True): 
         """
         Parameters
         ----------
@@ -283,138 +709,245 @@ class ModelFitting(AbstractFitting):
             length of num_windows for resting
         transient_num : int
             The number of initial time points to exclude from some metrics
-        -----------
+        noise_seed : int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
+        inference_mode : bool
+            Whether to simulate under torch.inference_mode(), the fastest (otherwise under torch.no_grad()). Either way, the windows
+            are copied into tensors allocated outside inference mode, so the time series of lastRec are normal tensors.
+
+        Returns
+        -------
+        dict
+            The fit metrics: 'FC_cor' (correlation of the simulated and empirical FC) and 'cos_sim' (mean cosine similarity of the time series)
         """
         method_arg_type_check(self.evaluate, exclude = ['u']) # Check that the passed arguments (excluding self) abide by their expected data types
         #TODO: Should be updated to take a list of u and empRec
 
-        # initial state
-        X = self.model.createIC(ver = 1)
-        # initials of history of E
-        hE = self.model.createDelayIC(ver = 1)
-
-        # define mask for getting lower triangle matrix
-        mask = np.tril_indices(self.model.node_size, -1)
-        mask_e = np.tril_indices(self.model.output_size, -1)
-        
-        # Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
-        windListDict = {} # A Dictionary with a List of windowed time series
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = []
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
 
         num_windows = int(empRec.length/TPperWindow)
-        u_hat = np.zeros(
-            (self.model.node_size,self.model.steps_per_TR,
-             base_window_num*self.model.TRs_per_window + num_windows*self.model.TRs_per_window))
-        u_hat[:, :, base_window_num * self.model.TRs_per_window:] = u
-
-        # LOOP 1/2: The number of windows in a recording
-        for win_idx in range(num_windows + base_window_num):
-
-            # Get the input and output noises for the module.
-            external = torch.tensor(
-                (u_hat[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]),
-                dtype=torch.float32)
-
-            # LOOP 2/2: The loop within the forward model (numerical solver), which is number of time points per windowed segment
-            next_window, hE_new = self.model.forward(external, X, hE)
-
-            # TIME SERIES: Put the window of simulated forward model.
-            if win_idx > base_window_num - 1:
-                for name in set(self.model.state_names + self.model.output_names):
-                    windListDict[name].append(next_window[name].detach().cpu().numpy())
-
-            # last update current state using next state...
-            # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-            X = next_window['current_state'].detach().clone() # dtype=torch.float32
-            hE = hE_new.detach().clone() #dtype=torch.float32
+        outputs = self._simulateWindows(u, num_windows, base_window_num, inference_mode)
         
         windowedTS = empRec.windowedTensor(TPperWindow)
-        ts_emp = np.concatenate(list(windowedTS),1) #TODO: Check this code
-        fc = np.corrcoef(ts_emp)
-        
-        # TIME SERIES: Concatenate all windows together to get one recording
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = np.concatenate(windListDict[name], axis=1)
-        
-        ts_sim = windListDict[self.model.output_names[0]]
-        fc_sim = np.corrcoef(ts_sim[:, transient_num:])
+        ts_emp = torch.cat(list(windowedTS), 1).cpu().numpy()
+        ts_sim = outputs[self.model.output_names[0]].cpu().to(self.model.dtype_policy.compute).numpy()
         
-        print('FC_cor: ', np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1], 
-              'cos_sim: ', np.diag(cosine_similarity(ts_sim, ts_emp)).mean())
+        metrics = self._fitMetrics(ts_sim, ts_emp, transient_num)
+        self.telemetry.event('evaluate', **metrics)
         
         # Saving the last recording of training as a Model_fitting attribute
         self.lastRec = {}
-        for name in set(self.model.state_names + self.model.output_names):
-            self.lastRec[name] = Recording(windListDict[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
+        for name in self.model.recordNames():
+            self.lastRec[name] = Recording(outputs[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
+
+        return metrics
 
-    def simulate(self, u, numTP: int, base_window_num: int = 0, transient_num: int = 10):
+    def simulate(self, u, numTP: int, base_window_num: int = 0, transient_num: int = 10, noise_seed: int = None,
+                 inference_mode: bool = True):
         """
         Parameters
         ----------
         u : int or Tensor
             external or stimulus
         numTP : int
-            The number of time points ot simulate
+            The number of time points ot simulate, rounded up to whole windows
         base_window_num : int
             length of num_windows for resting
         transient_num : int
             The number of initial time points to exclude from some metrics
+        noise_seed : int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
+        inference_mode : bool
+            Whether to simulate under torch.inference_mode(), the fastest (otherwise under torch.no_grad()). Either way, the windows
+            are copied into tensors allocated outside inference mode, so the time series of lastRec are normal tensors.
         -----------
         """
         method_arg_type_check(self.simulate, exclude = ['u']) # Check that the passed arguments (excluding self) abide by their expected data types
 
-        num_windows = 1
-        TPperWindow = numTP #TODO: May want to go back to TPperWindow so base_window_num is used correctly, but also should be made consistent with train
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
 
-        # initial state
-        X = self.model.createIC(ver = 1)
-        # initials of history of E
-        hE = self.model.createDelayIC(ver = 1)
-
-        # define mask for getting lower triangle matrix
-        mask = np.tril_indices(self.model.node_size, -1)
-        mask_e = np.tril_indices(self.model.output_size, -1)
+        num_windows = max(1, -(-numTP // self.model.TRs_per_window))
+        outputs = self._simulateWindows(u, num_windows, base_window_num, inference_mode)
         
-        # Create placeholders for the simulated states and outputs of entire time series corresponding to one recording
-        windListDict = {} # A Dictionary with a List of windowed time series
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = []
+        # Saving the last recording of training as a Model_fitting attribute
+        self.lastRec = {}
+        for name in self.model.recordNames():
+            self.lastRec[name] = Recording(outputs[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
 
-        u_hat = np.zeros(
-            (self.model.node_size,self.model.steps_per_TR,
-             base_window_num*self.model.TRs_per_window + num_windows*self.model.TRs_per_window))
-        u_hat[:, :, base_window_num * self.model.TRs_per_window:] = u
+    def _reduceGradients(self):
+        # Called before every parameter update, once the gradients of the update are computed.
+        # Nothing to do here; DistributedFitting averages the gradients across its processes.
+        pass
 
-        # LOOP 1/2: The number of windows in a recording
-        for win_idx in range(num_windows + base_window_num):
+    def _fitMetrics(self, ts_sim, ts_emp, transient_num):
+        # The correlation of the simulated and empirical FC (lower triangles), and the mean cosine similarity of the time series
+        mask_e = np.tril_indices(ts_emp.shape[0], -1)
+        fc = np.corrcoef(ts_emp)
+        fc_sim = np.corrcoef(ts_sim[:, transient_num:])
+        return {'FC_cor': np.corrcoef(fc_sim[mask_e], fc[mask_e])[0, 1],
+                'cos_sim': np.diag(cosine_similarity(ts_sim, ts_emp)).mean()}
 
-            # Get the input and output noises for the module.
-            external = torch.tensor(
-                (u_hat[:, :, win_idx * self.model.TRs_per_window:(win_idx + 1) * self.model.TRs_per_window]),
-                dtype=torch.float32)
+    def simulateConditions(self, u, numTP: int, sc_masks = None, conditions: list = None, base_window_num: int = 0, 
+                           noise_seed: int = None, shared_noise: bool = True):
+        """
+        Simulates the model under several conditions at once, as one batched simulation under torch.inference_mode().
 
-            # LOOP 2/2: The loop within the forward model (numerical solver), which is number of time points per windowed segment
-            next_window, hE_new = self.model.forward(external, X, hE)
+        A condition is a stimulus, a mask of the structural connections (e.g. a virtual lesion, see model.setSCMask),
+        or both. All conditions start from the same initial state, and by default see the same noise, so that they only differ
+        by their stimulus and mask. Parameters whose value has a leading axis of length num_conditions also vary across conditions
+        (see model.batchParamValue).
 
-            # TIME SERIES: Put the window of simulated forward model.
-            if win_idx > base_window_num - 1:
-                for name in set(self.model.state_names + self.model.output_names):
-                    windListDict[name].append(next_window[name].detach().cpu().numpy())
+        Parameters
+        ----------
+        u : int or Tensor
+            The stimulus of every condition, num_conditions x num_nodes x steps_per_TR x time points, 
+            or one stimulus shared by all conditions (num_nodes x steps_per_TR x time points), or 0 for none.
+            It starts after the base windows.
+        numTP : int
+            The number of time points to simulate (after the base windows), rounded up to whole windows
+        sc_masks : Tensor
+            Optional mask of the structural connections of every condition, num_conditions x num_nodes x num_nodes
+            (or num_conditions x num_edges with sparse SC). It applies to the base windows too.
+        conditions : list
+            The label of every condition. Defaults to 0, 1, ...
+        base_window_num : int
+            length of num_windows for resting
+        noise_seed : int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
+        shared_noise : bool
+            Whether all conditions see the same noise (otherwise each draws its own)
+
+        Returns
+        -------
+        ConditionResults
+            The recorded states and outputs of every condition, by condition label
+        """
 
-            # last update current state using next state...
-            # (no direct use X = X_next, since gradient calculation only depends on one batch no history)
-            X = next_window['current_state'].detach().clone() # dtype=torch.float32
-            hE = hE_new.detach().clone() #dtype=torch.float32
-        
-        # TIME SERIES: Concatenate all windows together to get one recording
-        for name in set(self.model.state_names + self.model.output_names):
-            windListDict[name] = np.concatenate(windListDict[name], axis=1)
-        
-        ts_sim = windListDict[self.model.output_names[0]]
-        fc_sim = np.corrcoef(ts_sim[:, transient_num:])
-        
-        # Saving the last recording of training as a Model_fitting attribute
-        self.lastRec = {}
-        for name in set(self.model.state_names + self.model.output_names):
-            self.lastRec[name] = Recording(windListDict[name], step_size = self.model.step_size) #TODO: This won't work if different variables have different step sizes
+        if noise_seed is not None:
+            self.model.noise.reset(noise_seed)
+
+        TRs = self.model.TRs_per_window
+        num_windows = -(-numTP // TRs)
+
+        # The stimulus of every condition, on the fitting device
+        if isinstance(u, int):
+            u = None
+        else:
+            u = torch.as_tensor(u, dtype=self.model.dtype_policy.compute, device=self.device)
+        if u is not None and u.dim() == 4:
+            num_conditions = u.shape[0]
+        elif sc_masks is not None:
+            num_conditions = sc_masks.shape[0]
+        elif conditions is not None:
+            num_conditions = len(conditions)
+        else:
+            raise ValueError("The conditions should be given by a stack of stimuli, of SC masks, or by their labels.")
+        if conditions is None:
+            conditions = list(range(num_conditions))
+        if len(conditions) != num_conditions:
+            raise ValueError(f"Got {len(conditions)} condition labels for {num_conditions} conditions.")
+
+        u_hat = torch.zeros(num_conditions, self.model.node_size, self.model.steps_per_TR, 
+                            (base_window_num + num_windows) * TRs, device=self.device)
+        if u is not None:
+            u_hat[..., base_window_num * TRs:base_window_num * TRs + u.shape[-1]] = u[..., :num_windows * TRs]
+
+        # The base windows only depend on the conditions through their masks, so without masks
+        # they are run (or restored from the cache) once, and shared
+        share_base = sc_masks is None and shared_noise
+        X = self.model.createIC(ver = 1).to(self.device)
+        hE = self.model.createDelayIC(ver = 1).to(self.device)
+        start_window = 0
+        if share_base and base_window_num > 0:
+            cached = self.warmCache.lookup(self.model, base_window_num) if self.warmCache is not None else None
+            if cached is not None:
+                X, hE = cached[0].to(self.device), cached[1].to(self.device)
+            else:
+                with torch.inference_mode():
+                    for win_idx in range(base_window_num):
+                        next_window, hE = self.model.forward(u_hat[0, ..., win_idx * TRs:(win_idx + 1) * TRs], X, hE)
+                        X = next_window['current_state']
+                if self.warmCache is not None:
+                    self.warmCache.store(self.model, base_window_num, X, hE)
+            start_window = base_window_num
+        X = X.expand((num_conditions,) + tuple(X.shape)).clone()
+        hE = hE.expand((num_conditions,) + tuple(hE.shape)).clone()
+
+        windListDict = {name: [] for name in self.model.recordNames()}
+        sc_mask_prev = getattr(self.model, 'sc_mask', None)
+        if sc_masks is not None:
+            self.model.setSCMask(torch.as_tensor(sc_masks, dtype=self.model.dtype_policy.compute, device=self.device))
+        try:
+            with torch.inference_mode():
+                # LOOP 1/2: The number of windows, all conditions at once
+                for win_idx in range(start_window, base_window_num + num_windows):
+                    external = u_hat[..., win_idx * TRs:(win_idx + 1) * TRs]
+                    noise = None
+                    if shared_noise:
+                        noise = self.model.noise.sample((3, 1, self.model.node_size, self.model.steps_per_TR, TRs))
+                        noise = noise.expand(3, num_conditions, *noise.shape[2:])
+
+                    # LOOP 2/2: The loop within the forward model (numerical solver)
+                    next_window, hE = self.model.forward(external, X, hE, noise)
+                    X = next_window['current_state']
+
+                    if win_idx >= base_window_num:
+                        for name in self.model.recordNames():
+                            windListDict[name].append(next_window[name])
+        finally:
+            if sc_masks is not None:
+                self.model.setSCMask(sc_mask_prev)
+
+        data = {name: torch.cat(windListDict[name], dim=-1).cpu().to(self.model.dtype_policy.compute).numpy() for name in self.model.recordNames()}
+        return ConditionResults(conditions, data, self.model.step_size)
+
+    def evaluateConditions(self, u, empRec, TPperWindow: int, sc_masks = None, conditions: list = None, base_window_num: int = 0, 
+                           transient_num: int = 10, noise_seed: int = None, shared_noise: bool = True):
+        """
+        Evaluates the model under several conditions at once, as one batched simulation without gradients (see simulateConditions).
+
+        Parameters
+        ----------
+        u : int or Tensor
+            The stimulus of every condition (num_conditions x num_nodes x steps_per_TR x time points), 
+            or one stimulus shared by all conditions, or 0 for none
+        empRec : Recording or list of Recording
+            The empirical data, shared by all conditions, or one per condition
+        TPperWindow: int
+            Number of Empirical Time Points per window. model.forward does one window at a time.  
+        sc_masks : Tensor
+            Optional mask of the structural connections of every condition (see simulateConditions)
+        conditions : list
+            The label of every condition. Defaults to 0, 1, ...
+        base_window_num : int
+            length of num_windows for resting
+        transient_num : int
+            The number of initial time points to exclude from some metrics
+        noise_seed : int
+            If given, the noise of the model is restarted from this seed, so that repeated calls replay the same noise
+        shared_noise : bool
+            Whether all conditions see the same noise (otherwise each draws its own)
+
+        Returns
+        -------
+        ConditionResults
+            The recorded states and outputs of every condition, and their fit metrics ('FC_cor' and 'cos_sim'), by condition label
+        """
+
+        empRecs = empRec if isinstance(empRec, list) else None
+        numTP = (empRecs[0] if empRecs else empRec).length
+        results = self.simulateConditions(u, numTP, sc_masks = sc_masks, conditions = conditions, base_window_num = base_window_num,
+                                          noise_seed = noise_seed, shared_noise = shared_noise)
+
+        ts_sims = results.stack(self.model.output_names[0])
+        results.metrics = []
+        for idx, label in enumerate(results.conditions):
+            rec = empRecs[idx] if empRecs else empRec
+            ts_emp = torch.cat(list(rec.windowedTensor(TPperWindow)), 1).cpu().numpy()
+            ts_sim = ts_sims[idx][:, :ts_emp.shape[1]]
+            results.metrics.append(self._fitMetrics(ts_sim, ts_emp, transient_num))
+            self.telemetry.event('evaluate', condition = label, **results.metrics[-1])
+
+        return results
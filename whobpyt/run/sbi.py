@@ -0,0 +1,559 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for simulation-based inference (SBI) of amortised posteriors, with batched simulations
+"""
+
+import math
+import time
+
+import numpy as np
+import torch
+from torch.distributions import Categorical, MixtureSameFamily, MultivariateNormal
+
+from ..datatypes import AbstractFitting, TrainingStats, Parameter as par
+from .telemetry import Telemetry
+
+
+class MixtureDensityEstimator(torch.nn.Module):
+    """
+    A neural density estimator of the posterior p(theta | x) of num_params parameters given num_features summary features:
+    a mixture of num_components multivariate normals (with full covariances), whose weights, means and Cholesky factors are
+    given by a multilayer perceptron of the features (a mixture density network).
+
+    The features and parameters are standardized with the means and standard deviations of the training set (see setStandardization).
+
+    Attributes
+    ----------
+    num_features: int
+        The number of summary features
+    num_params: int
+        The number of parameters
+    num_components: int
+        The number of components of the mixture
+    """
+
+    def __init__(self, num_features: int, num_params: int, num_components: int = 5, hidden_size: int = 64, num_layers: int = 2):
+        """
+        Parameters
+        ----------
+        num_features: int
+            The number of summary features
+        num_params: int
+            The number of parameters
+        num_components: int
+            The number of components of the mixture
+        hidden_size: int
+            The number of units of every hidden layer
+        num_layers: int
+            The number of hidden layers
+        """
+
+        super(MixtureDensityEstimator, self).__init__()
+        self.num_features = num_features
+        self.num_params = num_params
+        self.num_components = num_components
+
+        layers = []
+        in_size = num_features
+        for layer in range(num_layers):
+            layers += [torch.nn.Linear(in_size, hidden_size), torch.nn.Tanh()]
+            in_size = hidden_size
+        self.net = torch.nn.Sequential(*layers)
+
+        num_tril = num_params * (num_params + 1) // 2
+        self.logits = torch.nn.Linear(in_size, num_components)
+        self.means = torch.nn.Linear(in_size, num_components * num_params)
+        self.trils = torch.nn.Linear(in_size, num_components * num_tril)
+        self.register_buffer('tril_index', torch.tril_indices(num_params, num_params))
+
+        self.register_buffer('x_mean', torch.zeros(num_features))
+        self.register_buffer('x_std', torch.ones(num_features))
+        self.register_buffer('theta_mean', torch.zeros(num_params))
+        self.register_buffer('theta_std', torch.ones(num_params))
+
+    def setStandardization(self, x, theta):
+        """
+        Parameters
+        ----------
+        x: torch.Tensor with number of simulations X num_features
+            The summary features of the training set
+        theta: torch.Tensor with number of simulations X num_params
+            The parameters of the training set
+        """
+
+        self.x_mean.copy_(x.mean(0))
+        self.x_std.copy_(x.std(0).clamp_min(1e-6))
+        self.theta_mean.copy_(theta.mean(0))
+        self.theta_std.copy_(theta.std(0).clamp_min(1e-6))
+
+    def _mixture(self, x):
+        # The mixture over the standardized parameters, for every set of features (batch_size x num_features)
+        batch_size = x.shape[0]
+        h = self.net((x - self.x_mean) / self.x_std)
+
+        means = self.means(h).reshape(batch_size, self.num_components, self.num_params)
+        tril_values = self.trils(h).reshape(batch_size, self.num_components, -1)
+        scale_tril = tril_values.new_zeros(batch_size, self.num_components, self.num_params, self.num_params)
+        scale_tril[..., self.tril_index[0], self.tril_index[1]] = tril_values
+        # Positive diagonals, for valid Cholesky factors
+        diag = torch.diagonal(scale_tril, dim1 = -2, dim2 = -1)
+        scale_tril = scale_tril - torch.diag_embed(diag) + torch.diag_embed(torch.nn.functional.softplus(diag) + 1e-4)
+
+        return MixtureSameFamily(Categorical(logits = self.logits(h)), MultivariateNormal(means, scale_tril = scale_tril))
+
+    def logProb(self, theta, x):
+        """
+        Parameters
+        ----------
+        theta: torch.Tensor with batch_size X num_params
+            Parameters
+        x: torch.Tensor with batch_size X num_features
+            Summary features
+
+        Returns
+        -------
+        torch.Tensor with batch_size
+            The log posterior density of every theta given its x
+        """
+
+        return self._mixture(x).log_prob((theta - self.theta_mean) / self.theta_std) - torch.log(self.theta_std).sum()
+
+    def sample(self, x, num_samples: int):
+        """
+        Parameters
+        ----------
+        x: torch.Tensor with num_features
+            Summary features
+        num_samples: int
+            The number of samples
+
+        Returns
+        -------
+        torch.Tensor with num_samples X num_params
+            Samples of the posterior given x
+        """
+
+        samples = self._mixture(x.reshape(1, -1)).sample((num_samples,))[:, 0]
+        return self.theta_mean + self.theta_std * samples
+
+
+class SimulationBasedInference(AbstractFitting):
+    """
+    This class estimates the posterior of the model parameters given a recording, rather than a point estimate (as ModelFitting does),
+    with neural posterior estimation:
+        1. simulate: parameter sets drawn from the priors are simulated in batched simulations without gradients (one
+           parameter set per simulation of the batch, see batchParamValue of the model), and summarized with SummaryFeatures
+        2. train: a neural density estimator (MixtureDensityEstimator) of the posterior given the features is trained on the simulations
+        3. sample / posteriorMean: the posterior of a new recording is then given by one pass of the estimator, without further simulation
+
+    The simulations and the training are done once, for all the recordings (e.g. all the subjects of a cohort, see inferCohort),
+    so that their cost is amortised across them. More simulations can be added to a bank (simulate appends to it), and the bank
+    is saved with the object (see save).
+
+    The inferred parameters are the Parameters fitted by the model (fit_par), except the leadfield (lm), which all need priors
+    (prior_mean and prior_precision). The posterior is over their values (val), as are the priors; samples are returned as
+    the values of the parameters (as returned by Parameter.value()).
+
+    The simulated time series should have the length of the recordings (num_windows windows of TRs_per_window time points),
+    as their features depend on it.
+
+    Attributes
+    ----------
+    model: AbstractNMM
+        Whole Brain Model to Simulate
+    features: SummaryFeatures
+        The summary features of the simulations and recordings
+    estimator: MixtureDensityEstimator
+        The density estimator of the posterior (created by train)
+    theta_bank: torch.Tensor with number of simulations X number of inferred values
+        The parameters (val) of the simulations
+    x_bank: torch.Tensor with number of simulations X number of features
+        The summary features of the simulations
+    trainingStats: TrainingStats
+        The training loss (negative log posterior density) of the estimator over the epochs
+    device : torch.device
+        Whether the simulations and training are to run on CPU or GPU
+    telemetry : Telemetry
+        Where the timings and losses are sent
+    """
+
+    def __init__(self, model, features, device = torch.device('cpu'), num_components: int = 5, hidden_size: int = 64,
+                 num_layers: int = 2, telemetry: Telemetry = None):
+        """
+        Parameters
+        ----------
+        model: AbstractNMM
+            Whole Brain Model to Simulate
+        features: SummaryFeatures
+            The summary features of the simulations and recordings
+        device : torch.device
+            Whether the simulations and training are to run on CPU or GPU
+        num_components: int
+            The number of components of the mixture of the density estimator
+        hidden_size: int
+            The number of units of every hidden layer of the density estimator
+        num_layers: int
+            The number of hidden layers of the density estimator
+        telemetry : Telemetry
+            Where the timings and losses are sent
+        """
+
+        self.model = model
+        self.cost = None
+        self.features = features
+        self.device = device
+        self.estimator_args = {'num_components': num_components, 'hidden_size': hidden_size, 'num_layers': num_layers}
+        self.estimator = None
+
+        self.inferred = []
+        var_names = [a for a in dir(self.model.params) if type(getattr(self.model.params, a)) == par]
+        for var_name in var_names:
+            var = getattr(self.model.params, var_name)
+            if var.fit_par and var_name != 'lm':
+                if not var.fit_hyper:
+                    raise ValueError(f"The parameter {var_name} has no prior (prior_mean and prior_std), so it cannot be sampled.")
+                self.inferred.append((var_name, var))
+        if not self.inferred:
+            raise ValueError("The model has no fitted parameters (fit_par) to infer.")
+        self.dim = sum(var.val.numel() for var_name, var in self.inferred)
+
+        self.theta_bank = torch.zeros(0, self.dim)
+        self.x_bank = None
+
+        self.trainingStats = TrainingStats(self.model)
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.lastRec = None
+
+    def samplePrior(self, num_samples: int, generator: torch.Generator = None):
+        """
+        Parameters
+        ----------
+        num_samples: int
+            The number of parameter sets
+        generator: torch.Generator
+            If given, the random number generator of the samples
+
+        Returns
+        -------
+        torch.Tensor with num_samples X number of inferred values
+            Parameter sets (val) drawn from the priors, N(prior_mean, 1/prior_precision)
+        """
+
+        thetas = []
+        for var_name, var in self.inferred:
+            mean = var.prior_mean.detach().expand_as(var.val).reshape(-1).cpu().float()
+            std = (1 / torch.sqrt(var.prior_precision.detach())).expand_as(var.val).reshape(-1).cpu().float()
+            thetas.append(mean + std * torch.randn(num_samples, mean.numel(), generator = generator))
+        return torch.cat(thetas, dim = 1)
+
+    def _toValues(self, thetas):
+        # Splits parameter sets (num_samples x number of inferred values) into the values (val) of every inferred parameter
+        values = {}
+        offset = 0
+        for var_name, var in self.inferred:
+            numel = var.val.numel()
+            theta = thetas[:, offset:offset + numel].to(var.val.device, var.val.dtype)
+            values[var_name] = theta.reshape((thetas.shape[0],) + tuple(var.val.shape))
+            offset += numel
+        return values
+
+    def _simulateBatch(self, thetas, u, num_windows: int, warmupWindow: int, generator: torch.Generator = None):
+        # Simulates one parameter set per simulation of the batch, without gradients, and returns the recorded
+        # time series of the features (batch_size x num_regions x num_windows * TRs_per_window).
+        # With a generator, the initial conditions are drawn from it rather than from numpy's global generator.
+        n = thetas.shape[0]
+        values = self._toValues(thetas)
+        no_external = torch.zeros(self.model.node_size, self.model.steps_per_TR, self.model.TRs_per_window, device = self.device)
+
+        saved = {var_name: var.val for var_name, var in self.inferred}
+        try:
+            for var_name, var in self.inferred:
+                var.val = values[var_name]
+            X = self.model.createIC(ver = 0, batch_size = n)
+            hE = self.model.createDelayIC(ver = 0, batch_size = n)
+            if generator is not None:
+                # Uniform in [-0.5, 0.5), as drawn by createIC and createDelayIC
+                X = torch.rand(X.shape, generator = generator, dtype = X.dtype) - 0.5
+                hE = torch.rand(hE.shape, generator = generator, dtype = hE.dtype) - 0.5
+            X = X.to(self.device)
+            hE = hE.to(self.device)
+            windows = []
+            with torch.no_grad():
+                for win_idx in range(warmupWindow + num_windows):
+                    external = no_external
+                    if win_idx >= warmupWindow and not isinstance(u, int):
+                        sim_win = win_idx - warmupWindow
+                        external = u[:, :, sim_win * self.model.TRs_per_window:(sim_win + 1) * self.model.TRs_per_window]
+                    next_window, hE = self.model.forward(external, X, hE)
+                    X = next_window['current_state']
+                    if win_idx >= warmupWindow:
+                        windows.append(next_window[self.features.simKey])
+        finally:
+            for var_name, var in self.inferred:
+                var.val = saved[var_name]
+        return torch.cat(windows, dim = -1)
+
+    def simulate(self, num_simulations: int, u, num_windows: int, warmupWindow: int = 10, batch_size: int = 100, seed: int = None):
+        """
+        Draws parameter sets from the priors, simulates them in batches, and adds them and their summary features to the bank.
+        Simulations which diverge (non-finite features) are left out.
+
+        Parameters
+        ----------
+        num_simulations: int
+            The number of parameter sets simulated
+        u: int or Tensor
+            The stimulus, as for ModelFitting.train
+        num_windows: int
+            The number of simulated windows (of TRs_per_window time points) summarized by the features
+        warmupWindow: int
+            The number of windows simulated first, and left out of the features
+        batch_size: int
+            The number of simulations run at once
+        seed: int
+            If given, the seed of the parameter sets, initial conditions and noise
+
+        Returns
+        -------
+        theta: torch.Tensor with number of simulations X number of inferred values
+            The parameter sets (val) of the new simulations
+        x: torch.Tensor with number of simulations X number of features
+            Their summary features
+        """
+
+        # With a seed, the noise of the model is reseeded for the simulations, and then restored, so that they leave
+        # the noise sequence of the model untouched (without one, the noise and parameter sets continue, so that
+        # repeated calls add new simulations)
+        noise_state = self.model.noise.getState() if seed is not None else None
+        generator = None
+        if seed is not None:
+            generator = torch.Generator().manual_seed(seed)
+            self.model.noise.reset(seed)
+        if not isinstance(u, int):
+            u = torch.as_tensor(u, dtype = self.model.dtype_policy.compute, device = self.device)
+        window_sim_time = self.model.TRs_per_window * self.model.steps_per_TR * float(self.model.step_size)
+
+        thetas = self.samplePrior(num_simulations, generator)
+        theta_list, x_list = [], []
+        try:
+            for start in range(0, num_simulations, batch_size):
+                theta = thetas[start:start + batch_size]
+                with self.telemetry.phase('forward'):
+                    ts = self._simulateBatch(theta, u, num_windows, warmupWindow, generator)
+                with self.telemetry.phase('features'):
+                    x = self.features.compute(ts).detach().cpu().float()
+                finite = torch.isfinite(x).all(dim = 1)
+                theta_list.append(theta[finite])
+                x_list.append(x[finite])
+                self.telemetry.window(window_sim_time * (warmupWindow + num_windows) * theta.shape[0], diverged = int((~finite).sum()))
+        finally:
+            if noise_state is not None:
+                self.model.noise.setState(noise_state)
+
+        theta = torch.cat(theta_list)
+        x = torch.cat(x_list)
+        self.theta_bank = torch.cat([self.theta_bank, theta])
+        self.x_bank = x if self.x_bank is None else torch.cat([self.x_bank, x])
+        self.telemetry.event('simulate', num_simulations = num_simulations, num_kept = theta.shape[0], bank_size = self.theta_bank.shape[0])
+        return theta, x
+
+    def train(self, num_epochs: int, learningrate: float = 1e-3, batch_size: int = 256, validation_fraction: float = 0.1, seed: int = None):
+        """
+        Trains the density estimator of the posterior on the bank of simulations, minimizing the negative log posterior density
+        of the simulated parameter sets given their features. The estimator of the epoch with the lowest validation loss is kept.
+
+        Parameters
+        ----------
+        num_epochs: int
+            The number of times to go through the simulations
+        learningrate: float
+            Learning rate of the Adam optimizer
+        batch_size: int
+            The number of simulations per update
+        validation_fraction: float
+            The fraction of the simulations held out for validation
+        seed: int
+            If given, the seed of the initialization, split and shuffling
+        """
+
+        if self.x_bank is None or self.x_bank.shape[0] < 2:
+            raise ValueError("There are not enough simulations to train on (see simulate).")
+        if seed is not None:
+            torch.manual_seed(seed)
+
+        theta = self.theta_bank.to(self.device)
+        x = self.x_bank.to(self.device)
+        num_sims = theta.shape[0]
+        perm = torch.randperm(num_sims, device = self.device)
+        num_val = min(max(int(validation_fraction * num_sims), 1), num_sims - 1) if validation_fraction > 0 else 0
+        val_idx, train_idx = perm[:num_val], perm[num_val:]
+
+        self.estimator = MixtureDensityEstimator(x.shape[1], self.dim, **self.estimator_args).to(self.device)
+        self.estimator.setStandardization(x[train_idx], theta[train_idx])
+        optim = torch.optim.Adam(self.estimator.parameters(), lr = learningrate)
+
+        best_loss = math.inf
+        best_state = None
+        for e in range(num_epochs):
+            epoch_start = time.perf_counter()
+            loss_his = []
+            order = train_idx[torch.randperm(train_idx.numel(), device = self.device)]
+            for start in range(0, order.numel(), batch_size):
+                idx = order[start:start + batch_size]
+                with self.telemetry.phase('loss'):
+                    loss = -self.estimator.logProb(theta[idx], x[idx]).mean()
+                optim.zero_grad()
+                with self.telemetry.phase('backward'):
+                    loss.backward()
+                with self.telemetry.phase('step'):
+                    optim.step()
+                loss_his.append(loss.detach().cpu().numpy().copy())
+
+            # TRAINING_STATS: the mean training loss of every epoch
+            self.trainingStats.appendLoss(np.mean(loss_his))
+
+            val_loss = self.trainingStats.loss[-1]
+            if num_val > 0:
+                with torch.no_grad():
+                    val_loss = float(-self.estimator.logProb(theta[val_idx], x[val_idx]).mean())
+            self.telemetry.window(0.0, epoch = e, loss = self.trainingStats.loss[-1])
+            if val_loss < best_loss:
+                best_loss = val_loss
+                best_state = {name: value.clone() for name, value in self.estimator.state_dict().items()}
+            self.telemetry.event('epoch', epoch = e, loss = self.trainingStats.loss[-1], val_loss = val_loss,
+                                 seconds = time.perf_counter() - epoch_start)
+
+        if best_state is not None:
+            self.estimator.load_state_dict(best_state)
+
+    def _features(self, empData):
+        # The summary features of a recording (a Timeseries or num_regions x time tensor), or features given directly
+        if torch.is_tensor(empData) and empData.dim() == 1:
+            x = empData
+        else:
+            x = self.features.compute(empData)[0]
+        x = x.to(self.device, torch.float32)
+        if x.numel() != self.estimator.num_features:
+            raise ValueError(f"The recording has {x.numel()} features, but the estimator was trained on {self.estimator.num_features} "
+                             "(the recording and the simulations should have the same length).")
+        return x
+
+    def _valuesOf(self, thetas):
+        # From parameter sets (val) to the values of every inferred parameter (as returned by Parameter.value())
+        values = {}
+        for var_name, val in self._toValues(thetas).items():
+            var = getattr(self.model.params, var_name)
+            values[var_name] = var.lb + (torch.exp(val) if var.asLog else val)
+        return values
+
+    def sample(self, empData, num_samples: int = 1000):
+        """
+        Parameters
+        ----------
+        empData: Timeseries or torch.Tensor
+            A recording (num_regions x time), or its summary features
+        num_samples: int
+            The number of samples
+
+        Returns
+        -------
+        dict of torch.Tensor
+            For every inferred parameter, num_samples samples of its posterior value (num_samples x shape of the parameter)
+        """
+
+        if self.estimator is None:
+            raise RuntimeError("The density estimator is not trained (see train).")
+        with torch.no_grad():
+            thetas = self.estimator.sample(self._features(empData), num_samples).cpu()
+        return self._valuesOf(thetas)
+
+    def posteriorMean(self, empData, num_samples: int = 1000):
+        """
+        Parameters
+        ----------
+        empData: Timeseries or torch.Tensor
+            A recording (num_regions x time), or its summary features
+        num_samples: int
+            The number of samples the mean is estimated from
+
+        Returns
+        -------
+        dict of torch.Tensor
+            For every inferred parameter, the mean of its posterior value
+        """
+
+        return {var_name: samples.mean(0) for var_name, samples in self.sample(empData, num_samples).items()}
+
+    def logProb(self, empData, values: dict = None):
+        """
+        Parameters
+        ----------
+        empData: Timeseries or torch.Tensor
+            A recording (num_regions x time), or its summary features
+        values: dict of torch.Tensor
+            For every inferred parameter, its value (val). Defaults to the current values of the model.
+
+        Returns
+        -------
+        float
+            The log posterior density of the parameters (val) given the recording
+        """
+
+        if self.estimator is None:
+            raise RuntimeError("The density estimator is not trained (see train).")
+        if values is None:
+            values = {var_name: var.val.detach() for var_name, var in self.inferred}
+        theta = torch.cat([torch.as_tensor(values[var_name]).reshape(-1) for var_name, var in self.inferred]).to(self.device, torch.float32)
+        with torch.no_grad():
+            return float(self.estimator.logProb(theta.reshape(1, -1), self._features(empData).reshape(1, -1))[0])
+
+    def evaluate(self, empData):
+        """
+        Parameters
+        ----------
+        empData: Timeseries or torch.Tensor
+            A recording (num_regions x time), or its summary features
+
+        Returns
+        -------
+        float
+            The log posterior density of the current model parameters given the recording
+        """
+
+        log_prob = self.logProb(empData)
+        self.telemetry.event('evaluate', log_prob = log_prob)
+        return log_prob
+
+    def setPosteriorMean(self, empData, num_samples: int = 1000):
+        """
+        Sets the inferred parameters of the model to the mean of their posterior (in val), e.g. to simulate it with ModelFitting.
+
+        Parameters
+        ----------
+        empData: Timeseries or torch.Tensor
+            A recording (num_regions x time), or its summary features
+        num_samples: int
+            The number of samples the mean is estimated from
+        """
+
+        with torch.no_grad():
+            thetas = self.estimator.sample(self._features(empData), num_samples).cpu()
+            for var_name, val in self._toValues(thetas).items():
+                getattr(self.model.params, var_name).val.copy_(val.mean(0))
+
+    def inferCohort(self, empRecs: list, num_samples: int = 1000):
+        """
+        Parameters
+        ----------
+        empRecs: list of Timeseries
+            The recordings of the cohort (e.g. one per subject)
+        num_samples: int
+            The number of samples per recording
+
+        Returns
+        -------
+        list of dict of torch.Tensor
+            For every recording, the posterior samples of every inferred parameter (see sample)
+        """
+
+        return [self.sample(empRec, num_samples) for empRec in empRecs]
@@ -0,0 +1,284 @@
+"""
+Authors: Zheng Wang, John Griffiths, Andrew Clappison, Hussain Ather, Kevin Kadak
+Neural Mass Model fitting module for the training telemetry (timings, throughput and diagnostics) and its sinks
+"""
+
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from ..datatypes import AbstractSink
+
+
+def _plain(value):
+    # Converts a value to a plain Python value that JSON and CSV can hold
+    if torch.is_tensor(value) or isinstance(value, np.generic) or (isinstance(value, np.ndarray) and value.size == 1):
+        return value.item()
+    return value
+
+
+class Telemetry:
+    """
+    This class collects the telemetry of a fitting run and hands it to a list of sinks, in place of printing it.
+
+    Within a training window, the time of each phase (by default 'forward', 'loss', 'backward' and 'step' for the optimizer step)
+    is measured with phase(), and window() then emits a 'window' record with the phase times, the total, and the throughput
+    in simulated time per wall-clock second. Other records ('recording', 'epoch', 'evaluate', ...) are emitted with event().
+
+    Costly diagnostics, such as the FC correlation of a whole recording, are passed to event() as functions,
+    and are only called when at least one sink asks for them (see AbstractSink.diagnostics).
+    With no sinks, telemetry does nothing at all.
+
+    Attributes
+    ----------
+    sinks : list of AbstractSink
+        Where the records go
+    synchronize : bool
+        Whether to synchronize CUDA before reading the clock, so that the phase times on a GPU are those of the kernels
+        rather than of their launch. This stalls the GPU queue, so it is off by default.
+    """
+
+    phases = ['forward', 'loss', 'backward', 'step']
+
+    def __init__(self, sinks: list = None, synchronize: bool = False):
+        """
+        Parameters
+        ----------
+        sinks : list of AbstractSink
+            Where the records go. Defaults to a PrintSink, showing the records previously printed by the fitting classes.
+        synchronize : bool
+            Whether to synchronize CUDA before reading the clock
+        """
+
+        self.sinks = sinks if sinks is not None else [PrintSink()]
+        self.synchronize = synchronize
+        self._times = {}
+
+    def _clock(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the enclosed code as a phase of the current window. Times of the same phase within a window add up.
+
+        Parameters
+        ----------
+        name : str
+            The phase, e.g. 'forward', 'loss', 'backward' or 'step'
+        """
+
+        if not self.sinks:
+            yield
+            return
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self._times[name] = self._times.get(name, 0.0) + self._clock() - start
+
+    def window(self, sim_time, **fields):
+        """
+        Emits a 'window' record with the phase times since the last window, and starts timing the next window.
+
+        Parameters
+        ----------
+        sim_time : float
+            The simulated time of the window (in the time units of the model's step_size)
+        **fields
+            Other values of the record, e.g. epoch, recording, window and loss (tensors are converted)
+        """
+
+        times, self._times = self._times, {}
+        if not self.sinks:
+            return
+        record = dict(fields)
+        for name in self.phases + [name for name in times if name not in self.phases]:
+            record[name + '_seconds'] = times.get(name, 0.0)
+        wall = sum(times.values())
+        record['seconds'] = wall
+        record['sim_time'] = sim_time
+        record['throughput'] = sim_time / wall if wall > 0 else float('nan')
+        self.event('window', **record)
+
+    def event(self, event, diagnostics: dict = None, **fields):
+        """
+        Emits a record.
+
+        Parameters
+        ----------
+        event : str
+            The kind of record, e.g. 'recording', 'epoch' or 'evaluate'
+        diagnostics : dict
+            Costly values of the record, as functions taking no argument. Only those asked for by a sink are computed.
+        **fields
+            The other values of the record (tensors are converted)
+        """
+
+        if not self.sinks:
+            return
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+        if diagnostics:
+            wanted = set()
+            for sink in self.sinks:
+                wanted.update(diagnostics if 'all' in sink.diagnostics else sink.diagnostics)
+            for name in diagnostics:
+                if name in wanted:
+                    record[name] = diagnostics[name]()
+        record = {key: _plain(value) for key, value in record.items()}
+        for sink in self.sinks:
+            sink.write(record)
+
+    def close(self):
+        """
+        Closes all the sinks.
+        """
+
+        for sink in self.sinks:
+            sink.close()
+
+
+class MemorySink(AbstractSink):
+    """
+    Keeps the records in memory, in the list `records`.
+    """
+
+    def __init__(self, diagnostics = []):
+        self.diagnostics = diagnostics
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def select(self, event):
+        """
+        Parameters
+        ----------
+        event : str
+            The kind of record
+
+        Returns
+        -------
+        list of dict
+            The records of that kind
+        """
+
+        return [record for record in self.records if record['event'] == event]
+
+    def column(self, name, event = 'window'):
+        """
+        Parameters
+        ----------
+        name : str
+            A value of the records, e.g. 'throughput' or 'forward_seconds'
+        event : str
+            The kind of record
+
+        Returns
+        -------
+        numpy array
+            The value in each record of that kind (nan where it is missing)
+        """
+
+        return np.array([record.get(name, np.nan) for record in self.select(event)], dtype = float)
+
+
+class _FileSink(AbstractSink):
+    # The file is opened on the first write, truncating it, and reopened for appending after the sink is pickled
+    # (e.g. when a ModelFitting object is sent back from a CohortFitting worker or saved)
+
+    def __init__(self, filename, diagnostics = []):
+        self.filename = filename
+        self.diagnostics = diagnostics
+        self._file = None
+        self._opened = False
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.filename, 'a' if self._opened else 'w', newline = '')
+            self._opened = True
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+
+class JSONLSink(_FileSink):
+    """
+    Writes every record as one line of JSON to a file.
+    """
+
+    def write(self, record):
+        f = self._open()
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+
+class CSVSink(_FileSink):
+    """
+    Writes the records of one kind (by default the 'window' records) as rows of a CSV file.
+    The columns are those of the first record; values missing from later records are left empty.
+    """
+
+    def __init__(self, filename, event = 'window', diagnostics = []):
+        super().__init__(filename, diagnostics)
+        self.event = event
+        self._columns = None
+
+    def write(self, record):
+        if record['event'] != self.event:
+            return
+        f = self._open()
+        if self._columns is None:
+            self._columns = list(record)
+            writer = csv.DictWriter(f, fieldnames = self._columns, restval = '', extrasaction = 'ignore')
+            writer.writeheader()
+        else:
+            writer = csv.DictWriter(f, fieldnames = self._columns, restval = '', extrasaction = 'ignore')
+        writer.writerow(record)
+        f.flush()
+
+
+class PrintSink(AbstractSink):
+    """
+    Prints the records of some kinds, one line of "key: value" fields per record. The default telemetry sink.
+    By default it asks for the pseudo FC correlation and cosine similarity of every training recording, 
+    which the fitting classes used to print.
+    """
+
+    def __init__(self, events = ['recording', 'epoch', 'evaluate', 'early_stop'], diagnostics = ['pseudo_FC_cor', 'cos_sim']):
+        self.events = events
+        self.diagnostics = diagnostics
+
+    def format(self, record):
+        """
+        Parameters
+        ----------
+        record : dict
+            A telemetry record
+
+        Returns
+        -------
+        str
+            The line printed for the record
+        """
+
+        return ', '.join(f"{key}: {value}" for key, value in record.items() if key not in ['event', 'time'])
+
+    def write(self, record):
+        if record['event'] in self.events:
+            print(self.format(record))